@@ -0,0 +1,192 @@
+"""
+Request micro-batching for Twittersa's JSON API.
+
+Scoring n texts in one call costs far less than n calls of one text, since
+every call pays for building a sparse matrix and a matrix product
+regardless of its size. MicroBatcher runs a scheduler thread that collects
+the items of concurrent requests for up to max_wait seconds (or until
+max_batch items are waiting), passes them to one function call and hands
+each request back its own rows.
+"""
+
+import os
+import threading
+import time
+from Queue import Queue, Empty
+
+
+class BatchTimeout(Exception):
+    """Raised when a submitted request isn't processed in time."""
+    def __init__(self, timeout):
+        Exception.__init__(self, 'no result after {}s'.format(timeout))
+        self.timeout = timeout
+
+
+class _Request(object):
+    """Items submitted together, and where their result is delivered."""
+    def __init__(self, items, submitted):
+        self.items = items
+        self.submitted = submitted
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Merges concurrent submit() calls into batched calls of function, which
+    takes a list of items and returns a sequence (e.g. an array) with one
+    row per item.
+
+    A batch is started as soon as a request arrives and closed max_wait
+    seconds later, or once it holds at least max_batch items; a single
+    request larger than max_batch is never split. Errors raised by function
+    are re-raised in every caller whose items were in the failing batch.
+
+    The scheduler thread is started on first use, and again in a process
+    forked after that (such as a gunicorn worker), where it doesn't survive,
+    or if it has died. Callers give up with BatchTimeout after timeout
+    seconds (None waits forever), so they can't hang on a lost request.
+    """
+    def __init__(self, function, max_batch=256, max_wait=0.005,
+                 timeout=30.0, clock=time.time):
+        self.function = function
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.clock = clock
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._depth = 0  # Items submitted but not yet being processed
+        self._max_depth = 0
+        self._requests = 0
+        self._batches = 0
+        self._items = 0
+        self._waited = 0  # Requests that have been batched
+        self._timeouts = 0
+        self._wait = 0.0
+        self._busy = 0.0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            if self._thread.is_alive():
+                return
+        else:
+            # Requests queued in the parent process never reach this one
+            self._queue = Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def submit(self, items):
+        """
+        Return function's rows for items (a list), computed as part of a
+        batch with any other items submitted at the same time.
+        """
+        if not items:
+            return self.function(items)
+        request = _Request(items, self.clock())
+        with self._lock:
+            self._ensure_started()
+            self._depth += len(items)
+            self._max_depth = max(self._max_depth, self._depth)
+            self._requests += 1
+            queue = self._queue
+        queue.put(request)
+        if not request.done.wait(self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise BatchTimeout(self.timeout)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self, queue, batch):
+        """Block for the next batch of requests, appending them to batch."""
+        batch.append(queue.get())
+        size = len(batch[0].items)
+        deadline = self.clock() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+            try:
+                request = queue.get(timeout=remaining)
+            except Empty:
+                break
+            batch.append(request)
+            size += len(request.items)
+        return size
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            batch = []
+            try:
+                self._process(batch, self._collect(queue, batch))
+            except Exception as e:
+                # A bug here mustn't leave the batch's callers waiting
+                for request in batch:
+                    if request.result is None:
+                        request.error = e
+            finally:
+                # Even if the thread is dying (the next submit restarts it)
+                for request in batch:
+                    request.done.set()
+
+    def _process(self, batch, size):
+        """Pass the items of batch to function and deliver their rows."""
+        start = self.clock()
+        with self._lock:
+            self._depth -= size
+            self._batches += 1
+            self._items += size
+            self._waited += len(batch)
+            self._wait += sum(start - r.submitted for r in batch)
+        items = []
+        for request in batch:
+            items.extend(request.items)
+        try:
+            result = self.function(items)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        else:
+            offset = 0
+            for request in batch:
+                n = len(request.items)
+                request.result = result[offset:offset + n]
+                offset += n
+        with self._lock:
+            self._busy += self.clock() - start
+
+    def stats(self):
+        """
+        The batcher's settings and counters: queue_depth (items waiting for
+        a batch right now) and its maximum so far, requests, batches and
+        items processed, mean_batch_size, the mean milliseconds a request
+        waited for its batch and a batch took to process, the total seconds
+        behind those means, and the requests that gave up with BatchTimeout.
+        """
+        with self._lock:
+            return {
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000,
+                'queue_depth': self._depth,
+                'max_queue_depth': self._max_depth,
+                'requests': self._requests,
+                'batches': self._batches,
+                'items': self._items,
+                'mean_batch_size': (float(self._items) / self._batches
+                                    if self._batches else 0.0),
+                'mean_wait_ms': (self._wait * 1000 / self._waited
+                                 if self._waited else 0.0),
+                'mean_batch_ms': (self._busy * 1000 / self._batches
+                                  if self._batches else 0.0),
+                'wait_seconds': self._wait,
+                'busy_seconds': self._busy,
+                'timeouts': self._timeouts,
+            }
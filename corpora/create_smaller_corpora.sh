@@ -1,7 +1,6 @@
-sizes=( 100 250 500 750 1000 2500 5000 7500 10000 15000 20000 25000 250000)
-for i in "${sizes[@]}"; do
-    shuf -o ./training.1600000.processed.noemoticon.csv.shuffled < ./training.1600000.processed.noemoticon.csv.shuffled
-    fout="./training.$i.csv"
-    echo "Writing to $fout"
-    tail -n "$i" ./training.1600000.processed.noemoticon.csv.shuffled > "$fout"
-done
+# Sample every training corpus size from the full Sentiment140 CSV in one
+# streaming pass (see util/split_corpus.py), writing lib/training.N/ and
+# corpora/training.N.csv. Extra arguments (sizes, --seed) are passed through.
+cd "$(dirname "$0")/.." || exit 1
+python util/split_corpus.py --csv-dir corpora \
+    corpora/training.1600000.processed.noemoticon.csv "$@"
@@ -0,0 +1,58 @@
+"""
+Gunicorn settings for serving Twittersa (see the Procfile).
+
+The app, and so the classifier, is loaded once in the master and shared by
+the workers it forks. The model's arrays and vocabulary are memory-mapped
+from the artifact in lib/model/, so workers never copy them, and each worker
+logs its memory use once it has started.
+"""
+
+import os
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Threads per worker; concurrent /api/classify requests in a worker are
+# batched together (see batching.py)
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = True
+errorlog = '-'
+
+
+def memory_usage(pid='self'):
+    """
+    The resident memory of process pid in kB, split into the part shared
+    with other processes (such as the master) and the part private to it.
+    """
+    usage = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0}
+    fields = {
+        'Rss:': 'rss', 'Pss:': 'pss',
+        'Shared_Clean:': 'shared', 'Shared_Dirty:': 'shared',
+        'Private_Clean:': 'private', 'Private_Dirty:': 'private',
+    }
+    with open('/proc/{}/smaps'.format(pid)) as fin:
+        for line in fin:
+            parts = line.split()
+            if parts and parts[0] in fields:
+                usage[fields[parts[0]]] += int(parts[1])
+    return usage
+
+
+def memory_report(pid='self'):
+    try:
+        usage = memory_usage(pid)
+    except IOError:
+        # No /proc, e.g. on OS X
+        import resource
+        return 'max RSS {} kB'.format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        )
+    return ('RSS {rss} kB ({shared} kB shared, {private} kB private), '
+            'PSS {pss} kB').format(**usage)
+
+
+def when_ready(server):
+    server.log.info('Master %s: %s', os.getpid(), memory_report())
+
+
+def post_worker_init(worker):
+    worker.log.info('Worker %s: %s', worker.pid, memory_report())
@@ -0,0 +1,147 @@
+"""
+Small in-process caches used to memoize preprocessing and predictions, and
+SingleFlight, which shares the result of a call among concurrent callers.
+"""
+
+from collections import OrderedDict, namedtuple
+import threading
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping holding at most maxsize items, evicting the least
+    recently used item when full. Hits and misses are counted so the cache
+    can be sized from its hit rate.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key (marking it recently used) or default."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert or update key, evicting the oldest item if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        """Change maxsize, evicting the oldest items if necessary."""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove every item and reset the hit/miss counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return hits, misses, maxsize and currsize as a CacheInfo."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<LRUCache {}>'.format(self.info())
+
+
+class FlightTimeout(Exception):
+    """Raised when waiting for another caller's call takes too long."""
+    def __init__(self, key, timeout):
+        Exception.__init__(self, 'gave up on {!r} after {}s'.format(
+            key, timeout
+        ))
+        self.key = key
+        self.timeout = timeout
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller of do()
+    runs the function, and callers arriving while it runs wait for it and
+    share its result, or have its exception raised, rather than running it
+    again. Once the call finishes the key is forgotten, so the next call
+    runs afresh.
+
+    Waiting callers give up with FlightTimeout after timeout seconds (None
+    waits forever); the call itself carries on for whoever is running it.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        """Return function(*args, **kwargs), shared with concurrent calls."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                flight.result = function(*args, **kwargs)
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        if not flight.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise FlightTimeout(key, self.timeout)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def __len__(self):
+        """The number of calls in flight."""
+        return len(self._flights)
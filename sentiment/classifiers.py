@@ -4,40 +4,166 @@ Implementations of several varations of Naive Bayes Classifiers.
 Jesse Mu
 """
 
+from sklearn.base import clone
 from sklearn.naive_bayes import MultinomialNB, BernoulliNB
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
-from sklearn.feature_selection import SelectKBest, chi2, VarianceThreshold
-from sklearn.metrics import f1_score
-from sklearn.pipeline import Pipeline
-# NLTK's tokenizer, as opposed to scikit, is more robust
+# Feature selection, metrics and pipelines are only needed for experiments
+# and are imported where they are used. So is nltk, which is slow to import.
 import re
-import nltk
-from nltk.stem import porter
 from random import shuffle
 import pickle  # Standard pickle for unicode support
+# cPickle only ever writes HIGHEST_PROTOCOL (2), a binary protocol that
+# stores unicode as length-prefixed UTF-8, so the unicode vocabularies and
+# feature names in model artifacts and the corpus cache round-trip intact
+import cPickle
+import hashlib
+import calendar
+import os
+import fcntl
+import shutil
+import tempfile
+import time
+import itertools
+import copy
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import scipy.sparse as sp
+import metrics
+from cache import LRUCache
+from corpus import Corpus, load_corpus, corpus_path, corpus_sizes
+from vocab import StringTable
+# NLTK's tokenizer, as opposed to scikit, is more robust
+from tokenizers import TOKENIZERS, get_tokenizer, get_nltk, nltk_tokenize
+
+SLANG_FILE = 'lib/noslang.pickle'
+STOPWORDS_FILE = 'lib/stopwords.pickle'
+# Loaded on first use by _load_resource, then shared
+_resources = {}
+
+
+def _load_resource(filename):
+    try:
+        return _resources[filename]
+    except KeyError:
+        with open(filename, 'r') as fin:
+            resource = _resources[filename] = pickle.load(fin)
+        return resource
+
+
+def get_slang():
+    """The slang dictionary, mapping acronyms to their expansions."""
+    return _load_resource(SLANG_FILE)
 
-# Look for corpora in this directory for heroku
-nltk.data.path.append('./nltk_data/')
 
-# Get slang dictionary
-with open('lib/noslang.pickle', 'r') as fin:
-    slang = pickle.load(fin)
+def get_stopwords():
+    """The set of twitter specific stopwords."""
+    return _load_resource(STOPWORDS_FILE)
 
-# These are twitter specific stopwords
-with open('lib/stopwords.pickle', 'r') as fin:
-    stopwords = pickle.load(fin)
+# Tokens that Punkt or the Treebank tokenizer may split when they are
+# tokenized again: those with punctuation it pads, "...", or a single
+# trailing period that could end a sentence. Anything else comes back out
+# unchanged...
+_UNSTABLE_TOKEN = re.compile(
+    r"""[?!:,;@#$%&"'`()\[\]{}<>]|--|\.\.\.|\.\*|[^.]\.$"""
+)
+# ...as do the contraction suffixes the Treebank tokenizer produces...
+_STABLE_SUFFIXES = frozenset(["'s", "'m", "'d", "'ll", "'re", "'ve", "n't"])
+# ...but not these (in any case), which it splits in two
+_SPLIT_WORDS = frozenset([
+    'cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna', 'whaddya',
+    'whatcha',
+])
+
+
+def _is_stable(tokens):
+    """True if nltk.word_tokenize(' '.join(tokens)) == tokens."""
+    for token in tokens:
+        if token.lower() in _SPLIT_WORDS or (
+                _UNSTABLE_TOKEN.search(token) and
+                token not in _STABLE_SUFFIXES):
+            return False
+    return True
+
+
+def _tokenize_phrase(text):
+    """nltk.word_tokenize, skipping nltk for plain space-separated words."""
+    tokens = text.split()
+    if _is_stable(tokens):
+        return tokens
+    return nltk_tokenize(text)
+
+# The expanded slang, tokenized once rather than for every hit
+_slang_tokens_by_tokenizer = {}
+
+
+def get_slang_tokens(tokenizer='nltk'):
+    """The slang table, with expansions pre-tokenized by tokenizer."""
+    try:
+        return _slang_tokens_by_tokenizer[tokenizer]
+    except KeyError:
+        if tokenizer == 'nltk':
+            tokenize = _tokenize_phrase
+        else:
+            tokenize = get_tokenizer(tokenizer)
+        table = {k: tokenize(v) for k, v in get_slang().iteritems()}
+        _slang_tokens_by_tokenizer[tokenizer] = table
+        return table
 
 PUNCTUATION = set('@$%^!?#&*()_+=-{}[]\|/:"\';",.')
-porter_stemmer = porter.PorterStemmer()
+# Created by stem on first use
+porter_stemmer = None
+
+# Tweet vocabulary is very Zipfian, so a modest cache catches most tokens
+STEM_CACHE_SIZE = int(os.environ.get('TWITTERSA_STEM_CACHE_SIZE', 50000))
+stem_cache = LRUCache(STEM_CACHE_SIZE)
+
 
+def stem(word):
+    """Porter stem word, memoized in stem_cache."""
+    global porter_stemmer
+    stemmed = stem_cache.get(word)
+    if stemmed is None:
+        if porter_stemmer is None:
+            porter_stemmer = get_nltk().stem.porter.PorterStemmer()
+        stemmed = porter_stemmer.stem(word)
+        stem_cache.put(word, stemmed)
+    return stemmed
 
-def preprocess(text):
+
+def preprocess_tokens(text, tokenizer='nltk'):
     """
-    Preprocess a tweet by:
+    Preprocess a unicode tweet into a list of tokens by:
      - Removing repeated words
      - Expanding acronyms
      - Porter stemming
      - Removing punctuation
+
+    tokenizer names the backend in sentiment.tokenizers to split words with.
+    """
+    tokenize = get_tokenizer(tokenizer)
+    expansions = get_slang_tokens(tokenizer)
+    text = text.lower()
+    # Remove two or more occurrences of characters`
+    text = re.sub(r'(.)\1+', r'\1\1', text)
+    text = tokenize(text)
+    processed = []
+    for i, word in enumerate(text):
+        word = stem(word)
+        if word in PUNCTUATION:
+            continue
+        if word in expansions:
+            # Look up the expanded acronym, already broken apart
+            processed.extend(expansions[word])
+        else:
+            processed.append(word)
+    return processed
+
+
+def preprocess(text, tokenizer='nltk'):
+    """
+    Preprocess a tweet (see preprocess_tokens), returning the tokens joined
+    with spaces in the same type (str or unicode) as text.
     """
     is_unicode = isinstance(text, unicode)
     # Attempt to decode for word_tokenize
@@ -50,21 +176,7 @@ def preprocess(text):
             codec = 'latin-1'
             text = text.decode(codec)
 
-    text = text.lower()
-    # Remove two or more occurrences of characters`
-    text = re.sub(r'(.)\1+', r'\1\1', text)
-    text = nltk.word_tokenize(text)
-    processed = []
-    for i, word in enumerate(text):
-        word = porter_stemmer.stem(word)
-        if word in PUNCTUATION:
-            continue
-        if word in slang:
-            # Look up the expanded acronym, and break that apart
-            words = nltk.word_tokenize(slang[word])
-            processed.extend(words)
-        else:
-            processed.append(word)
+    processed = preprocess_tokens(text, tokenizer)
 
     # Reencode string if necessary
     if not is_unicode:
@@ -72,12 +184,260 @@ def preprocess(text):
     return ' '.join(processed)
 
 
+class TweetAnalyzer(object):
+    """
+    Single-pass CountVectorizer analyzer, going straight from a raw tweet to
+    stemmed, slang-expanded, stopword-filtered n-grams.
+
+    With the default nltk tokenizer, produces the same features as a
+    CountVectorizer with preprocessor=preprocess and
+    tokenizer=nltk.word_tokenize, without joining the preprocessed tokens
+    into a string only to tokenize them again. The second tokenization is
+    only repeated for the few tweets where it could change anything (e.g. a
+    trailing "word." that Punkt decides ends a sentence). The regex
+    tokenizer is always single pass.
+    """
+    def __init__(self, stop_words=None, ngram_range=(1, 1), tokenizer='nltk',
+                 encoding='utf-8', decode_error='replace'):
+        self.stop_words = stop_words
+        self.ngram_range = ngram_range
+        self.tokenizer = tokenizer
+        self.encoding = encoding
+        self.decode_error = decode_error
+
+    def get_params(self, deep=False):
+        return {
+            'stop_words': self.stop_words,
+            'ngram_range': self.ngram_range,
+            'tokenizer': self.tokenizer,
+            'encoding': self.encoding,
+            'decode_error': self.decode_error,
+        }
+
+    def tokenize(self, doc):
+        """Decode and preprocess doc into its final list of tokens."""
+        if not isinstance(doc, unicode):
+            doc = doc.decode(self.encoding, self.decode_error)
+        tokens = preprocess_tokens(doc, self.tokenizer)
+        if self.tokenizer != 'nltk' or _is_stable(tokens):
+            return tokens
+        return nltk_tokenize(u' '.join(tokens))
+
+    def get_stop_words(self):
+        """The stop word set; 'twitter' names the one in lib/."""
+        if self.stop_words == 'twitter':
+            return get_stopwords()
+        return self.stop_words
+
+    def __call__(self, doc):
+        tokens = self.tokenize(doc)
+        stop_words = self.get_stop_words()
+        if stop_words is not None:
+            tokens = [w for w in tokens if w not in stop_words]
+
+        min_n, max_n = self.ngram_range
+        if max_n == 1:
+            return tokens
+        # Same ordering as CountVectorizer._word_ngrams
+        original_tokens = tokens
+        n_original_tokens = len(original_tokens)
+        tokens = []
+        for n in xrange(min_n, min(max_n + 1, n_original_tokens + 1)):
+            for i in xrange(n_original_tokens - n + 1):
+                tokens.append(u' '.join(original_tokens[i: i + n]))
+        return tokens
+
+
+def _count_documents(analyze, docs, vocabulary=None):
+    """
+    Count the features analyze produces for each of docs. Returns the
+    vocabulary (built from scratch unless one is given, in which case
+    unknown features are ignored) and a CSR document-term count matrix.
+    """
+    fixed_vocab = vocabulary is not None
+    if fixed_vocab and hasattr(vocabulary, 'lookup_many'):
+        return vocabulary, _count_table_documents(analyze, docs, vocabulary)
+    if not fixed_vocab:
+        vocabulary = {}
+    j_indices = []
+    values = []
+    indptr = [0]
+    for doc in docs:
+        feature_counter = {}
+        for feature in analyze(doc):
+            feature_idx = vocabulary.get(feature)
+            if feature_idx is None:
+                if fixed_vocab:
+                    continue
+                feature_idx = vocabulary[feature] = len(vocabulary)
+            feature_counter[feature_idx] = (
+                feature_counter.get(feature_idx, 0) + 1
+            )
+        j_indices.extend(feature_counter.iterkeys())
+        values.extend(feature_counter.itervalues())
+        indptr.append(len(j_indices))
+    X = sp.csr_matrix(
+        (np.asarray(values, dtype=np.intc),
+         np.asarray(j_indices, dtype=np.int32),
+         np.asarray(indptr, dtype=np.int32)),
+        shape=(len(indptr) - 1, len(vocabulary))
+    )
+    return vocabulary, X
+
+
+def _count_table_documents(analyze, docs, table):
+    """
+    _count_documents for a StringTable vocabulary, looking up the features
+    of every document in one batch.
+    """
+    features = []
+    indptr = [0]
+    for doc in docs:
+        features.extend(analyze(doc))
+        indptr.append(len(features))
+    columns = table.lookup_many(features)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    known = columns >= 0
+    X = sp.coo_matrix(
+        (np.ones(known.sum(), dtype=np.intc), (rows[known], columns[known])),
+        shape=(len(indptr) - 1, len(table))
+    ).tocsr()
+    X.sum_duplicates()
+    return X
+
+
+# Set in each pool worker by _init_count_worker (inherited when forked)
+_worker_analyze = None
+_worker_vocabulary = None
+
+
+def _init_count_worker(analyze, vocabulary):
+    global _worker_analyze, _worker_vocabulary
+    _worker_analyze = analyze
+    _worker_vocabulary = vocabulary
+
+
+def _count_chunk(docs):
+    return _count_documents(_worker_analyze, docs, _worker_vocabulary)
+
+
+# The types BagOfWords can keep its fitted vocabulary_ in
+VOCABULARY_BACKENDS = ('dict', 'table')
+
+
 class BagOfWords(CountVectorizer):
     """
-    Just a renaming of the scikit-learn CountVectorizer class.
-    This implements standard bag of words count-based feature extraction.
+    The scikit-learn CountVectorizer, which implements standard bag of words
+    count-based feature extraction, with optional parallel vectorization.
+
+    With n_jobs != 1, batches of at least parallel_threshold documents are
+    sharded across a process pool (n_jobs=-1 uses every core). Each worker
+    preprocesses and counts its shard; the shards are then remapped onto one
+    vocabulary and stacked, so the result is identical to the serial one.
+
+    With vocabulary_backend='table' the fitted vocabulary_ is converted to a
+    StringTable (see sentiment/vocab.py) once fitting is done, which
+    transform then looks features up in by the batch. It holds the same
+    mapping in a fraction of the memory of the dict.
     """
-    pass
+    def __init__(self, input='content', encoding='utf-8',
+                 decode_error='strict', strip_accents=None,
+                 lowercase=True, preprocessor=None, tokenizer=None,
+                 stop_words=None, token_pattern=r"(?u)\b\w\w+\b",
+                 ngram_range=(1, 1), analyzer='word',
+                 max_df=1.0, min_df=1, max_features=None,
+                 vocabulary=None, binary=False, dtype=np.int64,
+                 n_jobs=1, parallel_threshold=2000,
+                 vocabulary_backend='dict'):
+        super(BagOfWords, self).__init__(
+            input=input, encoding=encoding, decode_error=decode_error,
+            strip_accents=strip_accents, lowercase=lowercase,
+            preprocessor=preprocessor, tokenizer=tokenizer,
+            stop_words=stop_words, token_pattern=token_pattern,
+            ngram_range=ngram_range, analyzer=analyzer, max_df=max_df,
+            min_df=min_df, max_features=max_features, vocabulary=vocabulary,
+            binary=binary, dtype=dtype
+        )
+        self.n_jobs = n_jobs
+        self.parallel_threshold = parallel_threshold
+        self.vocabulary_backend = vocabulary_backend
+
+    def fit_transform(self, raw_documents, y=None):
+        """
+        Overrides CountVectorizer.fit_transform (which fit also uses) to
+        convert the fitted vocabulary to the vocabulary_backend.
+        """
+        if self.vocabulary_backend not in VOCABULARY_BACKENDS:
+            raise ValueError(
+                "vocabulary_backend should be one of {}, got {!r}".format(
+                    ', '.join(VOCABULARY_BACKENDS), self.vocabulary_backend
+                )
+            )
+        X = super(BagOfWords, self).fit_transform(raw_documents, y)
+        if (self.vocabulary_backend == 'table' and
+                not isinstance(self.vocabulary_, StringTable)):
+            self.vocabulary_ = StringTable.from_dict(self.vocabulary_)
+        return X
+
+    def _count_vocab(self, raw_documents, fixed_vocab):
+        """
+        Overrides CountVectorizer._count_vocab, which both fit_transform and
+        transform use to analyze and count raw_documents.
+        """
+        n_jobs = self.n_jobs if self.n_jobs > 0 else cpu_count()
+        if n_jobs == 1:
+            if fixed_vocab and hasattr(self.vocabulary_, 'lookup_many'):
+                # A StringTable, looked up in one batch
+                _, X = _count_documents(self.build_analyzer(), raw_documents,
+                                        self.vocabulary_)
+                X = X.astype(self.dtype)
+                X.sort_indices()
+                return self.vocabulary_, X
+            return super(BagOfWords, self)._count_vocab(
+                raw_documents, fixed_vocab
+            )
+        docs = list(raw_documents)
+        if len(docs) < self.parallel_threshold:
+            return super(BagOfWords, self)._count_vocab(docs, fixed_vocab)
+
+        chunksize = -(-len(docs) // (n_jobs * 4))
+        chunks = [docs[i:i + chunksize]
+                  for i in xrange(0, len(docs), chunksize)]
+        pool = Pool(n_jobs, initializer=_init_count_worker, initargs=(
+            self.build_analyzer(), self.vocabulary_ if fixed_vocab else None
+        ))
+        try:
+            results = pool.map(_count_chunk, chunks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if fixed_vocab:
+            vocabulary = self.vocabulary_
+            matrices = [X for _, X in results]
+        else:
+            # Merge the shard vocabularies and remap their column indices
+            vocabulary = {}
+            matrices = []
+            for local_vocabulary, X in results:
+                mapping = np.empty(len(local_vocabulary), dtype=np.int32)
+                for feature, i in local_vocabulary.iteritems():
+                    mapping[i] = vocabulary.setdefault(
+                        feature, len(vocabulary)
+                    )
+                matrices.append((X.data, mapping[X.indices], X.indptr))
+            matrices = [sp.csr_matrix(m, shape=(len(m[2]) - 1,
+                                                len(vocabulary)))
+                        for m in matrices]
+            if not vocabulary:
+                raise ValueError("empty vocabulary; perhaps the documents "
+                                 "only contain stop words")
+        X = sp.vstack(matrices, format='csr').astype(self.dtype)
+        X.sort_indices()
+        return vocabulary, X
 
 
 def show_most_informative_features(vectorizer, clf, n=20):
@@ -95,65 +455,880 @@ def load_pickle(filename):
     return training
 
 
-PROD_TRAINING_FILE = 'lib/training.15000.pickle'
-PROD_TRAINING_DATA = load_pickle(PROD_TRAINING_FILE)
+PROD_TRAINING_FILE = corpus_path(15000)
+PROD_MODEL_FILE = 'lib/model'
+# Bump whenever the artifact layout changes
+MODEL_FORMAT_VERSION = 2
+# Bump whenever preprocess() changes in a way that alters features
+PREPROCESS_VERSION = 3
+# nltk or regex (see sentiment/tokenizers.py)
+PROD_TOKENIZER = 'nltk'
 PROD_PROCESSOR = BagOfWords(
     min_df=1,
-    analyzer='word',
-    encoding='utf-8',
-    decode_error='replace',
-    preprocessor=preprocess,
-    tokenizer=nltk.word_tokenize,
-    stop_words=stopwords,
-    ngram_range=(1, 2),
-    binary=True
+    analyzer=TweetAnalyzer(
+        stop_words='twitter',
+        ngram_range=(1, 2),
+        tokenizer=PROD_TOKENIZER,
+        encoding='utf-8',
+        decode_error='replace',
+    ),
+    binary=True,
+    vocabulary_backend='table'
 )
 PROD_CLASSIFIER = BernoulliNB()
 
 
+PREDICTION_CACHE_SIZE = int(
+    os.environ.get('TWITTERSA_PREDICTION_CACHE_SIZE', 10000)
+)
+
+
+def text_key(text):
+    """
+    Hash text for the prediction cache, after normalizing away the case and
+    whitespace differences that preprocessing ignores anyway.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    normalized = u' '.join(text.lower().split())
+    return hashlib.md5(normalized.encode('utf-8')).digest()
+
+
+def nb_feature_scores(clf):
+    """
+    Return the chi2 statistic and training count of each feature of the
+    fitted naive Bayes clf. These are computed from its feature and class
+    counts exactly as sklearn's chi2 would compute them from the training
+    matrix, so no training data is needed.
+    """
+    observed = clf.feature_count_
+    counts = observed.sum(axis=0)
+    class_prob = clf.class_count_ / clf.class_count_.sum()
+    expected = np.outer(class_prob, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = ((observed - expected) ** 2 / expected).sum(axis=0)
+    # Features never seen in training are uninformative
+    return np.nan_to_num(chi2), counts
+
+
+class LinearNB(object):
+    """
+    A fitted naive Bayes classifier reduced to the linear model it scores
+    with, for serving: the joint log likelihood of each class is
+    X . feature_weights_ * scale_ + intercept_.
+
+    For a BernoulliNB the weight of a feature is the log odds of it being
+    present, feature_log_prob_ - log(1 - exp(feature_log_prob_)), and the
+    intercept folds in the class prior and the log probability of every
+    feature being absent. For a MultinomialNB the weights are just
+    feature_log_prob_. feature_weights_ is (n_features, n_classes), so the
+    sparse product doesn't need a transposed copy, and is either float32
+    (scale_ is None) or int8 with a per-class scale_.
+    """
+    def __init__(self, feature_weights, intercept, classes, scale=None,
+                 binarize=None):
+        self.feature_weights_ = feature_weights
+        self.intercept_ = intercept
+        self.classes_ = classes
+        self.scale_ = scale
+        self.binarize = binarize
+
+    @classmethod
+    def from_nb(cls, clf, columns=None, dtype=np.float32):
+        """
+        Convert the fitted naive Bayes clf, keeping only the feature columns
+        given (all of them by default). A BernoulliNB scores the dropped
+        features as always absent.
+        """
+        feature_log_prob = clf.feature_log_prob_
+        intercept = np.array(clf.class_log_prior_, dtype=np.float64)
+        if isinstance(clf, BernoulliNB):
+            absent = np.log(1 - np.exp(feature_log_prob))
+            weights = feature_log_prob - absent
+            intercept += absent.sum(axis=1)
+            binarize = clf.binarize
+        else:
+            weights = feature_log_prob
+            binarize = None
+        if columns is not None:
+            weights = weights[:, columns]
+        weights = weights.T
+        dtype = np.dtype(dtype)
+        scale = None
+        if dtype == np.int8:
+            scale = np.ones(weights.shape[1])
+            if len(weights):
+                scale = np.abs(weights).max(axis=0) / 127.
+                scale[scale == 0] = 1
+            weights = np.round(weights / scale)
+        elif dtype.kind != 'f':
+            raise ValueError('dtype should be a float type or int8, got {}'
+                             .format(dtype))
+        return cls(np.ascontiguousarray(weights, dtype=dtype), intercept,
+                   np.asarray(clf.classes_), scale, binarize)
+
+    def _joint_log_likelihood(self, X):
+        X = sp.csr_matrix(X)
+        if self.binarize is not None:
+            X = sp.csr_matrix(
+                ((X.data > self.binarize).astype(np.int64), X.indices,
+                 X.indptr), shape=X.shape
+            )
+        jll = X.dot(self.feature_weights_)
+        if self.scale_ is not None:
+            jll = jll * self.scale_
+        return jll + self.intercept_
+
+    def predict_log_proba(self, X):
+        jll = self._joint_log_likelihood(X)
+        top = jll.max(axis=1).reshape(-1, 1)
+        log_norm = top + np.log(np.exp(jll - top).sum(axis=1)).reshape(-1, 1)
+        return jll - log_norm
+
+    def predict_proba(self, X):
+        return np.exp(self.predict_log_proba(X))
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self._joint_log_likelihood(X), axis=1)]
+
+
 class TwitterClassifier(object):
     """
     A wrapper for a scikit classifier that simplifies fitting and training.
     """
-    def __init__(self, clf=PROD_CLASSIFIER):
+    def __init__(self, clf=PROD_CLASSIFIER,
+                 cache_size=PREDICTION_CACHE_SIZE):
         self.clf = clf
+        self.checksum = None
+        # Class probabilities by text_key, for retweets and bot spam
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def load(cls, filename=PROD_MODEL_FILE, checksum=None, mmap=True):
+        """
+        Load a fitted classifier from a model artifact written by save().
+
+        The classifier's arrays and the vocabulary are memory-mapped read-only
+        unless mmap is False, so processes loading the same artifact share
+        them (and can't partial_fit them).
 
-    def train(self, data=PROD_TRAINING_DATA, processor=PROD_PROCESSOR):
-        self.data = data
+        Returns None if the artifact doesn't exist, was written by a different
+        MODEL_FORMAT_VERSION, or (if given) doesn't match checksum.
+        """
+        # If save() repoints filename at a new version while we read the old
+        # one, the old one can be removed under us: read the new one instead
+        for _ in range(10):
+            path = os.path.realpath(filename)
+            classifier = cls._load_version(path, checksum, mmap)
+            if classifier is not None or os.path.realpath(filename) == path:
+                break
+        return classifier
+
+    @classmethod
+    def _load_version(cls, filename, checksum, mmap):
+        mmap_mode = 'r' if mmap else None
+        try:
+            with open(os.path.join(filename, 'model.pickle'), 'rb') as fin:
+                artifact = cPickle.load(fin)
+            if artifact.get('version') != MODEL_FORMAT_VERSION:
+                return None
+            if checksum is not None and artifact.get('checksum') != checksum:
+                return None
+            clf = artifact['clf']
+            for name in artifact['arrays']:
+                setattr(clf, name, np.load(
+                    os.path.join(filename, 'clf.{}.npy'.format(name)),
+                    mmap_mode=mmap_mode
+                ))
+            processor = artifact['processor']
+            if artifact['vocabulary']:
+                processor.vocabulary_ = StringTable.load(
+                    os.path.join(filename, 'vocabulary'), mmap=mmap
+                )
+        except (IOError, OSError, EOFError, ImportError, AttributeError,
+                cPickle.UnpicklingError):
+            # Missing, truncated, or pickled against code that has since moved
+            return None
+        classifier = cls(clf=clf)
+        classifier.processor = processor
+        classifier.checksum = artifact['checksum']
+        return classifier
+
+    def save(self, filename=PROD_MODEL_FILE, checksum=None):
+        """
+        Write the fitted processor and classifier to a model artifact: a
+        directory holding a small pickle, the classifier's numpy arrays as
+        .npy files and the vocabulary as a StringTable.
+
+        Each save writes a new version directory beside filename (such as
+        lib/model.<checksum>.<random>) and then atomically repoints filename,
+        a symlink, at it, so a process loading the model at any moment finds
+        either the old version or the new one. The version it replaced stays
+        until the next save, linked as filename.previous, and is removed
+        then; processes that have it mapped keep reading it. Concurrent
+        saves each switch in turn, and the last one wins.
+        """
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        prefix = basename + '.'
+        if checksum:
+            prefix += checksum[:12] + '.'
+        version = tempfile.mkdtemp(prefix=prefix, dir=dirname)
+        try:
+            self._write_version(version, checksum)
+            os.chmod(version, 0o755)  # mkdtemp makes it private
+            _link_version(filename, version)
+        except:
+            shutil.rmtree(version, ignore_errors=True)
+            raise
+        self.checksum = checksum
+
+    def _write_version(self, dirname, checksum):
+        processor = copy.copy(self.processor)
+        vocabulary = getattr(processor, 'vocabulary_', None)
+        if vocabulary is not None:
+            if not isinstance(vocabulary, StringTable):
+                vocabulary = StringTable.from_dict(vocabulary)
+            vocabulary.save(os.path.join(dirname, 'vocabulary'))
+            del processor.vocabulary_
+        clf = copy.copy(self.clf)
+        arrays = sorted(name for name, value in vars(clf).iteritems()
+                        if isinstance(value, np.ndarray))
+        for name in arrays:
+            np.save(os.path.join(dirname, 'clf.{}.npy'.format(name)),
+                    getattr(clf, name))
+            delattr(clf, name)
+        artifact = {
+            'version': MODEL_FORMAT_VERSION,
+            'checksum': checksum,
+            'processor': processor,
+            'clf': clf,
+            'arrays': arrays,
+            'vocabulary': vocabulary is not None,
+        }
+        with open(os.path.join(dirname, 'model.pickle'), 'wb') as fout:
+            cPickle.dump(artifact, fout, cPickle.HIGHEST_PROTOCOL)
+
+    def train(self, data=None, processor=PROD_PROCESSOR):
+        """
+        Fit processor and the classifier on data, a Corpus or a list of
+        (text, label) pairs (by default, the corpus at PROD_TRAINING_FILE).
+        The data is not kept once the model is fit.
+        """
+        if data is None:
+            data = load_corpus(PROD_TRAINING_FILE)
         self.processor = processor
 
-        shuffle(self.data)
-        X = self.processor.fit_transform([x[0] for x in self.data])
-        y = [x[1] for x in self.data]
+        if isinstance(data, Corpus):
+            data = data.shuffled()
+            X = self.processor.fit_transform(data.texts())
+            y = data.labels
+        else:
+            data = list(data)
+            shuffle(data)
+            X = self.processor.fit_transform([x[0] for x in data])
+            y = [x[1] for x in data]
 
         self.clf.fit(X, y)
+        self.cache.clear()
+
+    def export(self, min_chi2=None, min_count=None, dtype=np.float32):
+        """
+        Return a smaller copy of this fitted naive Bayes classifier for
+        serving. Features with a chi2 statistic below min_chi2, or seen fewer
+        than min_count times in training, are dropped from the vocabulary,
+        and the classifier becomes a LinearNB with dtype (float32 or int8)
+        weights.
+        """
+        chi2, counts = nb_feature_scores(self.clf)
+        keep = np.ones(len(counts), dtype=bool)
+        if min_chi2 is not None:
+            keep &= chi2 >= min_chi2
+        if min_count is not None:
+            keep &= counts >= min_count
+        new_columns = np.cumsum(keep) - 1
+        vocabulary = self.processor.vocabulary_
+        pruned = {feature: int(new_columns[i])
+                  for feature, i in vocabulary.iteritems() if keep[i]}
+        if isinstance(vocabulary, StringTable):
+            pruned = StringTable.from_dict(pruned)
+        processor = copy.copy(self.processor)
+        processor.vocabulary_ = pruned
+        exported = TwitterClassifier(
+            clf=LinearNB.from_nb(self.clf, np.flatnonzero(keep), dtype),
+            cache_size=self.cache.maxsize
+        )
+        exported.processor = processor
+        if self.checksum is not None:
+            exported.checksum = hashlib.sha1(
+                '{} min_chi2={!r} min_count={!r} dtype={}'.format(
+                    self.checksum, min_chi2, min_count, np.dtype(dtype)
+                )
+            ).hexdigest()
+        return exported
+
+    def predict_proba(self, texts):
+        """
+        Return the class probabilities for each of texts, in the order of
+        clf.classes_. Texts already in the prediction cache (or repeated in
+        texts) are only vectorized and scored once.
+        """
+        probs = np.empty((len(texts), len(self.clf.classes_)))
+        misses = OrderedDict()  # text_key -> (text, rows it appears in)
+        for i, text in enumerate(texts):
+            key = text_key(text)
+            prob = self.cache.get(key)
+            if prob is not None:
+                probs[i] = prob
+            else:
+                misses.setdefault(key, (text, []))[1].append(i)
+        if misses:
+            with metrics.stage('vectorize'):
+                X = self.processor.transform(
+                    [text for text, _ in misses.itervalues()]
+                )
+            with metrics.stage('predict'):
+                miss_probs = self.clf.predict_proba(X)
+            for (key, (_, rows)), prob in zip(misses.iteritems(), miss_probs):
+                probs[rows] = prob
+                # Copy, so the cache doesn't keep the whole batch alive
+                self.cache.put(key, prob.copy())
+        return probs
 
     def predict(self, tweet):
         """
         Return a TweetSentiment instance for the provided Tweepy tweet.
         """
-        X = self.processor.transform([tweet.text])
-        probs = self.clf.predict_proba(X)
+        probs = self.predict_proba([tweet.text])
         probs_dict = {self.clf.classes_[i]: p for i, p in enumerate(probs[0])}
         label = max(probs_dict, key=lambda x: probs_dict[x])
         sentiment = Sentiment(label, probs_dict)
         tweetsent = TweetSentiment(tweet, sentiment)
         return tweetsent
 
-    def predict_many(self, tweets):
+    def predict_many(self, tweets, columnar=False):
         """
         Return a TweetSentiment instance for the provided list of
         Tweepy tweets.
+
+        With columnar=True, return a SentimentBatch instead, which holds the
+        results as arrays and only builds TweetSentiments on access.
         """
-        X = self.processor.transform([t.text for t in tweets])
-        probs = self.clf.predict_proba(X)
-        tweetsents = []
-        for prob, tweet in zip(probs, tweets):
-            probs_dict = {self.clf.classes_[i]: p for i, p in enumerate(prob)}
-            label = max(probs_dict, key=lambda x: probs_dict[x])
-            sentiment = Sentiment(label, probs_dict)
-            tweetsents.append(TweetSentiment(tweet, sentiment))
-        return tweetsents
+        probs = self.predict_proba([t.text for t in tweets])
+        batch = SentimentBatch(tweets, probs, self.clf.classes_)
+        if columnar:
+            return batch
+        return list(batch)
+
+
+def _symlink(target, filename):
+    """Atomically make filename a symlink to target (a name beside it)."""
+    tmp_link = '{}.{}.link'.format(filename, os.getpid())
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, filename)
+
+
+def _link_version(filename, version):
+    """
+    Atomically point the symlink filename at the model version directory
+    version beside it. The version it replaces is kept, linked as
+    filename.previous, until the next switch, so processes still loading it
+    can finish; the one that was linked there before is removed.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    dirname = os.path.realpath(dirname)
+    previous = filename + '.previous'
+    old = stale = None
+    # Savers take turns, so each replaced version is removed exactly once
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.islink(filename):
+            old = os.path.realpath(filename)
+        elif os.path.isdir(filename):
+            # Saved before artifacts were versioned: this one move isn't
+            # atomic, and loaders retrain if they run into it
+            old = os.path.join(dirname, '{}.{}.old'.format(basename,
+                                                           os.getpid()))
+            os.rename(filename, old)
+        _symlink(os.path.basename(version), filename)
+        if old is not None:
+            if os.path.islink(previous):
+                stale = os.path.realpath(previous)
+            _symlink(os.path.basename(old), previous)
+    # Never remove a directory this didn't create
+    if (stale is not None and os.path.dirname(stale) == dirname and
+            os.path.basename(stale).startswith(basename + '.') and
+            stale not in (old, os.path.realpath(version))):
+        shutil.rmtree(stale, ignore_errors=True)
+
+
+def file_checksum(filename):
+    """
+    Return the SHA-1 hex digest of the contents of filename, or of every file
+    in it if it's a directory (such as a corpus).
+    """
+    if os.path.isdir(filename):
+        filenames = [os.path.join(filename, name)
+                     for name in sorted(os.listdir(filename))]
+    else:
+        filenames = [filename]
+    sha = hashlib.sha1()
+    for name in filenames:
+        with open(name, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 16), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def _describe_param(value):
+    """A description of an estimator parameter that is stable across runs."""
+    if hasattr(value, 'get_params'):
+        return _describe_estimator(value)
+    if callable(value) and hasattr(value, '__name__'):
+        return '{}.{}'.format(value.__module__, value.__name__)
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value))
+    return repr(value)
+
+
+# Parameters that change how fast a model is fit, not what it learns
+_RUNTIME_PARAMS = frozenset(['n_jobs', 'parallel_threshold'])
+
+
+def _describe_estimator(estimator):
+    params = estimator.get_params(deep=False)
+    for param in _RUNTIME_PARAMS:
+        params.pop(param, None)
+    return '{}({})'.format(type(estimator).__name__, ', '.join(
+        '{}={}'.format(k, _describe_param(params[k])) for k in sorted(params)
+    ))
+
+
+def model_checksum(training_file=PROD_TRAINING_FILE,
+                   processor=PROD_PROCESSOR, clf=PROD_CLASSIFIER):
+    """
+    Checksum identifying a trained model: the training data, the
+    preprocessing resources and config, and the classifier config. A model
+    artifact whose checksum doesn't match this is stale.
+    """
+    sha = hashlib.sha1()
+    sha.update('format={}\n'.format(MODEL_FORMAT_VERSION))
+    sha.update('preprocess={}\n'.format(PREPROCESS_VERSION))
+    for filename in (training_file, SLANG_FILE, STOPWORDS_FILE):
+        sha.update('{}={}\n'.format(filename, file_checksum(filename)))
+    sha.update('processor={}\n'.format(_describe_estimator(processor)))
+    sha.update('clf={}\n'.format(_describe_estimator(clf)))
+    return sha.hexdigest()
+
+
+# Vectorized corpora for the experiment CLI, keyed by corpus_cache_key
+CORPUS_CACHE_DIR = 'lib/cache'
+
+
+def corpus_cache_key(filename, analyzer):
+    """
+    Checksum identifying the document-term matrix analyzer produces for the
+    corpus at filename: the corpus, the preprocessing resources and
+    config, and the analyzer config.
+    """
+    sha = hashlib.sha1()
+    sha.update('preprocess={}\n'.format(PREPROCESS_VERSION))
+    for name in (filename, SLANG_FILE, STOPWORDS_FILE):
+        sha.update('{}={}\n'.format(name, file_checksum(name)))
+    sha.update('analyzer={}\n'.format(_describe_estimator(analyzer)))
+    return sha.hexdigest()
+
+
+def vectorize_corpus(filename, analyzer, n_jobs=1,
+                     cache_dir=CORPUS_CACHE_DIR):
+    """
+    Return (features, counts, labels) for the corpus at filename:
+    the feature names, a CSR document-term count matrix with one row per
+    tweet and the array of labels.
+
+    Preprocessing is deterministic, so the result is cached in cache_dir
+    under corpus_cache_key and only recomputed when the corpus, the
+    preprocessing resources or the analyzer change. Pass cache_dir=None to
+    skip the cache.
+    """
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir, '{}.pickle'.format(corpus_cache_key(filename, analyzer))
+        )
+        try:
+            with open(cache_file, 'rb') as fin:
+                cached = cPickle.load(fin)
+            return cached['features'], cached['counts'], cached['labels']
+        except Exception:
+            # Missing, truncated or in a stale format: rebuild it
+            pass
+    corpus = load_corpus(filename)
+    vectorizer = BagOfWords(min_df=1, analyzer=analyzer, n_jobs=n_jobs)
+    counts = vectorizer.fit_transform(corpus.texts()).tocsr()
+    features = np.asarray(vectorizer.get_feature_names(), dtype=object)
+    labels = corpus.labels
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cached = {'features': features, 'counts': counts, 'labels': labels}
+        tmp_filename = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_filename, 'wb') as fout:
+            cPickle.dump(cached, fout, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, cache_file)
+    return features, counts, labels
+
+
+def split_counts(counts, train_rows, test_rows):
+    """
+    Split a document-term matrix from vectorize_corpus into training and
+    testing matrices, keeping only the columns that occur in the training
+    rows. Returns (columns, X_train, X_test). With min_df=1 this is exactly
+    what a vectorizer fit on the training tweets alone would produce.
+    """
+    X_train = counts[train_rows]
+    columns = np.unique(X_train.indices)
+    return columns, X_train[:, columns], counts[test_rows][:, columns]
+
+
+def build_pipeline(classifier='bernoulli', weighting=None, kbest=None,
+                   threshold=None):
+    """
+    The experiment pipeline for a document-term matrix: optional tf or tf-idf
+    weighting (weighting='tf' or 'tfidf'), chi-squared selection of the kbest
+    features, a variance threshold and a naive Bayes classifier that assumes
+    pos/neg tweets are equally likely.
+    """
+    from sklearn.feature_selection import SelectKBest, chi2, VarianceThreshold
+    from sklearn.pipeline import Pipeline
+
+    if classifier == 'bernoulli':
+        nb = BernoulliNB(class_prior=[0.5, 0.5])
+    elif classifier == 'multinomial':
+        nb = MultinomialNB(class_prior=[0.5, 0.5])
+    else:
+        raise ValueError('unknown classifier {}'.format(classifier))
+    pipe = []
+    if weighting is not None:
+        if weighting not in ('tf', 'tfidf'):
+            raise ValueError('unknown weighting {}'.format(weighting))
+        pipe.append(('tfidf', TfidfTransformer(
+            use_idf=(weighting == 'tfidf')
+        )))
+    if kbest is not None:
+        pipe.append(('selector', SelectKBest(chi2, k=kbest)))
+    if threshold is not None:
+        pipe.append(('variance_threshold', VarianceThreshold(
+            threshold=threshold
+        )))
+    pipe.append(('clf', nb))
+    return Pipeline(pipe)
+
+
+# Set in each grid worker by _init_grid_worker (inherited when forked)
+_grid_corpora = None
+_grid_splits = None
+_grid_matrices = {}
+
+
+def _init_grid_worker(corpora, splits):
+    global _grid_corpora, _grid_splits
+    _grid_corpora = corpora
+    _grid_splits = splits
+    _grid_matrices.clear()
+
+
+def _split_matrices(ngram, i, binary):
+    """The (X, y, X_test, y_test) for split i, memoized per worker."""
+    key = (ngram, i, binary)
+    if key not in _grid_matrices:
+        counts, labels = _grid_corpora[ngram]
+        train_rows, test_rows = _grid_splits[i]
+        _, X, X_test = split_counts(counts, train_rows, test_rows)
+        if binary:
+            X.data[:] = 1
+            X_test.data[:] = 1
+        _grid_matrices[key] = (X, labels[train_rows],
+                               X_test, labels[test_rows])
+    return _grid_matrices[key]
+
+
+def _evaluate_settings(settings):
+    """
+    Mean accuracy, f-score, fit time and predict time of the pipeline for
+    settings over every split.
+    """
+    from sklearn.metrics import f1_score
+
+    accuracy = fscore = fit_time = predict_time = 0.0
+    for i in range(len(_grid_splits)):
+        X, y, X_test, y_test = _split_matrices(
+            settings['ngram'], i, settings['classifier'] == 'bernoulli'
+        )
+        pipeline = build_pipeline(
+            settings['classifier'], settings['weighting'],
+            settings['kbest'], settings['threshold']
+        )
+        start = time.time()
+        pipeline.fit(X, y)
+        fit_time += time.time() - start
+        start = time.time()
+        y_predict = pipeline.predict(X_test)
+        predict_time += time.time() - start
+        accuracy += np.mean(y_predict == y_test)
+        fscore += f1_score(y_test, y_predict, pos_label='positive')
+    n = len(_grid_splits)
+    return settings, accuracy / n, fscore / n, fit_time / n, predict_time / n
+
+
+GRID_KEYS = ('classifier', 'ngram', 'kbest', 'weighting', 'threshold')
+
+
+def check_jobs(n_jobs):
+    """
+    Return the number of processes n_jobs asks for: itself if positive, or
+    one per core for -1. Raises ValueError for anything else.
+    """
+    if n_jobs == -1:
+        return cpu_count()
+    if n_jobs < 1:
+        raise ValueError('n_jobs must be a positive number of processes or '
+                         '-1, not {}'.format(n_jobs))
+    return n_jobs
+
+
+def jobs_argument(value):
+    """An argparse type for a -j/--jobs option (see check_jobs)."""
+    from argparse import ArgumentTypeError
+    try:
+        return check_jobs(int(value))
+    except ValueError:
+        raise ArgumentTypeError(
+            'expected a positive number of processes or -1, not {}'.format(
+                value)
+        )
+
+
+def grid_search(filename, grid, analyzer_params=None, num=1, n_jobs=-1,
+                cache_dir=CORPUS_CACHE_DIR):
+    """
+    Evaluate every combination of the settings in grid, a dict mapping each
+    of GRID_KEYS to a list of values, on the corpus at filename.
+
+    The corpus is vectorized once per n-gram setting (see vectorize_corpus,
+    which also takes cache_dir) and every combination is scored on the same
+    num random 70/30 splits. Combinations are evaluated across a process
+    pool of n_jobs workers (n_jobs=-1 uses every core). Yields (settings,
+    accuracy, fscore, fit_time, predict_time) in grid order, with mean
+    per-split timings in seconds.
+    """
+    n_jobs = check_jobs(n_jobs)
+    analyzer_params = dict(analyzer_params or {})
+    corpora = {}
+    for ngram in grid['ngram']:
+        analyzer = TweetAnalyzer(ngram_range=(1, ngram), **analyzer_params)
+        _, counts, labels = vectorize_corpus(
+            filename, analyzer, n_jobs=n_jobs, cache_dir=cache_dir
+        )
+        corpora[ngram] = (counts, labels)
+    splits = []
+    for i in range(num):
+        rows = range(len(labels))
+        shuffle(rows)
+        cutoff = (len(rows) * 7) / 10
+        splits.append((rows[:cutoff], rows[cutoff:]))
+    combinations = [
+        dict(zip(GRID_KEYS, values))
+        for values in itertools.product(*[grid[key] for key in GRID_KEYS])
+    ]
+    n_jobs = min(n_jobs, len(combinations))
+    if n_jobs == 1:
+        _init_grid_worker(corpora, splits)
+        for result in itertools.imap(_evaluate_settings, combinations):
+            yield result
+        return
+    pool = Pool(n_jobs, _init_grid_worker, (corpora, splits))
+    try:
+        for result in pool.imap(_evaluate_settings, combinations):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _restrict_nb(clf, columns):
+    """
+    A copy of the fitted naive Bayes clf that only knows the given feature
+    columns, smoothed exactly as if it had been fit on those columns alone.
+    """
+    restricted = copy.copy(clf)
+    restricted.feature_count_ = clf.feature_count_[:, columns]
+    smoothed_fc = restricted.feature_count_ + clf.alpha
+    if isinstance(clf, BernoulliNB):
+        smoothed_cc = clf.class_count_ + clf.alpha * 2
+    else:
+        smoothed_cc = smoothed_fc.sum(axis=1)
+    restricted.feature_log_prob_ = (np.log(smoothed_fc) -
+                                    np.log(smoothed_cc.reshape(-1, 1)))
+    return restricted
+
+
+def learning_curve(filename, sizes, classifier='bernoulli', analyzer=None,
+                   cache_dir=CORPUS_CACHE_DIR):
+    """
+    Score classifier at each of sizes with a single pass over the corpus
+    at filename, yielding (size, accuracy, fscore) in increasing
+    order of size.
+
+    A random 30% of the corpus is held out once and the rest is streamed
+    through partial_fit, so the naive Bayes counts grow incrementally. To
+    line up with the 70/30 split of --all, the checkpoint for size is taken
+    after 70% of size tweets, and only the features seen so far are used,
+    so each checkpoint scores exactly what fitting on that prefix of the
+    stream would.
+    """
+    from sklearn.metrics import f1_score
+
+    if analyzer is None:
+        analyzer = TweetAnalyzer()
+    features, counts, labels = vectorize_corpus(
+        filename, analyzer, cache_dir=cache_dir
+    )
+    rows = range(len(labels))
+    shuffle(rows)
+    holdout = (len(rows) * 3) / 10
+    _, X, X_test = split_counts(counts, rows[holdout:], rows[:holdout])
+    y, y_test = labels[rows[holdout:]], labels[rows[:holdout]]
+    if classifier == 'bernoulli':
+        X.data[:] = 1
+        X_test.data[:] = 1
+    clf = build_pipeline(classifier).named_steps['clf']
+    classes = np.unique(labels)
+    trained = 0
+    for size in sorted(sizes):
+        n = (size * 7) / 10
+        if not 0 < n <= X.shape[0]:
+            raise ValueError('size {} is out of range for {}'.format(
+                size, filename
+            ))
+        if n > trained:
+            clf.partial_fit(X[trained:n], y[trained:n], classes=classes)
+            trained = n
+        seen = np.flatnonzero(clf.feature_count_.sum(axis=0))
+        y_predict = _restrict_nb(clf, seen).predict(X_test[:, seen])
+        yield (size, np.mean(y_predict == y_test),
+               f1_score(y_test, y_predict, pos_label='positive'))
+
+
+def load_or_train(model_file=PROD_MODEL_FILE,
+                  training_file=PROD_TRAINING_FILE):
+    """
+    Return the production TwitterClassifier, loading it from model_file if
+    the artifact there is up to date, and otherwise training it from
+    training_file and (re)writing the artifact.
+    """
+    checksum = model_checksum(training_file)
+    classifier = TwitterClassifier.load(model_file, checksum=checksum)
+    if classifier is not None:
+        return classifier
+    # Fit copies, so later training can't change the classifier returned
+    classifier = TwitterClassifier(clf=clone(PROD_CLASSIFIER))
+    classifier.train(data=load_corpus(training_file),
+                     processor=clone(PROD_PROCESSOR))
+    try:
+        classifier.save(model_file, checksum=checksum)
+    except (IOError, OSError):
+        # A read-only filesystem just means we train again next time
+        pass
+    return classifier
+
+
+class SentimentBatch(object):
+    """
+    The sentiment of a batch of tweets, stored column-wise: a probability
+    matrix (one column per class), the index of each tweet's label, and each
+    tweet's prob_scaled, id and created_at. Indexing with an int returns a
+    TweetSentiment view, and indexing with a slice or an index array returns
+    another SentimentBatch.
+    """
+    def __init__(self, tweets, probs, classes):
+        self.tweets = tweets
+        self.probs = np.asarray(probs, dtype=np.float64).reshape(
+            len(tweets), len(classes)
+        )
+        self.classes = np.asarray(classes)
+        self._class_names = self.classes.tolist()
+        self.label_index = self.probs.argmax(axis=1)
+        self._ids = None
+        self._created_at = None
+
+    @classmethod
+    def concat(cls, batches, classes):
+        """Join batches (all of the given classes) into one."""
+        batches = list(batches)
+        tweets = [tweet for batch in batches for tweet in batch.tweets]
+        if batches:
+            probs = np.vstack([batch.probs for batch in batches])
+        else:
+            probs = np.empty((0, len(classes)))
+        return cls(tweets, probs, classes)
+
+    @property
+    def labels(self):
+        return self.classes[self.label_index]
+
+    @property
+    def prob_scaled(self):
+        """Sentiment.prob_scaled for every tweet, as an array."""
+        positive = self.probs[:, self._class_column('positive')]
+        negative = self.probs[:, self._class_column('negative')]
+        is_positive = self.labels == 'positive'
+        return np.where(is_positive, positive - 0.5, -negative + 0.5)
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = np.array([t.id for t in self.tweets], dtype=np.int64)
+        return self._ids
+
+    @property
+    def created_at(self):
+        if self._created_at is None:
+            self._created_at = np.array(
+                [t.created_at for t in self.tweets], dtype='datetime64[s]'
+            )
+        return self._created_at
+
+    def _class_column(self, label):
+        return np.flatnonzero(self.classes == label)[0]
+
+    def __len__(self):
+        return len(self.tweets)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            probs = dict(zip(self._class_names, self.probs[index].tolist()))
+            label = self._class_names[self.label_index[index]]
+            sentiment = Sentiment(label, probs)
+            return TweetSentiment(self.tweets[index], sentiment)
+        if isinstance(index, slice):
+            tweets = self.tweets[index]
+        else:
+            index = np.asarray(index)
+            tweets = [self.tweets[i] for i in index]
+        batch = SentimentBatch(tweets, self.probs[index], self.classes)
+        if self._ids is not None:
+            batch._ids = self._ids[index]
+        if self._created_at is not None:
+            batch._created_at = self._created_at[index]
+        return batch
+
+    def __repr__(self):
+        return "<SentimentBatch of {} tweets>".format(len(self))
 
 
 class Sentiment(object):
@@ -164,6 +1339,8 @@ class Sentiment(object):
     and enable adding more detailed information about the sentiment
     (besides a raw percentage)
     """
+    __slots__ = ('_label', '_probs')
+
     def __init__(self, label, probs):
         self._label = label
         self._probs = probs
@@ -217,9 +1394,15 @@ class Sentiment(object):
 
 class TweetSentiment(object):
     """A class encapsulating a tweet and its associated sentiment object."""
+    __slots__ = ('_tweet', '_sentiment', '_sort_key')
+
     def __init__(self, tweet, sentiment=None):
         self._tweet = tweet
         self._sentiment = sentiment
+        # Seconds since the epoch, so sorting doesn't format dates
+        created_at = getattr(tweet, 'created_at', None)
+        self._sort_key = (calendar.timegm(created_at.utctimetuple())
+                          if created_at is not None else None)
 
     @property
     def tweet(self):
@@ -248,10 +1431,13 @@ class TweetSentiment(object):
     def __repr__(self):
         return "<{}: {}>".format(repr(self._tweet), repr(self._sentiment))
 
+    @property
+    def sort_key(self):
+        return self._sort_key
+
     def __cmp__(self, other):
         """Compare by dates,"""
-        return (int(self.tweet.created_at.strftime('%s')) -
-                int(other.tweet.created_at.strftime('%s')))
+        return cmp(self._sort_key, other._sort_key)
 
     def __add__(self, other):
         return self.sentiment + other.sentiment
@@ -259,17 +1445,19 @@ class TweetSentiment(object):
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    from sklearn.metrics import f1_score
+    from sklearn.pipeline import Pipeline
     import sys
     import os
     parser = ArgumentParser()
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         'corpus', nargs='*', type=int, default=[],
-        help="corpus sizes (must be the size of a .pickle file in lib/)"
+        help="corpus sizes (must be the size of a corpus in lib/)"
     )
     group.add_argument(
         '-a', '--all', action='store_true',
-        help='grab all training .pickle files in lib'
+        help='grab all training corpora in lib'
     )
     parser.add_argument(
         '-c', '--classifier', default='bernoulli',
@@ -283,6 +1471,15 @@ if __name__ == '__main__':
         '-n', '--ngram', type=int, default=1,
         help="use ngrams in addition to unigrams"
     )
+    parser.add_argument(
+        '-j', '--jobs', type=jobs_argument, default=None,
+        help="vectorize (and with --grid, evaluate) with this many processes "
+             "(-1 for one per core, the default for --grid)"
+    )
+    parser.add_argument(
+        '-t', '--tokenizer', default='nltk', choices=sorted(TOKENIZERS),
+        help="tokenizer backend (nltk is slow but matches the writeup)"
+    )
     tf_options = parser.add_mutually_exclusive_group()
     tf_options.add_argument(
         '--tf', action='store_true',
@@ -319,91 +1516,205 @@ if __name__ == '__main__':
         '-r', '--repl', action='store_true',
         help="enter REPL for last classifier"
     )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="preprocess the corpus again instead of using lib/cache"
+    )
+    parser.add_argument(
+        '-l', '--learning-curve', type=int, dest='curve', metavar='SIZE',
+        help="stream the SIZE corpus in lib once with partial_fit and "
+             "score it at the given corpus sizes (default: every size in lib "
+             "up to SIZE), averaged over -N held-out sets"
+    )
+    parser.add_argument(
+        '-g', '--grid', action='append', default=[], metavar='KEY=V1,V2,...',
+        help="evaluate every combination of these values for classifier, "
+             "ngram, kbest, weighting (none, tf or tfidf) or threshold, "
+             "overriding the corresponding option (none disables kbest "
+             "and threshold)"
+    )
 
     args = parser.parse_args()
 
-    if not args.corpus and not args.all:
+    if not args.corpus and not args.all and args.curve is None:
         sys.exit('classifiers.py: error: must specify corpus files')
 
     corpus = args.corpus
-    if args.all:
-        corpus = sorted(['lib/{}'.format(f) for f in os.listdir('lib/') if
-                         f.startswith('training') and f.endswith('.pickle')])
+    if args.all or args.curve is not None:
+        corpus = corpus_sizes()
+
+    if args.tfidf:
+        weighting = 'tfidf'
+    elif args.tf:
+        weighting = 'tf'
+    else:
+        weighting = None
+    cache_dir = None if args.no_cache else CORPUS_CACHE_DIR
+
+    def optional(parse):
+        return lambda value: None if value == 'none' else parse(value)
+
+    if args.curve is not None:
+        if (args.grid or weighting is not None or args.kbest is not None or
+                args.threshold is not None or args.pickle is not None or
+                args.repl or args.showfeats):
+            sys.exit('classifiers.py: error: --learning-curve only supports '
+                     '-c, -s, -n, -t and -N')
+        if args.classifier not in ('bernoulli', 'multinomial'):
+            sys.exit('classifiers.py: error: unknown classifier {}'.format(
+                args.classifier
+            ))
+        sizes = args.corpus or [n for n in corpus if n <= args.curve]
+        analyzer = TweetAnalyzer(
+            stop_words='twitter' if args.stopwords else None,
+            ngram_range=(1, args.ngram),
+            tokenizer=args.tokenizer,
+            encoding='utf-8',
+            decode_error='replace',
+        )
+        # Average each checkpoint over -N independent held-out sets
+        totals = OrderedDict()
+        try:
+            for i in range(args.num):
+                for size, accuracy, fscore in learning_curve(
+                        corpus_path(args.curve), sizes,
+                        args.classifier, analyzer, cache_dir=cache_dir):
+                    total = totals.setdefault(size, [0.0, 0.0])
+                    total[0] += accuracy
+                    total[1] += fscore
+        except ValueError as e:
+            sys.exit('classifiers.py: error: {}'.format(e))
+        print "size,accuracy,fscore"
+        for size, (accuracy, fscore) in totals.iteritems():
+            print "{},{},{}".format(
+                size, accuracy / args.num, fscore / args.num
+            )
+        sys.exit()
+
+    if args.grid:
+        if args.pickle is not None or args.repl or args.showfeats:
+            sys.exit('classifiers.py: error: --grid does not support -p, -r '
+                     'or --show-best-features')
+        grid = {
+            'classifier': [args.classifier],
+            'ngram': [args.ngram],
+            'kbest': [args.kbest],
+            'weighting': [weighting],
+            'threshold': [args.threshold],
+        }
+        parsers = {
+            'classifier': str,
+            'ngram': int,
+            'kbest': optional(int),
+            'weighting': optional(str),
+            'threshold': optional(float),
+        }
+        for spec in args.grid:
+            key, _, values = spec.partition('=')
+            if key not in parsers or not values:
+                sys.exit('classifiers.py: error: bad --grid {}'.format(spec))
+            try:
+                grid[key] = [parsers[key](v) for v in values.split(',')]
+            except ValueError:
+                sys.exit('classifiers.py: error: bad --grid {}'.format(spec))
+        for value in grid['classifier']:
+            if value not in ('bernoulli', 'multinomial'):
+                sys.exit('classifiers.py: error: unknown classifier {}'.format(
+                    value
+                ))
+        for value in grid['weighting']:
+            if value not in (None, 'tf', 'tfidf'):
+                sys.exit('classifiers.py: error: unknown weighting {}'.format(
+                    value
+                ))
+        analyzer_params = {
+            'stop_words': 'twitter' if args.stopwords else None,
+            'tokenizer': args.tokenizer,
+            'encoding': 'utf-8',
+            'decode_error': 'replace',
+        }
+        print ('size,accuracy,fscore,classifier,ngram,kbest,weighting,'
+               'threshold,fit_time,predict_time')
+        for n in corpus:
+            results = grid_search(
+                corpus_path(n), grid, analyzer_params, num=args.num,
+                n_jobs=-1 if args.jobs is None else args.jobs,
+                cache_dir=cache_dir
+            )
+            for settings, accuracy, fscore, fit_time, predict_time in results:
+                print '{},{},{},{},{},{},{},{},{:.4f},{:.4f}'.format(
+                    n, accuracy, fscore, *([
+                        'none' if settings[key] is None else settings[key]
+                        for key in GRID_KEYS
+                    ] + [fit_time, predict_time])
+                )
+                sys.stdout.flush()
+        sys.exit()
 
     print "size,accuracy,fscore"
-    for filename in corpus:
-        if not args.all:  # Format the filename correctly
-            n = filename
-            filename = 'lib/training.{}.pickle'.format(str(filename))
-        else:
-            n = int(filename[13:-7])  # Just get the number
+    for n in corpus:
+        filename = corpus_path(n)
         accuracy_list = []
         fscore_list = []
+        analyzer = TweetAnalyzer(
+            stop_words='twitter' if args.stopwords else None,
+            ngram_range=(1, args.ngram),
+            tokenizer=args.tokenizer,
+            encoding='utf-8',
+            decode_error='replace',  # For the one-off latin-1 tweets
+        )
+        # Preprocess once; each repetition only reshuffles the rows
+        features, counts, labels = vectorize_corpus(
+            filename, analyzer, n_jobs=args.jobs or 1, cache_dir=cache_dir
+        )
+        binary = (args.classifier == 'bernoulli')
         for i in range(args.num):
             # sys.stdout.write('{}...'.format(i))
             # sys.stdout.flush()
-            all_features = load_pickle(filename)
-            shuffle(all_features)
-
-            cutoff = (len(all_features) * 7) / 10
-            training = all_features[:cutoff]
-            testing = all_features[cutoff:]
-
-            vectorizer = CountVectorizer(
-                min_df=1,
-                analyzer='word',  # Would I ever use char n-grams?
-                encoding='utf-8',
-                decode_error='replace',  # For the one-off latin-1 tweets
-                ngram_range=(1, args.ngram),
-                preprocessor=preprocess,
-                tokenizer=nltk.word_tokenize,
-                stop_words=stopwords if args.stopwords else None,
-                binary=(args.classifier == 'bernoulli'),
+            rows = range(len(labels))
+            shuffle(rows)
+
+            cutoff = (len(rows) * 7) / 10
+            columns, X, X_test = split_counts(
+                counts, rows[:cutoff], rows[cutoff:]
+            )
+            y, y_test = labels[rows[:cutoff]], labels[rows[cutoff:]]
+            if binary:
+                X.data[:] = 1
+                X_test.data[:] = 1
+
+            # Fixed to the training columns, for --show-best-features and
+            # for classifying raw text with -p and -r
+            vectorizer = BagOfWords(
+                analyzer=analyzer,
+                vocabulary=features[columns],
+                binary=binary,
             )
 
-            # Assume pos/neg tweets are equally likely
-            if args.classifier == 'bernoulli':
-                nb = BernoulliNB(class_prior=[0.5, 0.5])
-            elif args.classifier == 'multinomial':
-                nb = MultinomialNB(class_prior=[0.5, 0.5])
-            else:
-                sys.exit(
-                    'classifiers.py: error: unknown classifier {}'.format(
-                        args.classifier
-                    )
+            try:
+                classifier_pipeline = build_pipeline(
+                    args.classifier, weighting, args.kbest, args.threshold
                 )
-
-            selector = SelectKBest(chi2, k=args.kbest)
-            tfidf = TfidfTransformer(use_idf=args.tfidf)
-            pipe = []
-            pipe.append(('vectorizer', vectorizer))
-            if args.tfidf or args.tf:
-                pipe.append(('tfidf', tfidf))
-            if args.kbest is not None:
-                pipe.append(('selector', selector))
-            if args.threshold is not None:
-                pipe.append(('variance_threshold', VarianceThreshold(
-                    threshold=args.threshold
-                )))
-            pipe.append(('clf', nb))
-
-            X, y = map(list, zip(*training))
-
-            classifier_pipeline = Pipeline(pipe)
+            except ValueError as e:
+                sys.exit('classifiers.py: error: {}'.format(e))
 
             # print classifier_pipeline
-            classifier = classifier_pipeline.fit(X, y)
+            classifier_pipeline.fit(X, y)
+            classifier = Pipeline(
+                [('vectorizer', vectorizer)] + classifier_pipeline.steps
+            )
 
-            X_test, y_test = map(list, zip(*testing))
-            accuracy = classifier.score(X_test, y_test)
+            accuracy = classifier_pipeline.score(X_test, y_test)
 
-            y_predict = classifier.predict(X_test)
+            y_predict = classifier_pipeline.predict(X_test)
 
             fscore = f1_score(y_test, y_predict, pos_label='positive')
 
             # Add totals for running average
             if args.showfeats:
-                show_most_informative_features(vectorizer, nb)
+                show_most_informative_features(
+                    vectorizer, classifier_pipeline.named_steps['clf']
+                )
 
             accuracy_list.append(accuracy)
             fscore_list.append(fscore)
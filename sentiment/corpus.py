@@ -0,0 +1,198 @@
+"""
+Columnar, memory-mapped tweet corpora.
+
+A corpus is a directory of three .npy arrays:
+
+ - text.npy: uint8, the raw bytes of every tweet back to back
+ - offsets.npy: int64, len + 1 offsets, so tweet i is
+   text[offsets[i]:offsets[i + 1]]
+ - labels.npy: int8, each tweet's index into LABELS
+
+Loading maps the arrays rather than reading them, and sampling and shuffling
+only build index arrays, so even the 1.6M tweet corpus loads instantly and
+never becomes a list of Python strings unless it's iterated.
+
+Write corpora with util/pickle_corpus.py.
+"""
+
+import os
+import pickle  # Standard pickle for unicode support
+import shutil
+from itertools import izip
+
+import numpy as np
+
+LABELS = ('negative', 'neutral', 'positive')
+_LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+# Tweets copied per gather when saving a view, which bounds the size of the
+# byte index array each gather builds
+_SAVE_CHUNK_ROWS = 1 << 16
+
+
+class Corpus(object):
+    """
+    A view of a corpus: the tweets at rows (all of them, in order, if rows is
+    None) of the text, offsets and label code arrays. Iterating yields
+    (text, label) pairs like the lists in lib/training.N.pickle.
+    """
+    def __init__(self, text, offsets, codes, rows=None):
+        self._text = text
+        self._offsets = offsets
+        self._codes = codes
+        self._rows = rows
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build an in-memory corpus from (text, label) pairs."""
+        chunks = []
+        lengths = []
+        codes = []
+        for text, label in pairs:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            try:
+                codes.append(_LABEL_CODES[label])
+            except KeyError:
+                raise ValueError('unknown label {!r}'.format(label))
+            chunks.append(text)
+            lengths.append(len(text))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        text = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+        return cls(text, offsets, np.asarray(codes, dtype=np.int8))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load the corpus in the directory path, memory-mapped by default."""
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            np.load(os.path.join(path, 'text.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'offsets.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'labels.npy'), mmap_mode=mmap_mode),
+        )
+
+    def save(self, path):
+        """
+        Write the tweets in this view to the directory path, replacing it.
+        The corpus is written to a temporary directory and renamed into place.
+        """
+        offsets = self._offsets
+        if self._rows is None:
+            text = self._text
+            codes = self._codes
+        else:
+            starts = offsets[self._rows]
+            lengths = offsets[self._rows + 1] - starts
+            offsets = np.zeros(len(self._rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            text = np.empty(offsets[-1], dtype=np.uint8)
+            for i in xrange(0, len(lengths), _SAVE_CHUNK_ROWS):
+                j = min(i + _SAVE_CHUNK_ROWS, len(lengths))
+                # Where each byte of tweets i to j is in the source text
+                index = np.arange(offsets[i], offsets[j]) + np.repeat(
+                    starts[i:j] - offsets[i:j], lengths[i:j]
+                )
+                text[offsets[i]:offsets[j]] = self._text[index]
+            codes = self._codes[self._rows]
+        tmp_path = '{}.{}.tmp'.format(path.rstrip('/'), os.getpid())
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'text.npy'), text)
+        np.save(os.path.join(tmp_path, 'offsets.npy'),
+                offsets - offsets[0])
+        np.save(os.path.join(tmp_path, 'labels.npy'), codes)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def __len__(self):
+        if self._rows is None:
+            return len(self._codes)
+        return len(self._rows)
+
+    def _row(self, i):
+        if i < 0:
+            i += len(self)
+        if self._rows is None:
+            return i
+        return self._rows[i]
+
+    def text(self, i):
+        """The raw (byte string) text of tweet i."""
+        row = self._row(i)
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return self._text[start:end].tostring()
+
+    def texts(self):
+        """Iterate over the raw text of every tweet."""
+        text, offsets = self._text, self._offsets
+        rows = xrange(len(self)) if self._rows is None else self._rows
+        for row in rows:
+            yield text[offsets[row]:offsets[row + 1]].tostring()
+
+    @property
+    def codes(self):
+        """Each tweet's index into LABELS."""
+        if self._rows is None:
+            return self._codes
+        return self._codes[self._rows]
+
+    @property
+    def labels(self):
+        """An array of each tweet's label."""
+        return np.asarray(LABELS)[self.codes]
+
+    def take(self, rows):
+        """A view of the tweets at rows (an index array) of this view."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._rows is not None:
+            rows = self._rows[rows]
+        return Corpus(self._text, self._offsets, self._codes, rows)
+
+    def shuffled(self, random_state=np.random):
+        """A randomly ordered view of this corpus."""
+        return self.take(random_state.permutation(len(self)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(len(self))[index])
+        return self.text(index), LABELS[self._codes[self._row(index)]]
+
+    def __iter__(self):
+        for text, code in izip(self.texts(), self.codes):
+            yield text, LABELS[code]
+
+    def __repr__(self):
+        return '<Corpus of {} tweets>'.format(len(self))
+
+
+def load_corpus(path):
+    """
+    Load the corpus at path: a corpus directory, which is memory-mapped, or
+    a pickled list of (text, label) pairs.
+    """
+    if os.path.isdir(path):
+        return Corpus.load(path)
+    with open(path, 'r') as fin:
+        return Corpus.from_pairs(pickle.load(fin))
+
+
+def corpus_path(size, directory='lib'):
+    """
+    The path of the training corpus with size tweets in directory: the
+    corpus directory if it has been built, and otherwise the pickle.
+    """
+    path = os.path.join(directory, 'training.{}'.format(size))
+    if os.path.isdir(path):
+        return path
+    return '{}.pickle'.format(path)
+
+
+def corpus_sizes(directory='lib'):
+    """The sizes of the training corpora in directory, in either format."""
+    sizes = set()
+    for name in os.listdir(directory):
+        parts = name.split('.')
+        if (parts[:1] == ['training'] and parts[2:] in ([], ['pickle']) and
+                len(parts) > 1 and parts[1].isdigit()):
+            sizes.add(int(parts[1]))
+    return sorted(sizes)
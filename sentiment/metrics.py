@@ -0,0 +1,249 @@
+"""
+Lightweight in-process metrics, served in the Prometheus text format.
+
+stage(name) times a block of code into the twittersa_stage_seconds
+histogram, and into the current thread's request profile if one was started
+with start_profile(). inc() and observe() update other counters and
+histograms, and collectors added with add_collector() report values (such as
+cache hit counts) that are already kept elsewhere when render() is called.
+
+Metrics are per process: each gunicorn worker serves its own. With
+TWITTERSA_METRICS=0, stage() returns a shared no-op context manager unless
+the request is being profiled, and inc() and observe() return at once, so
+the hooks cost next to nothing.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+ENABLED = os.environ.get('TWITTERSA_METRICS', '1') != '0'
+
+# Latency histogram bucket bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+_HELP = {
+    'twittersa_stage_seconds': 'Time spent in each stage of a request',
+    'twittersa_request_seconds': 'Time taken to serve each request',
+    'twittersa_requests_total': 'Requests served, by endpoint and status',
+    'twittersa_stale_timelines_total':
+        'Cached timelines served because a refresh was rate limited',
+}
+
+
+class Histogram(object):
+    """Counts of observations at or below each of buckets, and their sum."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """(le, count) for each bucket, ending with '+Inf'."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    ))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """Thread-safe counters and histograms, keyed by name and labels."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """
+        Add a function that returns (name, type, help, samples) tuples at
+        render time, where type is 'counter' or 'gauge' and samples is a list
+        of (labels dict, value).
+        """
+        self._collectors.append(collector)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Every metric, in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name, kind, help):
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self._lock:
+            for name in sorted(self._counters):
+                header(name, 'counter', _HELP.get(name))
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), _format_value(value)
+                    ))
+            for name in sorted(self._histograms):
+                header(name, 'histogram', _HELP.get(name))
+                for labels, histogram in sorted(
+                        self._histograms[name].items()):
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append('{}_bucket{} {}'.format(
+                            name, _format_labels(labels + (('le', bound),)),
+                            count
+                        ))
+                    lines.append('{}_sum{} {!r}'.format(
+                        name, _format_labels(labels), histogram.sum
+                    ))
+                    lines.append('{}_count{} {}'.format(
+                        name, _format_labels(labels), histogram.count
+                    ))
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                header(name, kind, help)
+                for labels, value in samples:
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(sorted(labels.items())),
+                        _format_value(value)
+                    ))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+_local = threading.local()
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.start
+        if ENABLED:
+            REGISTRY.observe('twittersa_stage_seconds', elapsed,
+                             stage=self.name)
+        profile = getattr(_local, 'profile', None)
+        if profile is not None:
+            profile[self.name] = profile.get(self.name, 0.0) + elapsed
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """A context manager timing the stage of a request called name."""
+    if not ENABLED and getattr(_local, 'profile', None) is None:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed_iter(name, iterable):
+    """
+    Yield the items of iterable, timing each wait for the next item (such
+    as a page being fetched in the background) as the stage called name.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def inc(name, amount=1, **labels):
+    if ENABLED:
+        REGISTRY.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    if ENABLED:
+        REGISTRY.observe(name, value, **labels)
+
+
+def start_profile():
+    """Start recording the stages timed in this thread."""
+    _local.profile = OrderedDict()
+
+
+def stop_profile():
+    """
+    Stop recording stages in this thread and return the seconds spent in
+    each stage since start_profile(), in the order they first finished (None
+    if no profile was started).
+    """
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    return profile
+
+
+def server_timing(profile, total=None):
+    """A Server-Timing header value for profile (and the total seconds)."""
+    timings = profile.items()
+    if total is not None:
+        timings.append(('total', total))
+    return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000)
+                     for name, seconds in timings)
+
+
+def render():
+    return REGISTRY.render()
+
+
+def add_collector(collector):
+    REGISTRY.add_collector(collector)
@@ -0,0 +1,220 @@
+"""
+Out-of-core training on the full Sentiment140 corpus.
+
+Rather than loading a lib/training.N.pickle list into memory, the source CSV
+is read in chunks, hashed into a fixed number of features (so memory doesn't
+grow with the vocabulary), and fed to BernoulliNB.partial_fit. Since Naive
+Bayes just sums counts, the result is the same model fit() would give on the
+whole file.
+
+Run from the repository home directory, e.g.
+
+    python -m sentiment.streaming \
+        corpora/training.1600000.processed.noemoticon.csv \
+        -o lib/model.1600000
+
+and serve the result by pointing TWITTERSA_MODEL at it.
+"""
+
+import csv
+import sys
+import time
+from itertools import islice
+
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.naive_bayes import BernoulliNB, MultinomialNB
+
+from sentiment.classifiers import (
+    TwitterClassifier, TweetAnalyzer, PROD_TOKENIZER, model_checksum
+)
+
+# Sentiment140 polarity column: 4 is positive, 2 is neutral, 0 is negative
+SENTIMENT140_LABELS = {'0': 'negative', '2': 'neutral', '4': 'positive'}
+CLASSES = ['negative', 'positive']
+
+
+def iter_csv_chunks(filename, chunksize=10000):
+    """
+    Yield lists of up to chunksize (text, sentiment) pairs from a
+    Sentiment140-format CSV, without reading the whole file.
+    """
+    with open(filename, 'r') as fin:
+        reader = csv.reader(fin, quotechar='"')
+        while True:
+            rows = list(islice(reader, chunksize))
+            if not rows:
+                break
+            yield [(row[-1], SENTIMENT140_LABELS[row[0]]) for row in rows]
+
+
+def hashing_processor(n_features=2 ** 20, ngram_range=(1, 2),
+                      tokenizer=PROD_TOKENIZER):
+    """
+    A stateless processor with the production preprocessing. Binary,
+    non-negative features suit BernoulliNB and MultinomialNB alike.
+    """
+    return HashingVectorizer(
+        analyzer=TweetAnalyzer(
+            stop_words='twitter',
+            ngram_range=ngram_range,
+            tokenizer=tokenizer,
+        ),
+        n_features=n_features,
+        binary=True,
+        norm=None,
+        non_negative=True,
+    )
+
+
+def train_streaming(filename, processor=None, clf=None, chunksize=10000,
+                    holdout_every=100, max_holdout=20000, eval_every=10,
+                    report=None):
+    """
+    Train a TwitterClassifier on filename one chunk at a time.
+
+    Every holdout_every'th row (up to max_holdout rows) is held out rather
+    than trained on, and vectorized once as it is split off (processor must
+    be stateless, like HashingVectorizer). Every eval_every chunks, and at
+    the end, report (if given) is called with a dict of progress: rows
+    trained on, rows/sec and held-out accuracy. Note that Sentiment140 is
+    sorted by polarity, so accuracy mid-stream reflects a model that has
+    only seen one class; shuffle the file first for a meaningful curve.
+
+    Returns the classifier and the list of progress dicts.
+    """
+    if processor is None:
+        processor = hashing_processor()
+    if clf is None:
+        clf = BernoulliNB()
+    holdout_X = []  # Sparse matrices, one per chunk (stacked when scored)
+    holdout_y = []
+    history = []
+    trained = 0
+    row = 0
+    start = time.time()
+
+    def progress(chunks):
+        seconds = time.time() - start
+        stats = {
+            'chunks': chunks,
+            'trained': trained,
+            'held_out': len(holdout_y),
+            'seconds': seconds,
+            'rows_per_sec': trained / seconds if seconds else 0.0,
+        }
+        if trained and len(set(holdout_y)) == len(CLASSES):
+            if len(holdout_X) > 1:
+                holdout_X[:] = [sp.vstack(holdout_X, format='csr')]
+            stats['accuracy'] = clf.score(holdout_X[0], holdout_y)
+        history.append(stats)
+        if report is not None:
+            report(stats)
+
+    chunks = 0
+    for chunk in iter_csv_chunks(filename, chunksize):
+        texts = []
+        labels = []
+        held_texts = []
+        for text, label in chunk:
+            row += 1
+            if label not in CLASSES:
+                continue
+            if (row % holdout_every == 0 and
+                    len(holdout_y) + len(held_texts) < max_holdout):
+                held_texts.append(text)
+                holdout_y.append(label)
+                continue
+            texts.append(text)
+            labels.append(label)
+        if held_texts:
+            holdout_X.append(processor.transform(held_texts))
+        if texts:
+            clf.partial_fit(processor.transform(texts), labels,
+                            classes=CLASSES)
+            trained += len(texts)
+        chunks += 1
+        if eval_every and chunks % eval_every == 0:
+            progress(chunks)
+    if not history or history[-1]['chunks'] != chunks:
+        progress(chunks)
+
+    classifier = TwitterClassifier(clf=clf)
+    classifier.processor = processor
+    return classifier, history
+
+
+def print_progress(stats):
+    sys.stderr.write(
+        "{trained} rows in {seconds:.0f}s ({rows_per_sec:.0f}/s)".format(
+            **stats
+        )
+    )
+    if 'accuracy' in stats:
+        sys.stderr.write(", held-out accuracy {:.4f} on {} rows".format(
+            stats['accuracy'], stats['held_out']
+        ))
+    sys.stderr.write('\n')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('corpus', help="Sentiment140-format .csv file")
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help="write the model artifact here"
+    )
+    parser.add_argument(
+        '-c', '--classifier', default='bernoulli',
+        choices=['bernoulli', 'multinomial'],
+        help="specifiy classifier (bernoulli or multinomial)"
+    )
+    parser.add_argument(
+        '--chunksize', type=int, default=10000,
+        help="rows to read and fit at a time"
+    )
+    parser.add_argument(
+        '--features', type=int, default=20,
+        help="hash into 2 ** FEATURES features"
+    )
+    parser.add_argument(
+        '-n', '--ngram', type=int, default=2,
+        help="use ngrams in addition to unigrams"
+    )
+    parser.add_argument(
+        '--holdout-every', type=int, default=100,
+        help="hold out every Nth row for evaluation"
+    )
+    parser.add_argument(
+        '--max-holdout', type=int, default=20000,
+        help="maximum number of held-out rows"
+    )
+    parser.add_argument(
+        '--eval-every', type=int, default=10,
+        help="report progress every N chunks"
+    )
+    args = parser.parse_args()
+
+    processor = hashing_processor(
+        n_features=2 ** args.features, ngram_range=(1, args.ngram)
+    )
+    if args.classifier == 'bernoulli':
+        clf = BernoulliNB()
+    else:
+        clf = MultinomialNB()
+    classifier, history = train_streaming(
+        args.corpus,
+        processor=processor,
+        clf=clf,
+        chunksize=args.chunksize,
+        holdout_every=args.holdout_every,
+        max_holdout=args.max_holdout,
+        eval_every=args.eval_every,
+        report=print_progress,
+    )
+    if args.output is not None:
+        checksum = model_checksum(args.corpus, classifier.processor,
+                                  classifier.clf)
+        classifier.save(args.output, checksum=checksum)
+        print "wrote {} ({})".format(args.output, checksum)
@@ -1,7 +1,7 @@
 echo "Bernoulli Data Set Improvement"
-python sentiment/classifiers.py --all -N 5 -c bernoulli | sort -n > sentiment/results/bernoulli_improvement.csv
+python sentiment/classifiers.py -l 25000 -N 5 -c bernoulli > sentiment/results/bernoulli_improvement.csv
 echo "Multinomial Data Set Improvement"
-python sentiment/classifiers.py --all -N 5 -c multinomial | sort -n > sentiment/results/multinomial_improvement.csv
+python sentiment/classifiers.py -l 25000 -N 5 -c multinomial > sentiment/results/multinomial_improvement.csv
 echo "Bernoulli Bag of Words - Base"
 python sentiment/classifiers.py 25000 -N 5 -c bernoulli
 echo "Multinomial Bag of Words - Base"
@@ -26,4 +26,5 @@ python sentiment/classifiers.py 25000 -n 2 --bow-count 10000 --ngram-count 200 -
 echo "Multi BoW 10000 - Bigram 200 - TFIDF"
 python sentiment/classifiers.py 25000 -n 2 --bow-count 10000 --ngram-count 200 -N 5 --tfidf -c multinomial
 # TFIDF?
-# TODO: Grid Search
+echo "Grid Search"
+python sentiment/classifiers.py 25000 -N 5 -g classifier=bernoulli,multinomial -g ngram=1,2 -g weighting=none,tf,tfidf -g kbest=none,1000,10000
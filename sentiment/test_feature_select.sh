@@ -1,8 +1,4 @@
-python sentiment/classifiers.py -N 5 -n 2 -k 10 25000 --tfidf -c multinomial
-python sentiment/classifiers.py -N 5 -n 2 -k 100 25000 --tfidf -c multinomial
-python sentiment/classifiers.py -N 5 -n 2 -k 1000 25000 --tfidf -c multinomial
-python sentiment/classifiers.py -N 5 -n 2 -k 10000 25000 --tfidf -c multinomial
-python sentiment/classifiers.py -N 5 -n 2 -k 20000 25000 --tfidf -c multinomial
+python sentiment/classifiers.py -N 5 25000 -c multinomial --tfidf -n 2 -g kbest=10,100,1000,10000,20000
 30000
 # 10
 # 25000,0.599893333333,500
@@ -0,0 +1,179 @@
+"""
+Tokenizer backends for preprocess.
+
+nltk.word_tokenize runs the Punkt sentence splitter and the Treebank
+tokenizer over every tweet, which is a lot of machinery for 140 characters.
+tweet_tokenize is a single precompiled regex that knows about mentions,
+hashtags, URLs and emoticons, and splits contractions the way the Treebank
+tokenizer does ("don't" -> "do", "n't") so slang and stopwords still match.
+
+Run this file to compare the two backends on the corpora:
+
+    python sentiment/tokenizers.py corpora/training.1000.csv
+"""
+
+import re
+
+_nltk = None
+
+
+def get_nltk():
+    """Import nltk (which takes a while) on first use and return it."""
+    global _nltk
+    if _nltk is None:
+        import nltk
+        # Look for corpora in this directory for heroku
+        nltk.data.path.append('./nltk_data/')
+        _nltk = nltk
+    return _nltk
+
+EMOTICON = r"""
+    (?:
+      [<>]?[:;=8][\-o\*']?[\)\]\(\[dDpP/:\}\{@\|\\]         # :) ;-( =p
+      |
+      (?<!\w)[\)\]\(\[/:\}\{@\|\\][\-o\*']?[:;=](?!\w)[<>]?  # (: )-; alone
+      |
+      </?3                                                 # <3 </3
+    )
+"""
+
+TWEET_TOKEN = re.compile(r"""
+    (?:https?://|www\.)\S+               # URLs
+    |
+    \d+(?:[.,:/]\d+)*                    # numbers, times, fractions, dates
+    |
+    {emoticon}
+    |
+    [@\#]\w+                             # mentions and hashtags
+    |
+    &\w+;                                # HTML entities, e.g. &amp;
+    |
+    \w+(?=n't\b)                         # "do" of "don't"...
+    |
+    n't\b                                # ...and its "n't"
+    |
+    '(?:s|m|d|ll|re|ve)\b                # other Treebank clitics
+    |
+    \w+(?:-\w+)*                         # words, possibly hyphenated
+    |
+    \.\.+                                # ellipses
+    |
+    [^\w\s]                              # any other symbol on its own
+""".format(emoticon=EMOTICON), re.VERBOSE | re.UNICODE | re.IGNORECASE)
+
+
+def tweet_tokenize(text):
+    """Tokenize text with the precompiled TWEET_TOKEN regex."""
+    return TWEET_TOKEN.findall(text)
+
+
+def nltk_tokenize(text):
+    """nltk.word_tokenize, importing nltk on first use."""
+    return get_nltk().word_tokenize(text)
+
+
+TOKENIZERS = {
+    'nltk': nltk_tokenize,
+    'regex': tweet_tokenize,
+}
+
+
+def get_tokenizer(name):
+    """Return the tokenizer function for the backend called name."""
+    try:
+        return TOKENIZERS[name]
+    except KeyError:
+        raise ValueError('unknown tokenizer {} (expected one of {})'.format(
+            name, ', '.join(sorted(TOKENIZERS))
+        ))
+
+
+def verify(texts, reference='nltk', candidate='regex'):
+    """
+    Tokenize texts with both backends, returning a dict with the token-level
+    agreement between them, the tokens they most often disagree on, and the
+    throughput of each.
+    """
+    from collections import Counter
+    import time
+
+    results = {}
+    tokenized = {}
+    for name in (reference, candidate):
+        tokenize = get_tokenizer(name)
+        start = time.time()
+        tokenized[name] = [tokenize(text) for text in texts]
+        elapsed = time.time() - start
+        n_tokens = sum(len(tokens) for tokens in tokenized[name])
+        results[name] = {
+            'tokens': n_tokens,
+            'seconds': elapsed,
+            'tweets_per_sec': len(texts) / elapsed if elapsed else 0.0,
+            'tokens_per_sec': n_tokens / elapsed if elapsed else 0.0,
+        }
+
+    common = 0
+    exact = 0
+    only_reference = Counter()
+    only_candidate = Counter()
+    for ref_tokens, cand_tokens in zip(tokenized[reference],
+                                       tokenized[candidate]):
+        if ref_tokens == cand_tokens:
+            exact += 1
+        ref_counts = Counter(ref_tokens)
+        cand_counts = Counter(cand_tokens)
+        common += sum((ref_counts & cand_counts).values())
+        only_reference.update(ref_counts - cand_counts)
+        only_candidate.update(cand_counts - ref_counts)
+
+    total = results[reference]['tokens'] + results[candidate]['tokens']
+    results['agreement'] = 2.0 * common / total if total else 1.0
+    results['exact_tweets'] = float(exact) / len(texts) if texts else 1.0
+    results['only_' + reference] = only_reference
+    results['only_' + candidate] = only_candidate
+    results['speedup'] = (results[reference]['seconds'] /
+                          results[candidate]['seconds']
+                          if results[candidate]['seconds'] else 0.0)
+    return results
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import csv
+    import glob
+    parser = ArgumentParser()
+    parser.add_argument(
+        'corpus', nargs='*',
+        help="corpus .csv files (defaults to every file in corpora/)"
+    )
+    parser.add_argument(
+        '-c', '--candidate', default='regex', choices=sorted(TOKENIZERS),
+        help="tokenizer backend to check against nltk"
+    )
+    parser.add_argument(
+        '-n', '--top', type=int, default=15,
+        help="number of disagreeing tokens to show"
+    )
+    args = parser.parse_args()
+
+    filenames = args.corpus or sorted(glob.glob('corpora/*.csv'))
+    texts = []
+    for filename in filenames:
+        with open(filename, 'r') as fin:
+            for row in csv.reader(fin, quotechar='"'):
+                texts.append(row[-1].decode('utf-8', 'replace').lower())
+
+    results = verify(texts, candidate=args.candidate)
+    print "{} tweets from {} file(s)".format(len(texts), len(filenames))
+    for name in ('nltk', args.candidate):
+        print "{}: {:.0f} tweets/sec, {:.0f} tokens/sec".format(
+            name, results[name]['tweets_per_sec'],
+            results[name]['tokens_per_sec']
+        )
+    print "speedup: {:.1f}x".format(results['speedup'])
+    print "token agreement: {:.2%}".format(results['agreement'])
+    print "identical tweets: {:.2%}".format(results['exact_tweets'])
+    for name in ('nltk', args.candidate):
+        print "only from {}:".format(name)
+        for token, count in results['only_' + name].most_common(args.top):
+            print "\t{}\t{}".format(count, token.encode('utf-8'))
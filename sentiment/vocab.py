@@ -0,0 +1,181 @@
+"""
+A compact, read-only string -> int mapping for fitted vectorizer
+vocabularies.
+
+A bigram vocabulary with min_df=1 is a dict of a few hundred thousand unicode
+objects. Every lookup touches their refcounts, so after a fork each gunicorn
+worker gradually copies all of those pages. StringTable keeps the same
+mapping in four flat arrays instead:
+
+ - blob: uint8, the UTF-8 encoded keys back to back
+ - offsets: int64, len + 1 offsets, so key i is
+   blob[offsets[i]:offsets[i + 1]]
+ - hashes: int64, hash() of each key, sorted
+ - values: int64, each key's value
+
+Lookups binary search the hashes and compare the stored key, and
+lookup_many does the search for a whole batch of keys at once. The arrays are
+saved as .npy files and memory-mapped on load, so every process on the
+machine shares one copy.
+"""
+
+import os
+from collections import Mapping
+from itertools import izip
+
+import numpy as np
+
+# Checked on load: Python 2 only randomizes hash() with -R or PYTHONHASHSEED,
+# but if it does the saved hashes are recomputed
+_HASH_CHECK = u'twittersa'
+_ARRAYS = ('blob', 'offsets', 'hashes', 'values')
+
+
+class StringTable(Mapping):
+    """A read-only mapping from unicode strings to ints (see module doc)."""
+    def __init__(self, blob, offsets, hashes, values):
+        self._blob = blob
+        self._offsets = offsets
+        self._hashes = hashes
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, mapping):
+        """Build a table of the items of mapping (unicode keys, int values)."""
+        keys = list(mapping)
+        hashes = np.fromiter((hash(key) for key in keys), dtype=np.int64,
+                             count=len(keys))
+        order = np.argsort(hashes, kind='mergesort')
+        keys = [keys[i].encode('utf-8') for i in order]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(key) for key in keys], out=offsets[1:])
+        values = np.fromiter((mapping[key.decode('utf-8')] for key in keys),
+                             dtype=np.int64, count=len(keys))
+        blob = np.frombuffer(b''.join(keys), dtype=np.uint8)
+        return cls(blob, offsets, hashes[order], values)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a table saved in the directory path."""
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, '{}.npy'.format(name)),
+                          mmap_mode=mmap_mode) for name in _ARRAYS]
+        table = cls(*arrays)
+        check = np.load(os.path.join(path, 'hash_check.npy'))
+        if int(check) != hash(_HASH_CHECK):
+            table = cls.from_dict(dict(table.iteritems()))
+        return table
+
+    def save(self, path):
+        """Save the table's arrays to the directory path."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    getattr(self, '_' + name))
+        np.save(os.path.join(path, 'hash_check.npy'),
+                np.int64(hash(_HASH_CHECK)))
+
+    def _key(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tostring()
+
+    def _find(self, key, key_hash):
+        """The position of key, or -1."""
+        hashes = self._hashes
+        i = hashes.searchsorted(key_hash)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        while i < len(hashes) and hashes[i] == key_hash:
+            if self._key(i) == key:
+                return i
+            i += 1
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key, hash(key))
+        if i < 0:
+            raise KeyError(key)
+        return int(self._values[i])
+
+    def get(self, key, default=None):
+        i = self._find(key, hash(key))
+        if i < 0:
+            return default
+        return int(self._values[i])
+
+    def __contains__(self, key):
+        return self._find(key, hash(key)) >= 0
+
+    def lookup_many(self, keys, default=-1):
+        """
+        Return an int64 array of the value of each of keys (a sequence of
+        unicode strings), or default for those not in the table.
+        """
+        n = len(keys)
+        hashes = self._hashes
+        key_hashes = np.fromiter((hash(key) for key in keys), dtype=np.int64,
+                                 count=n)
+        positions = hashes.searchsorted(key_hashes)
+        found = positions < len(hashes)
+        found[found] = hashes[positions[found]] == key_hashes[found]
+        result = np.empty(n, dtype=np.int64)
+        result.fill(default)
+        candidates = np.flatnonzero(found)
+        if not len(candidates):
+            return result
+
+        # Compare each candidate with the stored key of the same hash: first
+        # the lengths, then the bytes of all equal-length pairs at once
+        encoded = [keys[j].encode('utf-8') if isinstance(keys[j], unicode)
+                   else keys[j] for j in candidates]
+        lengths = np.fromiter((len(key) for key in encoded), dtype=np.int64,
+                              count=len(encoded))
+        positions = positions[candidates]
+        starts = self._offsets[positions]
+        same = self._offsets[positions + 1] - starts == lengths
+        compare = np.flatnonzero(same & (lengths > 0))
+        if len(compare):
+            query = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            query_starts = np.cumsum(lengths) - lengths
+            compare_lengths = lengths[compare]
+            firsts = np.cumsum(compare_lengths) - compare_lengths
+            within = (np.arange(compare_lengths.sum()) -
+                      np.repeat(firsts, compare_lengths))
+            differ = (
+                query[np.repeat(query_starts[compare], compare_lengths) +
+                      within] !=
+                self._blob[np.repeat(starts[compare], compare_lengths) +
+                           within]
+            )
+            same[compare[np.logical_or.reduceat(differ, firsts)]] = False
+        result[candidates[same]] = self._values[positions[same]]
+
+        # A hash collision, with this or another key
+        for j in candidates[~same]:
+            i = self._find(keys[j], key_hashes[j])
+            if i >= 0:
+                result[j] = self._values[i]
+        return result
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._key(i).decode('utf-8')
+
+    def iteritems(self):
+        return izip(self, (int(value) for value in self._values))
+
+    def items(self):
+        return list(self.iteritems())
+
+    @property
+    def nbytes(self):
+        """The total size of the table's arrays."""
+        return sum(getattr(self, '_' + name).nbytes for name in _ARRAYS)
+
+    def __repr__(self):
+        return '<StringTable of {} keys, {} bytes>'.format(
+            len(self), self.nbytes
+        )
@@ -5,7 +5,25 @@ Jesse Mu
 """
 
 import twittersa
+import timelines
+import batching
+import sentiment.classifiers as sa
+from sentiment import metrics
+from sentiment.cache import LRUCache, SingleFlight, FlightTimeout
+from sentiment.corpus import Corpus, load_corpus
+from sentiment.tokenizers import tweet_tokenize
+from sentiment.vocab import StringTable
 import unittest
+import nltk
+import tempfile
+import shutil
+import os
+import datetime
+import random
+import time
+import json
+import threading
+import numpy as np
 import pickle  # Standard pickle for unicode support
 
 
@@ -23,6 +41,8 @@ class TwittersaTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+    @unittest.skipIf(twittersa.TIMELINE_SOURCE == 'fake',
+                     'using the offline timeline source')
     def test_twitter_api(self):
         """Test to make sure the API is getting tweets"""
         tweets = twittersa.api.search(q='hello')
@@ -35,6 +55,58 @@ class TwittersaTestCase(unittest.TestCase):
         rv = self.app.get('/search?nonsense=nonsense')
         assert 'Invalid search query' in rv.data
 
+    def test_user_search(self):
+        """Test a user search renders the classified timeline"""
+        api = twittersa.api
+        twittersa.api = timelines.StubAPI({'someone': make_statuses(1, 300)})
+        twittersa.timeline_cache.clear()
+        try:
+            rv = self.app.get('/search?q=@someone')
+        finally:
+            twittersa.api = api
+            twittersa.timeline_cache.clear()
+        assert rv.status_code == 200
+        assert '@someone' in rv.data
+        assert rv.data.count('<tr class=') == 300
+
+    def test_api_classify(self):
+        """Test that the JSON API classifies a list of texts"""
+        rv = self.app.post('/api/classify', content_type='application/json',
+                           data=json.dumps({'texts': ['i love this', 'meh']}))
+        assert rv.status_code == 200
+        results = json.loads(rv.data)['results']
+        assert len(results) == 2
+        for result in results:
+            assert result['label'] in result['probs']
+            assert abs(sum(result['probs'].values()) - 1) < 1e-6
+        rv = self.app.post('/api/classify', content_type='application/json',
+                           data=json.dumps({'texts': 'i love this'}))
+        assert rv.status_code == 400
+        rv = self.app.get('/api/classify/stats')
+        assert json.loads(rv.data)['requests'] >= 1
+
+    def test_api_classify_timeout(self):
+        """Test that the JSON API fails fast if classifying stalls"""
+        batcher = twittersa.classify_batcher
+        release = threading.Event()
+        twittersa.classify_batcher = batching.MicroBatcher(
+            lambda texts: release.wait(5), max_wait=0, timeout=0.01
+        )
+        try:
+            rv = self.app.post('/api/classify',
+                               content_type='application/json',
+                               data=json.dumps({'texts': ['i love this']}))
+        finally:
+            release.set()
+            twittersa.classify_batcher = batcher
+        assert rv.status_code == 503
+        assert 'error' in json.loads(rv.data)
+
+    def test_serial_vectorization(self):
+        """Test that serving never forks a vectorization pool"""
+        params = twittersa.classifier.processor.get_params()
+        assert params.get('n_jobs', 1) == 1
+
     def test_invalid_user_id(self):
         """Test for invalid user ids"""
         rv = self.app.get('/user?username=')
@@ -49,5 +121,912 @@ class TwittersaTestCase(unittest.TestCase):
                 data = pickle.load(f)
                 assert data
 
+class Status(object):
+    """Just enough of a tweepy Status for classifying and binning."""
+    def __init__(self, id, text, created_at):
+        self.id = id
+        self.text = text
+        self.created_at = created_at
+
+
+def make_statuses(start_id, n):
+    # Tweepy gives us unicode
+    texts = [t.decode('utf-8', 'replace')
+             for t, _ in sa.load_pickle('lib/training.500.pickle')]
+    start = datetime.datetime(2014, 1, 1)
+    return [Status(i, texts[i % len(texts)],
+                   start + datetime.timedelta(hours=12 * i))
+            for i in range(start_id, start_id + n)]
+
+
+def run_concurrently(function, n=8):
+    # Call function from n threads at once; errors are returned as results
+    results = [None] * n
+
+    def call(i):
+        try:
+            results[i] = function()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        twittersa.app.config['TESTING'] = True
+        self.app = twittersa.app.test_client()
+        self.api = twittersa.api
+        twittersa.api = timelines.StubAPI({'someone': make_statuses(1, 300)})
+        twittersa.timeline_cache.clear()
+
+    def tearDown(self):
+        twittersa.api = self.api
+        twittersa.timeline_cache.clear()
+
+    def test_registry(self):
+        """Test the Prometheus rendering of counters and histograms"""
+        registry = metrics.Registry()
+        registry.inc('requests_total', status=200)
+        registry.inc('requests_total', 2, status=200)
+        for value in (0.0005, 0.003, 20):
+            registry.observe('latency_seconds', value, stage='a"b')
+        lines = registry.render().splitlines()
+        assert '# TYPE requests_total counter' in lines
+        assert 'requests_total{status="200"} 3' in lines
+        assert 'latency_seconds_bucket{stage="a\\"b",le="0.001"} 1' in lines
+        assert 'latency_seconds_bucket{stage="a\\"b",le="0.005"} 2' in lines
+        assert 'latency_seconds_bucket{stage="a\\"b",le="+Inf"} 3' in lines
+        assert 'latency_seconds_count{stage="a\\"b"} 3' in lines
+
+    def test_search_profile(self):
+        """Test the profiling header and the stages served from /metrics"""
+        rv = self.app.get('/search?q=@someone',
+                          headers={twittersa.PROFILE_HEADER: '1'})
+        timing = rv.headers['Server-Timing']
+        for name in ('fetch', 'vectorize', 'predict', 'classify',
+                     'transform_timeline', 'render', 'total'):
+            assert '{};dur='.format(name) in timing
+        rv = self.app.get('/search?q=@someone')
+        assert 'Server-Timing' not in rv.headers
+        rv = self.app.get('/metrics')
+        assert rv.status_code == 200
+        assert 'twittersa_stage_seconds_count{stage="render"}' in rv.data
+        assert 'twittersa_cache_hits_total{cache="timeline"}' in rv.data
+        assert 'twittersa_batch_queue_depth 0' in rv.data
+
+
+class MicroBatcherTestCase(unittest.TestCase):
+    def test_concurrent_requests_batched(self):
+        """Test that concurrent submits share batches and get their rows"""
+        calls = []
+
+        def double(items):
+            calls.append(len(items))
+            return [2 * item for item in items]
+
+        batcher = batching.MicroBatcher(double, max_batch=1000,
+                                        max_wait=0.2)
+        results = {}
+
+        def submit(i):
+            results[i] = batcher.submit([i, i + 100])
+
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {i: [2 * i, 2 * i + 200] for i in range(10)}
+        assert sum(calls) == 20 and len(calls) < 10
+        stats = batcher.stats()
+        assert stats['requests'] == 10 and stats['items'] == 20
+        assert stats['batches'] == len(calls)
+        assert stats['queue_depth'] == 0
+
+    def test_errors_propagate(self):
+        """Test that an error in a batch is raised in the caller"""
+        def fail(items):
+            raise ValueError('bad batch')
+
+        batcher = batching.MicroBatcher(fail, max_wait=0)
+        self.assertRaises(ValueError, batcher.submit, ['x'])
+        assert batcher.stats()['queue_depth'] == 0
+
+    def test_scheduler_errors(self):
+        """Test that a failure outside function doesn't strand callers"""
+        batcher = batching.MicroBatcher(lambda items: items, max_wait=0,
+                                        timeout=5)
+        collect = batcher._collect
+
+        def fail_once(queue, batch):
+            batcher._collect = collect
+            batch.append(queue.get())
+            raise RuntimeError('scheduler bug')
+
+        batcher._collect = fail_once
+        self.assertRaises(RuntimeError, batcher.submit, ['x'])
+        assert batcher.submit(['y']) == ['y']
+
+    def test_timeout(self):
+        """Test that a caller gives up on a batch that takes too long"""
+        release = threading.Event()
+        batcher = batching.MicroBatcher(lambda items: release.wait(5),
+                                        max_wait=0, timeout=0.01)
+        try:
+            self.assertRaises(batching.BatchTimeout, batcher.submit, ['x'])
+        finally:
+            release.set()
+        assert batcher.stats()['timeouts'] == 1
+
+
+class TimelineCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.api = twittersa.api
+        self.ttl = twittersa.TIMELINE_CACHE_TTL
+        self.rate_limiter = twittersa.rate_limiter
+        twittersa.rate_limiter = timelines.RateLimiter()
+        twittersa.timeline_cache.clear()
+
+    def tearDown(self):
+        twittersa.api = self.api
+        twittersa.TIMELINE_CACHE_TTL = self.ttl
+        twittersa.rate_limiter = self.rate_limiter
+        twittersa.timeline_cache.clear()
+
+    def test_cached_and_incremental(self):
+        """Test repeat lookups are cached and refreshes use since_id"""
+        stub = twittersa.api = timelines.StubAPI(
+            {'someone': make_statuses(1, 250)}
+        )
+        tweetsents = twittersa.classified_timeline('@Someone')
+        assert [t.tweet.id for t in tweetsents] == range(1, 251)
+        n_calls = len(stub.calls)
+
+        # Within the TTL (and case-insensitively), no API calls
+        assert len(twittersa.classified_timeline('@someone')) == 250
+        assert len(stub.calls) == n_calls
+
+        twittersa.TIMELINE_CACHE_TTL = 0
+        stub.add_timeline('someone', make_statuses(1, 255))
+        tweetsents = twittersa.classified_timeline('@someone')
+        assert stub.calls[n_calls]['since_id'] == 250
+        assert [t.tweet.id for t in tweetsents] == range(1, 256)
+
+    def test_stale_when_rate_limited(self):
+        """Test the cached timeline is served if a refresh is rate limited"""
+        twittersa.api = timelines.StubAPI({'someone': make_statuses(1, 250)})
+        assert not twittersa.load_timeline('@someone').stale
+        twittersa.TIMELINE_CACHE_TTL = 0
+        twittersa.api = timelines.StubAPI(
+            {'someone': make_statuses(1, 255)}, rate_limit=0
+        )
+        timeline = twittersa.load_timeline('@someone')
+        assert timeline.stale
+        assert [t.tweet.id for t in timeline.tweetsents] == range(1, 251)
+        rv = twittersa.app.test_client().get('/search?q=@someone')
+        assert rv.status_code == 200 and "rate limit has been" in rv.data
+        # With nothing cached there's nothing to fall back on
+        self.assertRaises(timelines.RateLimitExceeded,
+                          twittersa.load_timeline, '@nobody')
+
+    def test_concurrent_requests_coalesced(self):
+        """Test that concurrent lookups of a user share one fetch"""
+        stub = twittersa.api = timelines.StubAPI(
+            {'someone': make_statuses(1, 250)}
+        )
+        twittersa.classified_timeline('@someone')
+        n_calls = len(stub.calls)
+        twittersa.timeline_cache.clear()
+        stub.calls = []
+        stub.latency = 0.1
+        shared = twittersa.timeline_flights.shared
+
+        results = run_concurrently(
+            lambda: twittersa.classified_timeline('@Someone')
+        )
+        assert len(stub.calls) == n_calls
+        assert all(len(result) == 250 for result in results)
+        assert twittersa.timeline_flights.shared - shared == 7
+
+
+class TransformTimelineTestCase(unittest.TestCase):
+    def tweetsent(self, created_at, prob_scaled):
+        label = 'positive' if prob_scaled >= 0 else 'negative'
+        sentiment = sa.Sentiment(label, {
+            'positive': 0.5 + prob_scaled, 'negative': 0.5 - prob_scaled
+        })
+        return sa.TweetSentiment(Status(0, '', created_at), sentiment)
+
+    def test_weekly_bins(self):
+        """Test tweets land in the week they were posted, gaps and all"""
+        d = datetime.datetime
+        tweetsents = [
+            self.tweetsent(d(2014, 3, 20, 12), 0.25),
+            self.tweetsent(d(2014, 3, 1, 0, 0, 1), 0.5),
+            self.tweetsent(d(2014, 3, 2), -0.25),
+            self.tweetsent(d(2014, 3, 31, 23), 0.0),
+        ]
+        data, tweet_bins = twittersa.transform_timeline(tweetsents)
+        assert data['labels'] == ['Mar 01', 'Mar 08', 'Mar 15', 'Mar 22',
+                                  'Mar 29']
+        assert data['datasets'][0]['data'] == [0.125, 0.0, 0.25, 0.0, 0.0]
+        assert [len(b) for b in tweet_bins] == [2, 0, 1, 0, 1]
+        assert tweet_bins[0][0] is tweetsents[1]
+
+    def test_monthly_bins(self):
+        """Test long timelines are binned by month"""
+        d = datetime.datetime
+        tweetsents = [self.tweetsent(d(2013, 11, 30), 0.5),
+                      self.tweetsent(d(2014, 4, 1), -0.5)]
+        data, tweet_bins = twittersa.transform_timeline(tweetsents)
+        assert data['labels'] == ['Nov 13', 'Dec 13', 'Jan 14', 'Feb 14',
+                                  'Mar 14', 'Apr 14']
+        assert [len(b) for b in tweet_bins] == [1, 0, 0, 0, 0, 1]
+
+
+class SentimentBatchTestCase(unittest.TestCase):
+    def test_matches_tweetsents(self):
+        """Test columnar results agree with per-tweet TweetSentiments"""
+        statuses = make_statuses(1, 50)
+        batch = twittersa.classifier.predict_many(statuses, columnar=True)
+        tweetsents = twittersa.classifier.predict_many(statuses)
+        assert len(batch) == len(tweetsents) == 50
+        for i, tweetsent in enumerate(tweetsents):
+            assert batch[i].sentiment.label == tweetsent.sentiment.label
+            assert batch[i].tweet is tweetsent.tweet
+            assert batch.labels[i] == tweetsent.sentiment.label
+            self.assertAlmostEqual(batch.prob_scaled[i],
+                                   tweetsent.sentiment.prob_scaled)
+        assert (batch.ids == range(1, 51)).all()
+        tail = batch[45:]
+        assert len(tail) == 5 and tail[0].tweet.id == 46
+        assert sorted(tweetsents[::-1])[0].tweet.id == 1
+
+
+class TimelineFetcherTestCase(unittest.TestCase):
+    def test_pages_until_exhausted(self):
+        """Test pages are fetched newest first with max_id pagination"""
+        stub = timelines.StubAPI({'someone': make_statuses(1, 450)})
+        fetcher = timelines.TimelineFetcher(stub, pages=5)
+        pages = list(fetcher.iter_pages('@someone'))
+        assert [len(page) for page in pages] == [200, 200, 50]
+        assert [s.id for page in pages for s in page] == range(450, 0, -1)
+        assert [call['max_id'] for call in stub.calls] == [None, 250, 50, 0]
+
+    def test_rate_limit_backoff(self):
+        """Test fetching stops short of the rate limit instead of a 429"""
+        stub = timelines.StubAPI({'someone': make_statuses(1, 1000)},
+                                 rate_limit=3)
+        limiter = timelines.RateLimiter()
+        fetcher = timelines.TimelineFetcher(stub, limiter, pages=5)
+        assert len(fetcher.fetch('someone')) == 600
+        assert limiter.remaining(timelines.USER_TIMELINE) == 0
+        assert len(stub.calls) == 3
+        self.assertRaises(timelines.RateLimitExceeded,
+                          fetcher.fetch, 'someone')
+        assert len(stub.calls) == 3
+
+    def test_reserve_and_wait(self):
+        """Test a nearly spent window is waited out if it resets soon"""
+        now = [1000.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        limiter = timelines.RateLimiter(reserve=1, max_wait=5,
+                                        clock=lambda: now[0], sleep=sleep)
+        endpoint = timelines.USER_TIMELINE
+        limiter.update(endpoint, 2, 1003)
+        limiter.acquire(endpoint)
+        assert slept == [] and limiter.remaining(endpoint) == 1
+        limiter.acquire(endpoint)  # Only the reserve is left: wait it out
+        assert slept == [3]
+        limiter.update(endpoint, 1, 1100)
+        self.assertRaises(timelines.RateLimitExceeded, limiter.acquire,
+                          endpoint)
+
+    def test_concurrent_responses(self):
+        """Test each fetch reads the rate limit headers of its own call"""
+        started = threading.Event()
+        finished = threading.Event()
+
+        class RacingAPI(timelines.StubAPI):
+            def user_timeline(self, screen_name=None, **kwargs):
+                self.last_response = timelines.StubResponse(200, {
+                    'x-rate-limit-remaining': str(len(screen_name)),
+                    'x-rate-limit-reset': str(int(time.time()) + 900),
+                })
+                if screen_name == 'slow':
+                    started.set()
+                    finished.wait(5)
+                return []
+
+        limiter = timelines.RateLimiter()
+        fetcher = timelines.TimelineFetcher(RacingAPI(), limiter)
+        slow = threading.Thread(target=fetcher.fetch_page, args=('slow',))
+        slow.start()
+        started.wait(5)
+        fetcher.fetch_page('quickest')
+        finished.set()
+        slow.join()
+        # The slow call finished last, with its own remaining count
+        assert limiter.remaining(timelines.USER_TIMELINE) == 4
+
+    def test_errors_propagate(self):
+        """Test an API error in the fetching thread reaches the caller"""
+        stub = timelines.StubAPI({'someone': make_statuses(1, 10)},
+                                 rate_limit=0)
+        fetcher = timelines.TimelineFetcher(stub, pages=5)
+        self.assertRaises(timelines.RateLimitExceeded,
+                          fetcher.fetch, 'someone')
+
+
+class FakeAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'corpora/training.1000.csv'
+
+    def test_timelines(self):
+        """Test that made-up timelines are stable, real and paged"""
+        stub = timelines.FakeAPI(self.filename, timeline_size=300)
+        first = stub.user_timeline(screen_name='@Someone', count=200)
+        again = timelines.FakeAPI(self.filename, timeline_size=300)
+        again = again.user_timeline(screen_name='someone', count=200)
+        assert [s.id for s in first] == [s.id for s in again]
+        ids = [s.id for s in first]
+        assert ids == sorted(ids, reverse=True) and len(set(ids)) == 200
+        assert isinstance(first[0].created_at, datetime.datetime)
+        other = stub.user_timeline(screen_name='someone_else', count=200)
+        assert [s.id for s in other] != ids
+        statuses = timelines.TimelineFetcher(stub, pages=5).fetch('someone')
+        assert len(statuses) == 300
+
+    def test_rate_limit(self):
+        """Test that the fake API runs out of calls like Twitter"""
+        stub = timelines.FakeAPI(self.filename, rate_limit=1)
+        fetcher = timelines.TimelineFetcher(stub, pages=1)
+        fetcher.fetch('someone')
+        self.assertRaises(timelines.RateLimitExceeded, fetcher.fetch,
+                          'someone')
+
+
+class PredictionCacheTestCase(unittest.TestCase):
+    def test_duplicates_scored_once(self):
+        """Test repeated texts are vectorized once and cached"""
+        classifier = sa.TwitterClassifier(clf=sa.BernoulliNB())
+        classifier.train(data=sa.load_pickle('lib/training.250.pickle'),
+                         processor=sa.BagOfWords(analyzer=sa.TweetAnalyzer()))
+        transformed = []
+        transform = classifier.processor.transform
+
+        def counting_transform(texts):
+            transformed.extend(texts)
+            return transform(texts)
+        classifier.processor.transform = counting_transform
+
+        statuses = make_statuses(0, 3)
+        statuses[1].text = 'RT  ' + statuses[0].text.upper()
+        statuses[2].text = 'RT ' + statuses[0].text
+        tweetsents = classifier.predict_many(statuses)
+        assert len(transformed) == 2
+        assert tweetsents[1].sentiment.probs == tweetsents[2].sentiment.probs
+        uncached = classifier.clf.predict_proba(transform([statuses[0].text]))
+        assert tweetsents[0].sentiment.probs['negative'] == uncached[0][0]
+
+        classifier.predict(statuses[0])
+        assert len(transformed) == 2
+        assert classifier.cache.hits == 1
+
+
+class TweetAnalyzerTestCase(unittest.TestCase):
+    def test_same_features_as_preprocess(self):
+        """Test the analyzer matches preprocess + word_tokenize features"""
+        texts = [t for t, _ in sa.load_pickle('lib/training.1000.pickle')]
+        old = sa.CountVectorizer(
+            preprocessor=sa.preprocess,
+            tokenizer=nltk.word_tokenize,
+            stop_words=sa.get_stopwords(),
+            ngram_range=(1, 2),
+            decode_error='replace',
+        ).build_analyzer()
+        new = sa.TweetAnalyzer(stop_words='twitter', ngram_range=(1, 2))
+        for text in texts:
+            assert old(text) == new(text), text
+
+
+class TweetTokenizeTestCase(unittest.TestCase):
+    def test_tweet_tokens(self):
+        """Test the regex tokenizer keeps tweet entities whole"""
+        tokens = tweet_tokenize(
+            u"@bob I don't think so :) #nope http://t.co/x1 wait..."
+        )
+        assert tokens == [
+            u'@bob', u'I', u'do', u"n't", u'think', u'so', u':)', u'#nope',
+            u'http://t.co/x1', u'wait', u'...'
+        ], tokens
+
+    def test_numbers(self):
+        """Test that times, fractions and dates aren't split as emoticons"""
+        for text, number in [(u'meet at 8:30', u'8:30'),
+                             (u'rated it 8/10', u'8/10'),
+                             (u'born 1/2/2014', u'1/2/2014'),
+                             (u'(80% off)', u'80')]:
+            tokens = tweet_tokenize(text)
+            assert number in tokens, tokens
+            assert tokens == nltk.word_tokenize(text), tokens
+        # Words and numbers next to punctuation aren't reversed emoticons
+        for text in [u'what to do: nothing', u'd: sad', u'(8 tweets)']:
+            assert tweet_tokenize(text) == nltk.word_tokenize(text), text
+        assert tweet_tokenize(u'so sad ): ok (:') == [
+            u'so', u'sad', u'):', u'ok', u'(:'
+        ]
+        assert tweet_tokenize(u'see you at 8:)') == [
+            u'see', u'you', u'at', u'8', u':)'
+        ]
+
+    def test_regex_analyzer(self):
+        """Test preprocessing with the regex backend"""
+        analyzer = sa.TweetAnalyzer(tokenizer='regex')
+        assert analyzer('I loooove it lol :)') == [
+            u'i', u'loov', u'it', 'laughing', 'out', 'loud', u':)'
+        ]
+
+
+class ParallelBagOfWordsTestCase(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        """Test sharded vectorization gives the serial vocabulary/matrix"""
+        texts = [t for t, _ in sa.load_pickle('lib/training.500.pickle')]
+
+        def vectorizer(n_jobs):
+            return sa.BagOfWords(
+                analyzer=sa.TweetAnalyzer(ngram_range=(1, 2)),
+                n_jobs=n_jobs, parallel_threshold=100
+            )
+        serial, parallel = vectorizer(1), vectorizer(2)
+        X = serial.fit_transform(texts)
+        X_parallel = parallel.fit_transform(texts)
+        assert serial.vocabulary_ == parallel.vocabulary_
+        assert (X != X_parallel).nnz == 0
+        assert (serial.transform(texts) != parallel.transform(texts)).nnz == 0
+
+
+class StreamingTestCase(unittest.TestCase):
+    def test_partial_fit_matches_fit(self):
+        """Test chunked training learns the same counts as one fit"""
+        from sentiment import streaming
+        filename = 'corpora/training.500.csv'
+        classifier, history = streaming.train_streaming(
+            filename, chunksize=100, holdout_every=10, eval_every=2
+        )
+        assert history[-1]['trained'] == 450
+        rows = [row for chunk in streaming.iter_csv_chunks(filename)
+                for row in chunk]
+        texts, labels = zip(*[row for i, row in enumerate(rows)
+                              if (i + 1) % 10 != 0])
+        clf = sa.BernoulliNB().fit(
+            classifier.processor.transform(texts), labels
+        )
+        assert (clf.feature_count_ == classifier.clf.feature_count_).all()
+
+    def test_holdout_vectorized_once(self):
+        """Test that evaluation doesn't re-vectorize the held-out rows"""
+        from sentiment import streaming
+        processor = streaming.hashing_processor()
+        transformed = []
+        transform = processor.transform
+
+        def counting_transform(texts):
+            transformed.append(len(texts))
+            return transform(texts)
+
+        processor.transform = counting_transform
+        classifier, history = streaming.train_streaming(
+            'corpora/training.500.csv', processor=processor, chunksize=100,
+            holdout_every=10, eval_every=1
+        )
+        assert sum(transformed) == 500
+        assert history[-1]['held_out'] == 50
+        assert 'accuracy' in history[-1]
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction_and_counters(self):
+        """Test least recently used items are evicted and lookups counted"""
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1  # b is now least recently used
+        cache.put('c', 3)
+        assert 'b' not in cache
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+        assert cache.info() == (2, 1, 2, 2)
+        cache.resize(1)
+        assert len(cache) == 1 and 'c' in cache
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_shared_result(self):
+        """Test that concurrent calls for a key run the function once"""
+        flights = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return ['tweets']
+
+        results = run_concurrently(lambda: flights.do('jack', fetch))
+        assert len(calls) == 1
+        assert all(result == ['tweets'] for result in results)
+        assert flights.calls == 1 and flights.shared == 7
+        assert len(flights) == 0
+        flights.do('jack', fetch)
+        assert len(calls) == 2
+
+    def test_errors_and_timeouts(self):
+        """Test that errors are shared and waiters can time out"""
+        flights = SingleFlight(timeout=0.05)
+
+        def fail():
+            time.sleep(0.2)
+            raise ValueError('no such user')
+
+        results = run_concurrently(lambda: flights.do('jack', fail))
+        assert sum(isinstance(r, ValueError) for r in results) == 1
+        assert sum(isinstance(r, FlightTimeout) for r in results) == 7
+        assert flights.timeouts == 7
+        flights.timeout = None
+        results = run_concurrently(lambda: flights.do('jack', fail))
+        assert all(isinstance(r, ValueError) for r in results)
+
+
+class ModelArtifactTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.model_file = os.path.join(self.tmpdir, 'model')
+        self.training_file = 'lib/training.100.pickle'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_and_load(self):
+        """Test that a saved artifact loads and predicts identically"""
+        checksum = sa.model_checksum(self.training_file)
+        classifier = sa.load_or_train(self.model_file, self.training_file)
+        assert classifier.checksum == checksum
+        loaded = sa.TwitterClassifier.load(self.model_file, checksum=checksum)
+        assert loaded is not None
+        texts = ['i love this', 'worst day ever']
+        X = classifier.processor.transform(texts)
+        X_loaded = loaded.processor.transform(texts)
+        assert (classifier.clf.predict_proba(X) ==
+                loaded.clf.predict_proba(X_loaded)).all()
+
+    def test_trained_independently(self):
+        """Test that training another model leaves a trained one alone"""
+        classifier = sa.load_or_train(self.model_file, self.training_file)
+        n_features = classifier.clf.feature_count_.shape[1]
+        sa.load_or_train(os.path.join(self.tmpdir, 'other'),
+                         'lib/training.250.pickle')
+        assert classifier.clf.feature_count_.shape[1] == n_features
+        assert len(classifier.processor.vocabulary_) == n_features
+
+    def test_stale_artifact(self):
+        """Test that an artifact for other training data isn't loaded"""
+        sa.load_or_train(self.model_file, self.training_file)
+        checksum = sa.model_checksum('lib/training.250.pickle')
+        assert sa.TwitterClassifier.load(
+            self.model_file, checksum=checksum) is None
+        assert sa.TwitterClassifier.load(
+            os.path.join(self.tmpdir, 'missing.pickle')) is None
+
+    def test_shared_arrays(self):
+        """Test that the model's arrays and vocabulary are memory-mapped"""
+        sa.load_or_train(self.model_file, self.training_file)
+        loaded = sa.TwitterClassifier.load(self.model_file)
+        assert isinstance(loaded.clf.feature_log_prob_, np.memmap)
+        vocabulary = loaded.processor.vocabulary_
+        assert isinstance(vocabulary, StringTable)
+        assert isinstance(vocabulary._blob, np.memmap)
+
+    def test_overwrite_while_loading(self):
+        """Test that replacing an artifact never hides it from loaders"""
+        classifier = sa.load_or_train(self.model_file, self.training_file)
+        checksum = classifier.checksum
+        stop = threading.Event()
+
+        def save():
+            while not stop.is_set():
+                classifier.save(self.model_file, checksum=checksum)
+
+        savers = [threading.Thread(target=save) for _ in range(2)]
+        for saver in savers:
+            saver.start()
+        try:
+            for _ in range(50):
+                assert sa.TwitterClassifier.load(
+                    self.model_file, checksum=checksum) is not None
+        finally:
+            stop.set()
+            for saver in savers:
+                saver.join()
+        # Only the current and previous versions are left, and nothing
+        # half-written
+        names = sorted(os.listdir(self.tmpdir))
+        assert names == sorted([
+            'model', 'model.lock', 'model.previous',
+            os.readlink(self.model_file),
+            os.readlink(self.model_file + '.previous')
+        ]), names
+
+    def test_replace_unversioned(self):
+        """Test that an artifact saved as a plain directory is replaced"""
+        classifier = sa.load_or_train(self.model_file, self.training_file)
+        os.rename(os.path.realpath(self.model_file),
+                  os.path.join(self.tmpdir, 'plain'))
+        os.remove(self.model_file)
+        os.rename(os.path.join(self.tmpdir, 'plain'), self.model_file)
+        classifier.save(self.model_file, checksum=classifier.checksum)
+        assert os.path.islink(self.model_file)
+        assert sa.TwitterClassifier.load(self.model_file) is not None
+        classifier.save(self.model_file, checksum=classifier.checksum)
+        assert len(os.listdir(self.tmpdir)) == 5
+
+    def test_export(self):
+        """Test that an exported model scores like the original"""
+        classifier = sa.load_or_train(self.model_file, self.training_file)
+        texts = ['i love this', 'worst day ever', 'meh']
+        probs = classifier.predict_proba(texts)
+        exported = classifier.export(dtype=np.float64)
+        assert np.allclose(exported.predict_proba(texts), probs)
+        pruned = classifier.export(min_count=2, dtype=np.int8)
+        assert (len(pruned.processor.vocabulary_) <
+                len(classifier.processor.vocabulary_))
+        pruned_file = os.path.join(self.tmpdir, 'model.pruned')
+        pruned.save(pruned_file, checksum=pruned.checksum)
+        loaded = sa.TwitterClassifier.load(pruned_file,
+                                           checksum=pruned.checksum)
+        assert loaded.clf.feature_weights_.dtype == np.int8
+        assert np.allclose(loaded.predict_proba(texts),
+                           pruned.predict_proba(texts))
+
+
+class CorpusCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.training_file = 'lib/training.250.pickle'
+        self.analyzer = sa.TweetAnalyzer(ngram_range=(1, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_corpus(self):
+        """Test that the vectorized corpus is cached and reused"""
+        features, counts, labels = sa.vectorize_corpus(
+            self.training_file, self.analyzer, cache_dir=self.tmpdir)
+        assert len(os.listdir(self.tmpdir)) == 1
+        cached_features, cached_counts, cached_labels = sa.vectorize_corpus(
+            self.training_file, self.analyzer, cache_dir=self.tmpdir)
+        assert list(features) == list(cached_features)
+        assert (counts != cached_counts).nnz == 0
+        assert list(labels) == list(cached_labels)
+        sa.vectorize_corpus(self.training_file, sa.TweetAnalyzer(),
+                            cache_dir=self.tmpdir)
+        assert len(os.listdir(self.tmpdir)) == 2
+
+    def test_unreadable_cache(self):
+        """Test that a cache file in another format is rebuilt"""
+        features, counts, labels = sa.vectorize_corpus(
+            self.training_file, self.analyzer, cache_dir=self.tmpdir)
+        cache_file = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        for stale in ({'features': features}, (features, counts, labels)):
+            with open(cache_file, 'wb') as fout:
+                pickle.dump(stale, fout, pickle.HIGHEST_PROTOCOL)
+            cached_features, _, _ = sa.vectorize_corpus(
+                self.training_file, self.analyzer, cache_dir=self.tmpdir)
+            assert list(cached_features) == list(features)
+        with open(cache_file, 'rb') as fin:
+            assert sorted(pickle.load(fin)) == ['counts', 'features',
+                                                'labels']
+
+    def test_split_matches_refit(self):
+        """Test that splitting the cached matrix matches refitting"""
+        features, counts, labels = sa.vectorize_corpus(
+            self.training_file, self.analyzer, cache_dir=None)
+        texts = [text for text, _ in sa.load_pickle(self.training_file)]
+        rows = range(len(texts))
+        train_rows, test_rows = rows[1::2], rows[::2]
+        columns, X_train, X_test = sa.split_counts(
+            counts, train_rows, test_rows)
+        vectorizer = sa.BagOfWords(analyzer=self.analyzer)
+        X_refit = vectorizer.fit_transform([texts[i] for i in train_rows])
+        assert list(features[columns]) == vectorizer.get_feature_names()
+        assert (X_train != X_refit).nnz == 0
+        X_refit = vectorizer.transform([texts[i] for i in test_rows])
+        assert (X_test != X_refit).nnz == 0
+
+
+class GridSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.grid = {
+            'classifier': ['bernoulli', 'multinomial'],
+            'ngram': [1, 2],
+            'kbest': [None, 50],
+            'weighting': [None, 'tfidf'],
+            'threshold': [None],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def search(self, n_jobs):
+        random.seed(0)
+        return list(sa.grid_search(
+            'lib/training.250.pickle', self.grid, num=2, n_jobs=n_jobs,
+            cache_dir=self.tmpdir
+        ))
+
+    def test_parallel_grid(self):
+        """Test that a parallel grid search matches a serial one"""
+        serial = self.search(n_jobs=1)
+        assert len(serial) == 16
+        assert serial[0][0] == {'classifier': 'bernoulli', 'ngram': 1,
+                                'kbest': None, 'weighting': None,
+                                'threshold': None}
+        parallel = self.search(n_jobs=2)
+        assert [r[:3] for r in serial] == [r[:3] for r in parallel]
+
+    def test_invalid_jobs(self):
+        """Test that n_jobs must be positive or -1"""
+        self.assertRaises(ValueError, self.search, n_jobs=-2)
+        self.assertRaises(ValueError, self.search, n_jobs=0)
+        assert sa.check_jobs(-1) == sa.cpu_count()
+
+
+class LearningCurveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_checkpoints(self):
+        """Test that the curve is scored at each size in order"""
+        curve = list(sa.learning_curve(
+            'lib/training.500.pickle', [500, 100, 250],
+            cache_dir=self.tmpdir
+        ))
+        assert [size for size, _, _ in curve] == [100, 250, 500]
+        for _, accuracy, fscore in curve:
+            assert 0 <= accuracy <= 1 and 0 <= fscore <= 1
+        with self.assertRaises(ValueError):
+            list(sa.learning_curve('lib/training.500.pickle', [1000],
+                                   cache_dir=self.tmpdir))
+
+    def test_partial_fit_matches_refit(self):
+        """Test that a restricted incremental model matches a refit one"""
+        _, counts, labels = sa.vectorize_corpus(
+            'lib/training.500.pickle', sa.TweetAnalyzer(), cache_dir=None)
+        X, y = counts[:300], labels[:300]
+        X_test = counts[300:]
+        for name in ('bernoulli', 'multinomial'):
+            clf = sa.build_pipeline(name).named_steps['clf']
+            clf.partial_fit(X[:100], y[:100], classes=['negative', 'positive'])
+            clf.partial_fit(X[100:], y[100:])
+            seen = clf.feature_count_.sum(axis=0).nonzero()[0]
+            refit = sa.build_pipeline(name).named_steps['clf']
+            refit.fit(X[:, seen], y)
+            restricted = sa._restrict_nb(clf, seen)
+            assert abs(restricted.predict_proba(X_test[:, seen]) -
+                       refit.predict_proba(X_test[:, seen])).max() < 1e-9
+
+
+class CorpusTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pairs = sa.load_pickle('lib/training.250.pickle')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """Test that a saved corpus maps back to the same tweets"""
+        path = os.path.join(self.tmpdir, 'training.250')
+        Corpus.from_pairs(self.pairs).save(path)
+        corpus = load_corpus(path)
+        assert len(corpus) == len(self.pairs)
+        assert [list(pair) for pair in corpus] == self.pairs
+        assert corpus[-1] == tuple(self.pairs[-1])
+        assert list(corpus.labels) == [label for _, label in self.pairs]
+        assert list(corpus.texts()) == [text for text, _ in self.pairs]
+
+    def test_views(self):
+        """Test that sampled and shuffled views index the same tweets"""
+        corpus = Corpus.from_pairs(self.pairs)
+        view = corpus.take([5, 3, 9])[1:]
+        assert list(view) == [tuple(self.pairs[3]), tuple(self.pairs[9])]
+        shuffled = corpus.shuffled()
+        assert sorted(shuffled) == sorted(map(tuple, self.pairs))
+        path = os.path.join(self.tmpdir, 'view')
+        view.save(path)
+        assert list(load_corpus(path)) == list(view)
+        shuffled.save(path)
+        assert list(load_corpus(path)) == list(shuffled)
+        corpus.take([]).save(path)
+        assert len(load_corpus(path)) == 0
+
+    def test_train_on_corpus(self):
+        """Test that a classifier trains directly on a corpus"""
+        classifier = sa.TwitterClassifier()
+        classifier.train(data=Corpus.from_pairs(self.pairs),
+                         processor=sa.BagOfWords(analyzer=sa.TweetAnalyzer()))
+        assert classifier.predict_proba(['i love this']).shape == (1, 2)
+
+
+class StringTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.vocabulary = {u'love': 0, u'hate': 1, u'i love': 2,
+                           u'caf\xe9': 3, u'': 4}
+        self.table = StringTable.from_dict(self.vocabulary)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mapping(self):
+        """Test that a table behaves like the dict it was built from"""
+        assert len(self.table) == len(self.vocabulary)
+        assert dict(self.table.items()) == self.vocabulary
+        assert self.table[u'caf\xe9'] == 3
+        assert u'love' in self.table and u'like' not in self.table
+        assert self.table.get(u'like') is None
+        self.assertRaises(KeyError, lambda: self.table[u'like'])
+
+    def test_lookup_many(self):
+        """Test batch lookups, including unknown and non-ASCII keys"""
+        keys = [u'i love', u'like', u'caf\xe9', u'', u'love', u'cafe']
+        assert list(self.table.lookup_many(keys)) == [2, -1, 3, 4, 0, -1]
+
+    def test_round_trip(self):
+        """Test that a saved table loads memory-mapped and unchanged"""
+        path = os.path.join(self.tmpdir, 'vocabulary')
+        self.table.save(path)
+        loaded = StringTable.load(path)
+        assert isinstance(loaded._hashes, np.memmap)
+        assert dict(loaded.items()) == self.vocabulary
+
+    def test_table_backend(self):
+        """Test that a table vocabulary transforms like the dict"""
+        texts = [text for text, _ in sa.load_pickle('lib/training.250.pickle')]
+        processor = sa.BagOfWords(
+            analyzer=sa.TweetAnalyzer(ngram_range=(1, 2))
+        )
+        X = processor.fit_transform(texts)
+        table_processor = sa.BagOfWords(
+            analyzer=sa.TweetAnalyzer(ngram_range=(1, 2)),
+            vocabulary_backend='table'
+        )
+        X_table = table_processor.fit_transform(texts)
+        assert isinstance(table_processor.vocabulary_, StringTable)
+        assert (X != X_table).nnz == 0
+        assert (processor.get_feature_names() ==
+                table_processor.get_feature_names())
+        new_texts = ['i love this', 'worst day ever']
+        assert (processor.transform(new_texts) !=
+                table_processor.transform(new_texts)).nnz == 0
+        self.assertRaises(ValueError, sa.BagOfWords(
+            vocabulary_backend='trie').fit, texts)
+
+
 if __name__ == '__main__':
     unittest.main()
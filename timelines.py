@@ -0,0 +1,352 @@
+"""
+Timeline fetching for Twittersa.
+
+TimelineFetcher pages through a user's timeline in a background thread, so
+the caller can classify one page while the next is in flight, and uses a
+RateLimiter to stop short of Twitter's per-endpoint rate limits rather than
+running into 429s. StubAPI stands in for tweepy.API offline, and FakeAPI
+makes up a timeline for any user from the tweets in a training corpus CSV.
+"""
+
+import copy
+import csv
+import datetime
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from Queue import Queue
+
+import tweepy
+
+from sentiment import metrics
+
+USER_TIMELINE = 'statuses/user_timeline'
+
+
+class RateLimitExceeded(Exception):
+    """Raised when an endpoint's rate limit budget is spent."""
+    def __init__(self, endpoint, reset):
+        Exception.__init__(self, '{} rate limit exceeded until {}'.format(
+            endpoint, time.ctime(reset)
+        ))
+        self.endpoint = endpoint
+        self.reset = reset
+
+
+def _header(response, name):
+    """Read a header from a tweepy last_response (httplib or requests)."""
+    if response is None:
+        return None
+    headers = getattr(response, 'headers', None)
+    if headers is not None and hasattr(headers, 'get'):
+        return headers.get(name)
+    if hasattr(response, 'getheader'):
+        return response.getheader(name)
+    return None
+
+
+class RateLimiter(object):
+    """
+    Tracks the remaining call budget of each endpoint, as reported by the
+    x-rate-limit-remaining and x-rate-limit-reset response headers.
+
+    Before each call, acquire() waits (up to max_wait seconds) for the window
+    to reset if no more than reserve calls are left, and otherwise raises
+    RateLimitExceeded instead of letting Twitter answer with a 429.
+    """
+    def __init__(self, reserve=0, max_wait=0, clock=time.time,
+                 sleep=time.sleep):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self._limits = {}  # endpoint -> (remaining, reset)
+        self._lock = threading.Lock()
+
+    def remaining(self, endpoint):
+        """Calls left for endpoint in this window (None if unknown)."""
+        with self._lock:
+            remaining, reset = self._limits.get(endpoint, (None, None))
+        if reset is not None and reset <= self.clock():
+            return None  # A new window has started
+        return remaining
+
+    def update(self, endpoint, remaining, reset):
+        with self._lock:
+            self._limits[endpoint] = (remaining, reset)
+
+    def update_from_response(self, endpoint, response):
+        remaining = _header(response, 'x-rate-limit-remaining')
+        reset = _header(response, 'x-rate-limit-reset')
+        if remaining is not None and reset is not None:
+            self.update(endpoint, int(remaining), int(reset))
+
+    def acquire(self, endpoint):
+        """Wait until a call to endpoint is within budget, and spend it."""
+        with self._lock:
+            remaining, reset = self._limits.get(endpoint, (None, None))
+            now = self.clock()
+            if remaining is None or reset is None or reset <= now:
+                return
+            if remaining > self.reserve:
+                self._limits[endpoint] = (remaining - 1, reset)
+                return
+        if reset - now > self.max_wait:
+            raise RateLimitExceeded(endpoint, reset)
+        self.sleep(reset - now)
+
+
+class TimelineFetcher(object):
+    """
+    Pages backwards through a user's timeline with max_id, newest first.
+
+    iter_pages fetches in a background thread, up to prefetch pages ahead of
+    the caller, so that page N+1 is already being fetched while the caller
+    works on page N. Errors are re-raised in the caller. If the rate limit
+    runs out partway, the pages fetched so far are returned.
+    """
+    def __init__(self, api, rate_limiter=None, pages=2, count=200,
+                 prefetch=1):
+        self.api = api
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.pages = pages
+        self.count = count  # 200 is the max for a single API call
+        self.prefetch = prefetch
+
+    def fetch_page(self, screen_name, max_id=None, since_id=None):
+        self.rate_limiter.acquire(USER_TIMELINE)
+        # tweepy keeps each call's response in api.last_response, which
+        # concurrent fetches would overwrite; a shallow copy keeps our own
+        api = copy.copy(self.api)
+        try:
+            with metrics.stage('twitter_api'):
+                page = api.user_timeline(
+                    screen_name=screen_name,
+                    include_rts=True,
+                    result_type='mixed',
+                    max_id=max_id,
+                    since_id=since_id,
+                    count=self.count
+                )
+        except tweepy.TweepError as e:
+            response = getattr(e, 'response', None)
+            if getattr(response, 'status', None) == 429 or getattr(
+                    response, 'status_code', None) == 429:
+                reset = _header(response, 'x-rate-limit-reset')
+                reset = int(reset) if reset else int(time.time()) + 900
+                self.rate_limiter.update(USER_TIMELINE, 0, reset)
+                raise RateLimitExceeded(USER_TIMELINE, reset)
+            raise
+        self.rate_limiter.update_from_response(
+            USER_TIMELINE, getattr(api, 'last_response', None)
+        )
+        return page
+
+    def _produce(self, screen_name, since_id, queue, stop):
+        max_id = None
+        try:
+            for x in range(self.pages):
+                if stop.is_set():
+                    break
+                try:
+                    page = self.fetch_page(screen_name, max_id, since_id)
+                except RateLimitExceeded:
+                    if x == 0:
+                        raise
+                    break  # Make do with what we have
+                if not page:  # Nothing older (or newer than since_id)
+                    break
+                queue.put((page, None))
+                # Get up to the last id polled
+                max_id = page[-1].id - 1
+        except Exception as e:
+            queue.put((None, e))
+        queue.put((None, None))
+
+    def iter_pages(self, screen_name, since_id=None):
+        """Yield pages of statuses, newest first, until since_id."""
+        queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(screen_name, since_id, queue, stop)
+        )
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                page, error = queue.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    break
+                yield page
+        finally:
+            stop.set()
+            # Unblock the producer if it's waiting on a full queue
+            while producer.is_alive():
+                while not queue.empty():
+                    queue.get_nowait()
+                producer.join(0.01)
+
+    def fetch(self, screen_name, since_id=None):
+        """All pages of statuses as one list, newest first."""
+        statuses = []
+        for page in self.iter_pages(screen_name, since_id):
+            statuses.extend(page)
+        return statuses
+
+
+class StubResponse(object):
+    """Mimics the parts of tweepy's last_response a RateLimiter reads."""
+    def __init__(self, status=200, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class StubAPI(object):
+    """
+    An offline stand-in for the tweepy.API endpoints Twittersa uses.
+
+    timelines maps screen names to status objects (anything with id, text
+    and created_at). Each call sleeps for latency seconds and, if rate_limit
+    is set, spends one of rate_limit calls per window seconds, reporting
+    the budget in last_response headers and raising a 429 TweepError once it
+    is spent. Calls are recorded in calls. Like tweepy.API, shallow copies
+    share the rate limit and calls but have their own last_response.
+    """
+    def __init__(self, timelines=None, latency=0.0, rate_limit=None,
+                 window=900, clock=time.time):
+        self.timelines = {}
+        for screen_name, statuses in (timelines or {}).iteritems():
+            self.add_timeline(screen_name, statuses)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.clock = clock
+        self.calls = []
+        self.last_response = None
+        self._window = {'start': None, 'calls': 0}  # Shared with copies
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(screen_name):
+        return screen_name.lstrip('@').lower()
+
+    def add_timeline(self, screen_name, statuses):
+        self.timelines[self._key(screen_name)] = sorted(
+            statuses, key=lambda s: s.id, reverse=True
+        )
+
+    def _spend_call(self):
+        with self._lock:
+            now = self.clock()
+            window = self._window
+            if window['start'] is None or now >= window['start'] + self.window:
+                window['start'] = now
+                window['calls'] = 0
+            reset = int(window['start'] + self.window)
+            if self.rate_limit is None:
+                return StubResponse()
+            if window['calls'] >= self.rate_limit:
+                response = StubResponse(429, {
+                    'x-rate-limit-remaining': '0',
+                    'x-rate-limit-reset': str(reset),
+                })
+                raise tweepy.TweepError('Rate limit exceeded', response)
+            window['calls'] += 1
+            return StubResponse(200, {
+                'x-rate-limit-remaining': str(
+                    self.rate_limit - window['calls']
+                ),
+                'x-rate-limit-reset': str(reset),
+            })
+
+    def _timeline(self, screen_name):
+        """The statuses of screen_name, newest first."""
+        return self.timelines.get(self._key(screen_name), [])
+
+    def user_timeline(self, screen_name=None, max_id=None, since_id=None,
+                      count=20, **kwargs):
+        self.calls.append({
+            'screen_name': screen_name,
+            'max_id': max_id,
+            'since_id': since_id,
+            'count': count,
+        })
+        if self.latency:
+            time.sleep(self.latency)
+        self.last_response = self._spend_call()
+        page = []
+        for status in self._timeline(screen_name):
+            if max_id is not None and status.id > max_id:
+                continue
+            if since_id is not None and status.id <= since_id:
+                break
+            page.append(status)
+            if len(page) == count:
+                break
+        return page
+
+
+class Status(object):
+    """The parts of a tweepy Status that Twittersa reads."""
+    def __init__(self, id, text, created_at):
+        self.id = id
+        self.text = text
+        self.created_at = created_at
+
+
+def load_statuses(filename, n=None):
+    """
+    The tweets of a Sentiment140-format CSV (the first n of them, if n is
+    given) as Statuses with their original ids and created_at times.
+    """
+    statuses = []
+    with open(filename, 'rb') as fin:
+        for row in csv.reader(fin, quotechar='"'):
+            # e.g. Fri Jun 19 13:21:58 PDT 2009; the zone is always PDT
+            parts = row[2].split()
+            created_at = datetime.datetime.strptime(
+                ' '.join(parts[:4] + parts[5:]), '%a %b %d %H:%M:%S %Y'
+            )
+            statuses.append(Status(int(row[1]),
+                                   row[-1].decode('utf-8', 'replace'),
+                                   created_at))
+            if len(statuses) == n:
+                break
+    return statuses
+
+
+class FakeAPI(StubAPI):
+    """
+    A StubAPI that serves a timeline for any screen name, made of
+    timeline_size tweets drawn from the Sentiment140-format CSV filename
+    (keeping their real ids and created_at times). The draw is seeded by the
+    screen name, so a user's timeline is the same on every call and in every
+    process. Timelines added with add_timeline take precedence.
+
+    latency and rate_limit are simulated as in StubAPI. Only the most recent
+    calls are recorded, so it can serve load tests indefinitely.
+    """
+    def __init__(self, filename, timeline_size=400, latency=0.0,
+                 rate_limit=None, window=900, clock=time.time):
+        StubAPI.__init__(self, latency=latency, rate_limit=rate_limit,
+                         window=window, clock=clock)
+        self.statuses = load_statuses(filename)
+        self.timeline_size = min(timeline_size, len(self.statuses))
+        self.calls = deque(maxlen=1000)
+
+    def _timeline(self, screen_name):
+        key = self._key(screen_name)
+        if key in self.timelines:
+            return self.timelines[key]
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        rng = random.Random(zlib.crc32(key))
+        return sorted(rng.sample(self.statuses, self.timeline_size),
+                      key=lambda s: s.id, reverse=True)
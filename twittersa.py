@@ -7,15 +7,93 @@ Jesse Mu
 """
 
 import os
+import time
 import logging
-from flask import Flask, render_template, request
+from collections import namedtuple
+from flask import Flask, render_template, request, jsonify, g, Response
 app = Flask(__name__)
 
 import tweepy
+import numpy as np
 import sentiment.classifiers as sa
-from dateutil.relativedelta import relativedelta
+from sentiment import metrics
+from sentiment.cache import LRUCache, SingleFlight, FlightTimeout
+from timelines import (TimelineFetcher, RateLimiter, RateLimitExceeded,
+                       FakeAPI)
+from batching import MicroBatcher, BatchTimeout
 
-USER_API_CALLS = 2
+# Number of tweets is 200 * this num
+USER_API_CALLS = int(os.environ.get('TWITTERSA_USER_PAGES', 2))
+# Seconds a user's classified timeline is served without asking Twitter for
+# newer tweets, and how many users' timelines are kept
+TIMELINE_CACHE_TTL = int(os.environ.get('TWITTERSA_TIMELINE_TTL', 300))
+TIMELINE_CACHE_SIZE = int(os.environ.get('TWITTERSA_TIMELINE_CACHE_SIZE', 256))
+# Where timelines come from: 'twitter', or 'fake' for timelines made up
+# from a training corpus, with no credentials or network (see FakeAPI)
+TIMELINE_SOURCE = os.environ.get('TWITTERSA_TIMELINE_SOURCE', 'twitter')
+
+# Classified tweets (oldest first), the newest tweet id, when we last asked
+# Twitter for newer ones, and whether a refresh since then was rate limited
+CachedTimeline = namedtuple('CachedTimeline',
+                            ['tweetsents', 'newest_id', 'fetched_at',
+                             'stale'])
+timeline_cache = LRUCache(TIMELINE_CACHE_SIZE)
+# Concurrent requests for the same user share one fetch; the others wait
+# up to this many seconds for it
+TIMELINE_FETCH_TIMEOUT = float(os.environ.get('TWITTERSA_TIMELINE_TIMEOUT',
+                                              30))
+timeline_flights = SingleFlight(timeout=TIMELINE_FETCH_TIMEOUT)
+# Remaining Twitter API budget, shared by every request in this process.
+# Once no more than RATE_LIMIT_RESERVE calls are left in the window,
+# requests wait up to RATE_LIMIT_MAX_WAIT seconds for it to reset, and fail
+# if it is further off than that
+RATE_LIMIT_RESERVE = int(os.environ.get('TWITTERSA_RATE_LIMIT_RESERVE', 2))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('TWITTERSA_RATE_LIMIT_MAX_WAIT',
+                                           5))
+rate_limiter = RateLimiter(reserve=RATE_LIMIT_RESERVE,
+                           max_wait=RATE_LIMIT_MAX_WAIT)
+# /api/classify requests arriving within BATCH_WAIT_MS of each other are
+# scored together, up to BATCH_SIZE texts at a time
+BATCH_SIZE = int(os.environ.get('TWITTERSA_BATCH_SIZE', 256))
+BATCH_WAIT_MS = float(os.environ.get('TWITTERSA_BATCH_WAIT_MS', 5))
+# Seconds an /api/classify request waits for its batch before giving up
+BATCH_TIMEOUT = float(os.environ.get('TWITTERSA_BATCH_TIMEOUT', 10))
+# Most texts accepted in one /api/classify request
+API_MAX_TEXTS = int(os.environ.get('TWITTERSA_API_MAX_TEXTS', 1000))
+# Requests with this header get a Server-Timing header breaking their
+# latency down by stage
+PROFILE_HEADER = 'X-Twittersa-Profile'
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+    if request.headers.get(PROFILE_HEADER):
+        metrics.start_profile()
+    else:
+        metrics.stop_profile()
+
+
+@app.after_request
+def record_request(response):
+    elapsed = time.time() - g.request_start
+    endpoint = request.endpoint or 'none'
+    metrics.observe('twittersa_request_seconds', elapsed, endpoint=endpoint)
+    metrics.inc('twittersa_requests_total', endpoint=endpoint,
+                status=response.status_code)
+    profile = metrics.stop_profile()
+    if profile is not None:
+        response.headers['Server-Timing'] = metrics.server_timing(
+            profile, elapsed
+        )
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Return this process's metrics in the Prometheus text format."""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
@@ -43,83 +121,218 @@ def search():
     )
 
 
+@app.route('/api/classify', methods=['POST'])
+def api_classify():
+    """
+    Classify the texts in a JSON object {"texts": [...]}, returning
+    {"results": [{"label": ..., "probs": {label: probability}}, ...]} in the
+    same order.
+    """
+    payload = request.get_json(silent=True)
+    texts = payload.get('texts') if isinstance(payload, dict) else None
+    if (not isinstance(texts, list) or
+            not all(isinstance(text, basestring) for text in texts)):
+        return jsonify({
+            'error': 'Expected a JSON object with a list of "texts"'
+        }), 400
+    if len(texts) > API_MAX_TEXTS:
+        return jsonify({
+            'error': 'At most {} texts per request'.format(API_MAX_TEXTS)
+        }), 413
+    classes = [str(label) for label in classifier.clf.classes_]
+    results = []
+    try:
+        with metrics.stage('classify'):
+            batch_probs = classify_batcher.submit(texts)
+    except BatchTimeout as e:
+        app.logger.warn(str(e))
+        return jsonify({'error': 'Timed out classifying - try again'}), 503
+    for probs in batch_probs:
+        results.append({
+            'label': classes[probs.argmax()],
+            'probs': dict(zip(classes, probs.tolist())),
+        })
+    return jsonify({'results': results})
+
+
+@app.route('/api/classify/stats')
+def api_classify_stats():
+    """Return the /api/classify batcher's queue depth and batch counters."""
+    return jsonify(classify_batcher.stats())
+
+
 def user(username):
     """Display historical sentiment of a given user's tweets."""
-    global_timeline = []
-    for x in range(USER_API_CALLS):  # Nunmber of tweets is 200 * this num
-        # TODO pagination might be easier
-        timeline = api.user_timeline(
-            screen_name=username,
-            include_rts=True,
-            result_type='mixed',
-            # Get up to the last id polled
-            max_id=global_timeline[-1].id - 1 if global_timeline else None,
-            count=200  # 200 is the max for a single API call
+    try:
+        timeline = load_timeline(username)
+    except RateLimitExceeded as e:
+        app.logger.warn(str(e))
+        minutes = max(1, int(e.reset - time.time()) // 60 + 1)
+        return render_template(
+            'error.html',
+            error="Twitter rate limit reached - try again in {} minutes"
+                  .format(minutes)
+        )
+    except FlightTimeout as e:
+        app.logger.warn(str(e))
+        return render_template(
+            'error.html',
+            error="Timed out loading {}'s tweets - try again".format(username)
+        )
+    stale_minutes = None
+    if timeline.stale:
+        stale_minutes = int(time.time() - timeline.fetched_at) // 60
+    with metrics.stage('transform_timeline'):
+        data, tweet_bins = transform_timeline(timeline.tweetsents)
+    with metrics.stage('render'):
+        return render_template(
+            'user.html',
+            username=username,
+            stale_minutes=stale_minutes,
+            data=data,
+            # This reverse is mirrored in data.labels|reverse in the template
+            tweet_bins=tweet_bins[::-1]
         )
-        global_timeline.extend(timeline)
-        # app.logger.warn([t.created_at for t in timeline])
-    global_timeline = global_timeline[::-1]
-    # app.logger.warn([t.created_at for t in global_timeline])
-    tweetsents = classifier.predict_many(global_timeline)
-    data, tweet_bins = transform_timeline(tweetsents)
-    return render_template(
-        'user.html',
-        username=username,
-        data=data,
-        # This reverse is mirrored in data.labels|reverse in the template
-        tweet_bins=tweet_bins[::-1]
-    )
 
 
-def transform_timeline(tweetsents):
-    tweetsents.sort()
+def classified_timeline(username):
+    """
+    Return a user's classified tweets, oldest first, as a SentimentBatch
+    (see load_timeline).
+    """
+    return load_timeline(username).tweetsents
+
+
+def load_timeline(username):
+    """
+    Return a user's CachedTimeline, refreshed if need be.
 
-    min_date = tweetsents[0].tweet.created_at
-    min_date = min_date.replace(day=1, hour=0, minute=0, second=0)
-    max_date = tweetsents[-1].tweet.created_at + relativedelta(months=+1)
-    max_date = max_date.replace(day=1, hour=0, minute=0, second=0)
+    Timelines are cached per user. Within TIMELINE_CACHE_TTL of the last
+    fetch the cached tweets are returned as is; after that only tweets newer
+    than the newest cached one are fetched and classified, and merged in.
+    If Twitter's rate limit stops the refresh, the cached timeline is
+    returned marked stale, and RateLimitExceeded is only raised for a user
+    with nothing cached.
 
-    r = relativedelta(max_date, min_date)
+    Concurrent requests for the same user share a single fetch: the first
+    one does it and the others wait for its result (or its error) for up to
+    TIMELINE_FETCH_TIMEOUT seconds, then raise FlightTimeout.
+    """
+    key = username.lower()
+    cached = timeline_cache.get(key)
+    if (cached is not None and
+            time.time() - cached.fetched_at < TIMELINE_CACHE_TTL):
+        return cached
+    return timeline_flights.do(key, refresh_timeline, username, key)
+
+
+def refresh_timeline(username, key):
+    """
+    Fetch and classify a user's tweets newer than those cached under key,
+    cache the merged timeline and return its CachedTimeline.
+    """
+    cached = timeline_cache.get(key)
+    now = time.time()
+    # A fetch that finished just before this one started may have done it
+    if cached is not None and now - cached.fetched_at < TIMELINE_CACHE_TTL:
+        return cached
+
+    since_id = cached.newest_id if cached is not None else None
+    fetcher = TimelineFetcher(api, rate_limiter, pages=USER_API_CALLS)
+    pages = []
+    newest_id = since_id
+    try:
+        for page in metrics.timed_iter(
+                'fetch', fetcher.iter_pages(username, since_id=since_id)):
+            # The next page is being fetched while we classify this one
+            if not pages:
+                newest_id = page[0].id
+            with metrics.stage('classify'):
+                pages.append(classifier.predict_many(page[::-1],
+                                                     columnar=True))
+    except RateLimitExceeded as e:
+        if cached is None:
+            raise
+        # Better the tweets we have than an error page
+        app.logger.warn('{}; serving cached tweets'.format(e))
+        metrics.inc('twittersa_stale_timelines_total')
+        return cached._replace(stale=True)
+    if cached is not None:
+        pages.append(cached.tweetsents)
+    tweetsents = sa.SentimentBatch.concat(reversed(pages),
+                                          classifier.clf.classes_)
+    # Keep the same history depth as a fresh fetch
+    tweetsents = tweetsents[-USER_API_CALLS * 200:]
+    timeline = CachedTimeline(tweetsents, newest_id, now, False)
+    timeline_cache.put(key, timeline)
+    return timeline
 
-    months_diff = (r.years * 12) + r.months
+
+def timeline_bins(first, last):
+    """
+    Return the start of each histogram bin for tweets between first and last
+    (datetimes or datetime64s), as a datetime64[s] array, and the strftime
+    format for labelling them. Bins are weekly if the tweets fit in under 5
+    calendar months, and monthly otherwise; either way they start on the
+    first of first's month.
+    """
+    min_month = np.datetime64(first, 'M')
+    max_month = np.datetime64(last, 'M') + 1
+    months_diff = int(max_month - min_month)
     if months_diff < 5:  # A lot of data, we can use weeks
-        # isocalendar gets number of week
-        max_week = max_date.isocalendar()[1]
-        min_week = min_date.isocalendar()[1]
-        weeks_diff = max_week - min_week
-        # If negative, there's a year offset - fix it
-        if weeks_diff < 0:
-            weeks_diff = 52 + max_week - min_week
-        app.logger.warn(weeks_diff)
-        dates = [add_weeks(min_date, x) for x in range(0, weeks_diff)]
-        human_dates = [d.strftime('%b %d') for d in dates]
+        min_date = min_month.astype('datetime64[D]')
+        max_date = max_month.astype('datetime64[D]')
+        starts = np.arange(min_date, max_date, np.timedelta64(7, 'D'))
+        label_format = '%b %d'
     else:
         # Stick to months
-        dates = [add_months(min_date, x) for x in range(0, months_diff)]
-        human_dates = [d.strftime('%b %y') for d in dates]
-    # app.logger.warn(min_date)
-    # app.logger.warn(max_date)
-    # app.logger.warn(months_diff)
-
-    # Create histogram bins
-    avg_bins = [[] for x in range(len(dates))]  # Calculates average
-    tweet_bins = [[] for x in range(len(dates))]  # For tweet table
-    # Current date index, we loop from bottom
-    i = 0
-    for tweetsent in tweetsents:
-        if tweetsent.tweet.created_at > dates[i] and i != len(dates) - 1:
-            # Shift the bins
-            i += 1
-        avg_bins[i].append(tweetsent.sentiment.prob_scaled)
-        tweet_bins[i].append(tweetsent)
-
-    app.logger.warn(avg_bins)
-    # Make this readable
-    averages = [round(bin_averages(b), 3) for b in avg_bins]
+        starts = np.arange(min_month, max_month)
+        label_format = '%b %y'
+    return starts.astype('datetime64[s]'), label_format
+
+
+def transform_timeline(tweetsents):
+    """
+    Bin tweetsents (a SentimentBatch or a list of TweetSentiments) by date
+    for the timeline chart, returning the chart data (bin labels and average
+    scaled probabilities) and the tweets in each bin.
+    """
+    if not len(tweetsents):
+        data = {'labels': [], 'datasets': [{'data': [], 'label': 'averages'}]}
+        return data, []
+    if isinstance(tweetsents, sa.SentimentBatch):
+        timestamps = tweetsents.created_at
+        probs = tweetsents.prob_scaled
+    else:
+        timestamps = np.array([t.tweet.created_at for t in tweetsents],
+                              dtype='datetime64[s]')
+        probs = np.array([t.sentiment.prob_scaled for t in tweetsents])
+    order = np.argsort(timestamps, kind='mergesort')
+    timestamps = timestamps[order]
+    probs = probs[order]
+    if isinstance(tweetsents, sa.SentimentBatch):
+        tweetsents = tweetsents[order]
+    else:
+        tweetsents = [tweetsents[i] for i in order]
+
+    starts, label_format = timeline_bins(timestamps[0], timestamps[-1])
+    n_bins = len(starts)
+    # Bin i holds tweets from starts[i] up to (not including) starts[i + 1]
+    bins = np.searchsorted(starts, timestamps, side='right') - 1
+    counts = np.bincount(bins, minlength=n_bins)
+    sums = np.bincount(bins, weights=probs, minlength=n_bins)
+    averages = np.round(sums / np.maximum(counts, 1), 3)
+
+    # Tweets are sorted, so each bin is a contiguous slice
+    bounds = np.searchsorted(bins, np.arange(n_bins + 1))
+    tweet_bins = [tweetsents[bounds[i]:bounds[i + 1]] for i in range(n_bins)]
+    human_dates = [d.strftime(label_format) for d in starts.astype(object)]
+
     data = {
         'labels': human_dates,
         'datasets': [{
-            'data': averages,
+            # Make this readable
+            'data': averages.tolist(),
             'label': 'averages',
             'fillColor': 'rgba(220,220,220,0.2)',
             'strokeColor': 'rgba(220,220,220,1)',
@@ -129,25 +342,9 @@ def transform_timeline(tweetsents):
             'pointHighlightStroke': 'rgba(220,220,220,1)'
         }]
     }
-    app.logger.warn(data)
     return data, tweet_bins
 
 
-def add_months(delta, months):
-    return delta + relativedelta(months=+months)
-
-
-def add_weeks(delta, weeks):
-    return delta + relativedelta(weeks=+weeks)
-
-
-def bin_averages(b):
-    if len(b) == 0:
-        return 0
-    else:
-        return sum(b)/len(b)
-
-
 def tweepy_init():
     """
     Create an authorized Tweepy API instance with API keys in the environment
@@ -161,6 +358,48 @@ def tweepy_init():
     return api
 
 
+def fake_api_init():
+    """
+    Create a FakeAPI from the CSV in TWITTERSA_FAKE_CORPUS, which answers
+    each call after TWITTERSA_FAKE_LATENCY seconds and, if
+    TWITTERSA_FAKE_RATE_LIMIT is set, allows that many calls per 15 minutes.
+    """
+    rate_limit = os.environ.get('TWITTERSA_FAKE_RATE_LIMIT')
+    return FakeAPI(
+        os.environ.get('TWITTERSA_FAKE_CORPUS', 'corpora/training.10000.csv'),
+        timeline_size=USER_API_CALLS * 200,
+        latency=float(os.environ.get('TWITTERSA_FAKE_LATENCY', 0.1)),
+        rate_limit=int(rate_limit) if rate_limit else None
+    )
+
+
+TIMELINE_SOURCES = {'twitter': tweepy_init, 'fake': fake_api_init}
+
+
+def load_classifier():
+    """
+    Load the classifier named by TWITTERSA_MODEL, or else the production
+    classifier (training it if its model artifact is missing or stale).
+    """
+    model_file = os.environ.get('TWITTERSA_MODEL')
+    if model_file:
+        # A prebuilt artifact, e.g. from python -m sentiment.streaming
+        classifier = sa.TwitterClassifier.load(model_file)
+        if classifier is None:
+            raise RuntimeError('Could not load model {}'.format(model_file))
+    else:
+        classifier = sa.load_or_train()
+    # Never shard batches across a process pool while serving: forking in a
+    # threaded worker can copy a lock another thread holds and deadlock the
+    # child, and served batches are too small to benefit anyway
+    if 'n_jobs' in classifier.processor.get_params():
+        classifier.processor.set_params(n_jobs=1)
+    # Load the lazy tokenizer resources now, so that with gunicorn's
+    # preload_app the workers share them rather than each loading its own
+    classifier.processor.transform([u'warm up'])
+    return classifier
+
+
 def setup_logging():
     logger_handler = logging.StreamHandler()
     logger_handler.setFormatter(
@@ -172,11 +411,62 @@ def setup_logging():
     app.logger.setLevel(logging.INFO)
 
 setup_logging()
-api = tweepy_init()
+if TIMELINE_SOURCE not in TIMELINE_SOURCES:
+    raise ValueError('TWITTERSA_TIMELINE_SOURCE should be one of {}'.format(
+        ', '.join(sorted(TIMELINE_SOURCES))
+    ))
+api = TIMELINE_SOURCES[TIMELINE_SOURCE]()
 app.logger.info('Loading classifier...')
-classifier = sa.TwitterClassifier()
-classifier.train()
-app.logger.info('Done')
+classifier = load_classifier()
+app.logger.info('Done (model {})'.format(classifier.checksum))
+classify_batcher = MicroBatcher(classifier.predict_proba,
+                                max_batch=BATCH_SIZE,
+                                max_wait=BATCH_WAIT_MS / 1000.,
+                                timeout=BATCH_TIMEOUT)
+
+
+def collect_metrics():
+    """Cache and batcher statistics for /metrics."""
+    caches = {'prediction': classifier.cache, 'timeline': timeline_cache,
+              'stem': sa.stem_cache}
+    yield ('twittersa_cache_hits_total', 'counter', 'Cache hits',
+           [({'cache': name}, cache.hits) for name, cache in caches.items()])
+    yield ('twittersa_cache_misses_total', 'counter', 'Cache misses',
+           [({'cache': name}, cache.misses)
+            for name, cache in caches.items()])
+    yield ('twittersa_cache_entries', 'gauge', 'Items in each cache',
+           [({'cache': name}, len(cache)) for name, cache in caches.items()])
+    yield ('twittersa_timeline_fetches_total', 'counter',
+           'User timeline fetches', [({}, timeline_flights.calls)])
+    yield ('twittersa_timeline_fetches_shared_total', 'counter',
+           'Requests that shared a concurrent fetch of the same timeline',
+           [({}, timeline_flights.shared)])
+    yield ('twittersa_timeline_fetch_timeouts_total', 'counter',
+           'Requests that gave up waiting for a shared fetch',
+           [({}, timeline_flights.timeouts)])
+    yield ('twittersa_timeline_fetches_in_flight', 'gauge',
+           'Timeline fetches in progress', [({}, len(timeline_flights))])
+    stats = classify_batcher.stats()
+    for name, kind, help, key in [
+            ('twittersa_batch_queue_depth', 'gauge',
+             'Texts waiting for an /api/classify batch', 'queue_depth'),
+            ('twittersa_batch_max_queue_depth', 'gauge',
+             'Most texts ever waiting for a batch', 'max_queue_depth'),
+            ('twittersa_batch_requests_total', 'counter',
+             'Requests submitted to the batcher', 'requests'),
+            ('twittersa_batches_total', 'counter',
+             'Batches classified', 'batches'),
+            ('twittersa_batch_items_total', 'counter',
+             'Texts classified in batches', 'items'),
+            ('twittersa_batch_wait_seconds_total', 'counter',
+             'Time requests spent waiting for their batch', 'wait_seconds'),
+            ('twittersa_batch_busy_seconds_total', 'counter',
+             'Time spent classifying batches', 'busy_seconds'),
+            ('twittersa_batch_timeouts_total', 'counter',
+             'Requests that gave up waiting for their batch', 'timeouts')]:
+        yield name, kind, help, [({}, stats[key])]
+
+metrics.add_collector(collect_metrics)
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
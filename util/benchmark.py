@@ -0,0 +1,245 @@
+"""
+Offline performance benchmarks for Twittersa, e.g.
+
+    python util/benchmark.py -o baseline.json
+    # ... change something ...
+    python util/benchmark.py -o new.json --compare baseline.json
+
+Tweets are read from a Sentiment140-format CSV in corpora/ and scored by
+the production model (lib/model/), and every benchmark clears the caches it
+would otherwise hit, so runs are comparable. It measures:
+
+ - preprocess: preprocess_tokens throughput, in tokens per second
+ - transform: BagOfWords.transform throughput, in tweets per second
+ - predict: single-tweet TwitterClassifier.predict latency percentiles
+ - predict_many: throughput at each of --batch-sizes
+ - search: end-to-end /search?q=@user latency through the Flask test client,
+   with the Twitter API stubbed out by a timeline of the CSV's tweets
+
+Results are written as JSON. With --compare, every metric is checked
+against a saved result and any that got worse by more than --threshold is
+reported as a regression (and the exit status is 1).
+"""
+
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+# twittersa authenticates with Twitter at import; the benchmarks stub it out
+os.environ.setdefault('TWITTER_CONSUMER_KEY', 'benchmark')
+os.environ.setdefault('TWITTER_CONSUMER_SECRET', 'benchmark')
+
+import sklearn
+
+import sentiment.classifiers as sa
+import timelines
+import twittersa
+
+BENCHMARKS = ('preprocess', 'transform', 'predict', 'predict_many', 'search')
+BATCH_SIZES = (1, 10, 100, 1000)
+
+
+def best_time(function, repeat):
+    """The fastest of repeat calls to function, in seconds."""
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def percentiles(seconds, prefix):
+    """The p50, p90 and p99 of seconds, in milliseconds."""
+    ms = np.asarray(seconds) * 1000
+    return {'{}_p{}_ms'.format(prefix, p): float(np.percentile(ms, p))
+            for p in (50, 90, 99)}
+
+
+def bench_preprocess(classifier, statuses, args):
+    texts = [status.text for status in statuses]
+    tokenizer = classifier.processor.analyzer.tokenizer
+    n_tokens = sum(len(sa.preprocess_tokens(text, tokenizer))
+                   for text in texts)
+
+    def run():
+        sa.stem_cache.clear()
+        for text in texts:
+            sa.preprocess_tokens(text, tokenizer)
+
+    return {'tokens_per_s': n_tokens / best_time(run, args.repeat)}
+
+
+def bench_transform(classifier, statuses, args):
+    texts = [status.text for status in statuses]
+    elapsed = best_time(lambda: classifier.processor.transform(texts),
+                        args.repeat)
+    return {'tweets_per_s': len(texts) / elapsed}
+
+
+def bench_predict(classifier, statuses, args):
+    seconds = []
+    for status in statuses[:args.requests]:
+        classifier.cache.clear()
+        start = time.time()
+        classifier.predict(status)
+        seconds.append(time.time() - start)
+    return percentiles(seconds, 'latency')
+
+
+def bench_predict_many(classifier, statuses, args):
+    results = {}
+    for batch_size in args.batch_sizes:
+        batches = [statuses[i:i + batch_size]
+                   for i in xrange(0, len(statuses), batch_size)]
+
+        def run():
+            classifier.cache.clear()
+            for batch in batches:
+                classifier.predict_many(batch, columnar=True)
+
+        elapsed = best_time(run, args.repeat)
+        results['batch_{}_tweets_per_s'.format(batch_size)] = (
+            len(statuses) / elapsed
+        )
+    return results
+
+
+def bench_search(classifier, statuses, args):
+    api = twittersa.api
+    twittersa.api = timelines.StubAPI({'benchmark': statuses})
+    client = twittersa.app.test_client()
+    seconds = []
+    try:
+        for _ in xrange(args.requests // 10 or 1):
+            twittersa.timeline_cache.clear()
+            classifier.cache.clear()
+            start = time.time()
+            response = client.get('/search?q=@benchmark')
+            seconds.append(time.time() - start)
+            assert response.status_code == 200
+    finally:
+        twittersa.api = api
+        twittersa.timeline_cache.clear()
+    return percentiles(seconds, 'latency')
+
+
+def compare(results, baseline, threshold):
+    """
+    Yield (benchmark, metric, baseline value, value, change, regressed) for
+    every metric in both results. Metrics ending in _per_s are better
+    higher, and the rest (latencies) lower.
+    """
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            new = results[name][metric]
+            change = (new - old) / old
+            if metric.endswith('_per_s'):
+                regressed = change < -threshold
+            else:
+                regressed = change > threshold
+            yield name, metric, old, new, change, regressed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--csv', default='corpora/training.10000.csv',
+        help="Sentiment140-format CSV to read tweets from"
+    )
+    parser.add_argument(
+        '-n', '--tweets', type=int, default=2000,
+        help="tweets to benchmark with"
+    )
+    parser.add_argument(
+        '-b', '--benchmark', action='append', choices=BENCHMARKS,
+        help="run only this benchmark (repeatable; default: all)"
+    )
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help="time throughput benchmarks this many times and keep the best"
+    )
+    parser.add_argument(
+        '--requests', type=int, default=500,
+        help="single-tweet predictions to time (and a tenth as many "
+             "searches)"
+    )
+    parser.add_argument(
+        '--batch-sizes', type=int, nargs='+', default=BATCH_SIZES,
+        help="predict_many batch sizes"
+    )
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help="write the results to this JSON file"
+    )
+    parser.add_argument(
+        '-c', '--compare', default=None,
+        help="JSON results to compare against"
+    )
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.15,
+        help="fractional slowdown reported as a regression"
+    )
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    statuses = timelines.load_statuses(args.csv, args.tweets)
+    classifier = twittersa.classifier
+    benchmarks = args.benchmark or BENCHMARKS
+    results = {}
+    for name in benchmarks:
+        start = time.time()
+        results[name] = globals()['bench_' + name](classifier, statuses, args)
+        print "{} ({:.1f}s)".format(name, time.time() - start)
+        for metric, value in sorted(results[name].items()):
+            print "    {}: {:.2f}".format(metric, value)
+
+    output = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'model': classifier.checksum,
+            'csv': args.csv,
+            'tweets': len(statuses),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        if baseline['meta'].get('model') != classifier.checksum:
+            print "warning: {} was run with a different model".format(
+                args.compare
+            )
+        regressions = 0
+        print "benchmark,metric,baseline,current,change"
+        for name, metric, old, new, change, regressed in compare(
+                results, baseline['results'], args.threshold):
+            print "{},{},{:.2f},{:.2f},{:+.1%}{}".format(
+                name, metric, old, new, change,
+                ',REGRESSION' if regressed else ''
+            )
+            regressions += regressed
+        if regressions:
+            sys.exit('{} regression(s) beyond {:.0%}'.format(
+                regressions, args.threshold
+            ))
@@ -0,0 +1,59 @@
+"""
+Train the production classifier and write it to a versioned model artifact,
+which Twittersa loads at startup instead of retraining.
+
+The artifact is tagged with a checksum of the training data and the
+preprocessing/classifier config, so it's only rebuilt when one of those
+changes (or with --force).
+"""
+
+import os
+import sys
+import time
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+import sentiment.classifiers as sa
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-t', '--training', default=sa.PROD_TRAINING_FILE,
+        help="training corpus (a corpus directory or .pickle file)"
+    )
+    parser.add_argument(
+        '-o', '--output', default=sa.PROD_MODEL_FILE,
+        help="model artifact destination"
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=sa.jobs_argument, default=1,
+        help="preprocess with this many processes (-1 for one per core)"
+    )
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help="retrain even if the existing artifact is up to date"
+    )
+    args = parser.parse_args()
+
+    checksum = sa.model_checksum(args.training)
+    if not args.force and sa.TwitterClassifier.load(
+            args.output, checksum=checksum) is not None:
+        print "{} is up to date ({})".format(args.output, checksum)
+        sys.exit(0)
+
+    start = time.time()
+    classifier = sa.TwitterClassifier()
+    sa.PROD_PROCESSOR.set_params(n_jobs=args.jobs)
+    classifier.train(data=sa.load_corpus(args.training))
+    # The artifact is for serving, which never vectorizes in parallel
+    classifier.processor.set_params(n_jobs=1)
+    print "trained on {} in {:.2f}s".format(args.training, time.time() - start)
+    classifier.save(args.output, checksum=checksum)
+    print "wrote {} ({})".format(args.output, checksum)
+
+    start = time.time()
+    sa.TwitterClassifier.load(args.output, checksum=checksum)
+    print "load time {:.3f}s".format(time.time() - start)
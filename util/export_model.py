@@ -0,0 +1,134 @@
+"""
+Export a pruned, quantized copy of the production classifier for serving
+(see TwitterClassifier.export), and report what it costs in accuracy.
+
+The production model is first trained on a random --train-fraction of the
+training corpus, exported, and both versions are scored on the rest, e.g.
+
+    python util/export_model.py --min-count 3 --dtype int8
+
+Then the model trained on the whole corpus is exported to --output (by
+default lib/model.pruned), which Twittersa serves with
+TWITTERSA_MODEL=lib/model.pruned.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+from sklearn.base import clone
+
+import sentiment.classifiers as sa
+
+
+def train(corpus):
+    """A production classifier trained on corpus."""
+    classifier = sa.TwitterClassifier(clf=clone(sa.PROD_CLASSIFIER))
+    classifier.train(data=corpus, processor=clone(sa.PROD_PROCESSOR))
+    return classifier
+
+
+def artifact_size(classifier):
+    """The size in bytes of the model artifact for classifier."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'model')
+        classifier.save(filename, checksum=classifier.checksum)
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(filename)
+                   for name in names)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def evaluate(classifier, texts, labels):
+    """
+    Return the accuracy on texts, and the seconds taken to vectorize them
+    and to score the vectors.
+    """
+    start = time.time()
+    X = classifier.processor.transform(texts)
+    transform_time = time.time() - start
+    start = time.time()
+    predicted = classifier.clf.predict(X)
+    predict_time = time.time() - start
+    return np.mean(predicted == labels), transform_time, predict_time
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-t', '--training', default=sa.PROD_TRAINING_FILE,
+        help="training corpus (a corpus directory or .pickle file)"
+    )
+    parser.add_argument(
+        '-o', '--output', default='lib/model.pruned',
+        help="exported model artifact destination"
+    )
+    parser.add_argument(
+        '--min-chi2', type=float, default=None,
+        help="drop features with a lower chi2 statistic"
+    )
+    parser.add_argument(
+        '--min-count', type=int, default=None,
+        help="drop features seen in fewer training tweets"
+    )
+    parser.add_argument(
+        '--dtype', choices=['float32', 'int8'], default='float32',
+        help="type to store the feature weights as"
+    )
+    parser.add_argument(
+        '--train-fraction', type=float, default=0.7,
+        help="fraction of the corpus to train on when measuring accuracy"
+    )
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help="random seed for the held-out split"
+    )
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help="only report, without writing --output"
+    )
+    args = parser.parse_args()
+    export_params = {'min_chi2': args.min_chi2, 'min_count': args.min_count,
+                     'dtype': np.dtype(args.dtype)}
+
+    corpus = sa.load_corpus(args.training)
+    split = corpus.shuffled(np.random.RandomState(args.seed))
+    n_train = int(len(split) * args.train_fraction)
+    test = split[n_train:]
+    texts, labels = list(test.texts()), test.labels
+
+    full = train(split[:n_train])
+    exported = full.export(**export_params)
+    print "model,features,accuracy,transform_s,predict_s,size_mb"
+    results = []
+    for name, classifier in (('full', full), ('exported', exported)):
+        accuracy, transform_time, predict_time = evaluate(
+            classifier, texts, labels
+        )
+        size = artifact_size(classifier)
+        results.append((accuracy, size))
+        print "{},{},{:.4f},{:.3f},{:.4f},{:.2f}".format(
+            name, len(classifier.processor.vocabulary_), accuracy,
+            transform_time, predict_time, size / 1e6
+        )
+    (full_accuracy, full_size), (accuracy, size) = results
+    print ("held-out accuracy change {:+.4f} on {} tweets, "
+           "{:.1f}x smaller").format(accuracy - full_accuracy, len(texts),
+                                     float(full_size) / size)
+
+    if not args.dry_run:
+        classifier = train(corpus)
+        classifier.checksum = sa.model_checksum(args.training)
+        exported = classifier.export(**export_params)
+        exported.save(args.output, checksum=exported.checksum)
+        print "wrote {} ({})".format(args.output, exported.checksum)
@@ -0,0 +1,88 @@
+"""
+Report how long importing a module takes, which modules it pulls in, and
+which of the lazily loaded sentiment resources are already loaded by the
+import, e.g.
+
+    python util/import_time.py sentiment.classifiers
+    python util/import_time.py twittersa
+"""
+
+import __builtin__
+import os
+import resource
+import sys
+import time
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+
+def profile_import(name):
+    """
+    Import the module called name, returning the total seconds taken and a
+    list of (seconds, depth, module) for each import statement that loaded
+    new modules, in the order they started. Times are inclusive of nested
+    imports.
+    """
+    records = []
+    stack = []
+    original_import = __builtin__.__import__
+
+    def timed_import(module, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        n_modules = len(sys.modules)
+        # "from . import x" imports an empty module name
+        record = [None, len(stack), module or ', '.join(fromlist or ())]
+        stack.append(record)
+        records.append(record)
+        start = time.time()
+        try:
+            return original_import(module, globals, locals, fromlist, level)
+        finally:
+            stack.pop()
+            if len(sys.modules) > n_modules:
+                record[0] = time.time() - start
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        __import__(name)
+    finally:
+        __builtin__.__import__ = original_import
+    total = time.time() - start
+    return total, [tuple(record) for record in records
+                   if record[0] is not None]
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        'module', nargs='?', default='sentiment.classifiers',
+        help="module to import"
+    )
+    parser.add_argument(
+        '-n', '--top', type=int, default=15,
+        help="number of slowest imports to list"
+    )
+    parser.add_argument(
+        '-d', '--depth', type=int, default=2,
+        help="only list imports nested at most this deep"
+    )
+    args = parser.parse_args()
+
+    n_modules = len(sys.modules)
+    total, records = profile_import(args.module)
+    print "import {}: {:.3f}s, {} modules, max RSS {:.1f} MB".format(
+        args.module, total, len(sys.modules) - n_modules,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    )
+    records = [record for record in records if record[1] <= args.depth]
+    for seconds, depth, module in sorted(records, reverse=True)[:args.top]:
+        print "{:8.3f}s  {}{}".format(seconds, '  ' * depth, module)
+
+    classifiers = sys.modules.get('sentiment.classifiers')
+    if classifiers is not None:
+        loaded = sorted(classifiers._resources)
+        print "resources loaded: {}".format(', '.join(loaded) or 'none')
+        print "nltk imported: {}".format('nltk' in sys.modules)
@@ -0,0 +1,136 @@
+"""
+Drive /search with many concurrent users and report throughput and latency.
+
+By default the app is loaded in this process with the fake timeline source
+(TWITTERSA_TIMELINE_SOURCE=fake, see timelines.FakeAPI) and driven through
+Flask's test client, so it runs offline:
+
+    python util/load_test.py -c 16 -d 30
+
+To load a running server instead (e.g. gunicorn with
+TWITTERSA_TIMELINE_SOURCE=fake), pass its URL:
+
+    python util/load_test.py --url http://localhost:8000 -c 64
+
+Each simulated user repeatedly searches for one of --users screen names at
+random, so the number of names controls how often the timeline cache hits.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+import urllib2
+from collections import Counter
+
+import numpy as np
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+
+def in_process_client():
+    """A function that GETs a path from the app in this process."""
+    os.environ.setdefault('TWITTERSA_TIMELINE_SOURCE', 'fake')
+    import twittersa
+    twittersa.app.logger.setLevel('WARNING')
+
+    def get(path):
+        # Test clients aren't shared between threads
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = twittersa.app.test_client()
+        response = client.get(path)
+        response.close()
+        return response.status_code
+
+    local = threading.local()
+    return get
+
+
+def url_client(url):
+    """A function that GETs a path from the server at url."""
+    def get(path):
+        try:
+            response = urllib2.urlopen(url.rstrip('/') + path)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as e:
+            return e.code
+    return get
+
+
+def run_user(get, names, deadline, max_requests, results, seed):
+    rng = random.Random(seed)
+    while time.time() < deadline and len(results) < max_requests:
+        path = '/search?q=@{}'.format(rng.choice(names))
+        start = time.time()
+        try:
+            status = get(path)
+        except Exception as e:
+            status = type(e).__name__
+        results.append((time.time() - start, status))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--url', default=None,
+        help="server to load (default: the app in this process)"
+    )
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=8,
+        help="simultaneous users"
+    )
+    parser.add_argument(
+        '-d', '--duration', type=float, default=20,
+        help="seconds to run for"
+    )
+    parser.add_argument(
+        '-n', '--requests', type=int, default=None,
+        help="stop after this many requests"
+    )
+    parser.add_argument(
+        '-u', '--users', type=int, default=100,
+        help="distinct screen names searched for"
+    )
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help="random seed for the users' searches"
+    )
+    args = parser.parse_args()
+
+    get = url_client(args.url) if args.url else in_process_client()
+    names = ['user{}'.format(i) for i in range(args.users)]
+    results = []
+    start = time.time()
+    threads = [
+        threading.Thread(target=run_user, args=(
+            get, names, start + args.duration,
+            args.requests or float('inf'), results, args.seed + i
+        ))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    if not results:
+        sys.exit('load_test.py: error: no requests completed')
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    statuses = Counter(status for _, status in results)
+    print "{} requests in {:.1f}s from {} users: {:.1f} requests/s".format(
+        len(results), elapsed, args.concurrency, len(results) / elapsed
+    )
+    print "latency ms: mean {:.0f}, p50 {:.0f}, p90 {:.0f}, p99 {:.0f}, " \
+        "max {:.0f}".format(latencies.mean(),
+                            *np.percentile(latencies, [50, 90, 99, 100]))
+    print "responses: {}".format(', '.join(
+        '{} x{}'.format(status, count)
+        for status, count in sorted(statuses.items())
+    ))
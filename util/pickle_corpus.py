@@ -1,35 +1,44 @@
 """
 Read training data CSVs from the corpus and serialize the results.
 
+Each corpora/training.N.csv is written to lib/training.N/ in the columnar
+format of sentiment/corpus.py, which is memory-mapped on load. --pickle also
+writes the older lib/training.N.pickle lists.
+
 Jesse Mu
 """
 
 import pickle  # Standard pickle for unicode support
 import csv
 import os
+import sys
+import time
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+from sentiment.corpus import Corpus
 
 
 def csv_extract(filename):
-    tweets = []
+    """Yield the [text, sentiment] pairs in a Sentiment140-format CSV."""
     with open(filename, 'r') as f:
         reader = csv.reader(f, quotechar='"')
-        rows = list(reader)
-    for row in rows:
-        sentiment = row[0]
-        text = row[-1]
-        # 4 is positive, 2 is neutral, 0 is negative
-        if sentiment == '4':
-            sentiment = 'positive'
-        elif sentiment == '2':
-            sentiment = 'neutral'
-        elif sentiment == '0':
-            sentiment = 'negative'
-        else:
-            raise Exception(
-                "Don't know how to handle sentiment {}".format(sentiment)
-            )
-        tweets.append([text, sentiment])
-    return tweets
+        for row in reader:
+            sentiment = row[0]
+            text = row[-1]
+            # 4 is positive, 2 is neutral, 0 is negative
+            if sentiment == '4':
+                sentiment = 'positive'
+            elif sentiment == '2':
+                sentiment = 'neutral'
+            elif sentiment == '0':
+                sentiment = 'negative'
+            else:
+                raise Exception(
+                    "Don't know how to handle sentiment {}".format(sentiment)
+                )
+            yield [text, sentiment]
 
 
 def serialize(filename, dictionary, verbose=False):
@@ -42,13 +51,35 @@ def pickle_filename(filename):
     assert filename[-4:] == '.csv' and filename[:8] == 'corpora/'
     return 'lib/{}.pickle'.format(filename[8:-4])
 
+
+def corpus_dirname(filename):
+    assert filename[-4:] == '.csv' and filename[:8] == 'corpora/'
+    return 'lib/{}'.format(filename[8:-4])
+
 if __name__ == '__main__':
-    for filename in os.listdir("corpora/"):
-        if filename.endswith(".csv"):
-            filename = "corpora/{}".format(filename)
-            print "parsing {}".format(filename)
-            tweets = csv_extract(filename)
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        'csv', nargs='*',
+        help="CSVs in corpora/ to convert (default: all of them)"
+    )
+    parser.add_argument(
+        '-p', '--pickle', action='store_true',
+        help="also write the older lib/training.N.pickle format"
+    )
+    args = parser.parse_args()
+
+    filenames = args.csv or sorted(
+        "corpora/{}".format(filename) for filename in os.listdir("corpora/")
+        if filename.endswith(".csv")
+    )
+    for filename in filenames:
+        print "parsing {}".format(filename)
+        corpus = Corpus.from_pairs(csv_extract(filename))
+        corpus_dir = corpus_dirname(filename)
+        print "writing {} tweets to {}".format(len(corpus), corpus_dir)
+        corpus.save(corpus_dir)
+        if args.pickle:
             pickle_file = pickle_filename(filename)
             print "writing to {}".format(pickle_file)
-            with open(pickle_file, 'w') as fout:
-                pickle.dump(tweets, fout)
+            serialize(pickle_file, [list(pair) for pair in corpus])
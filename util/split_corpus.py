@@ -0,0 +1,124 @@
+"""
+Sample the training corpora from the full Sentiment140 CSV in a single
+streaming pass, replacing corpora/create_smaller_corpora.sh.
+
+A seeded reservoir sample of the largest requested size is drawn while the
+source is read, then shuffled once; every smaller corpus is a prefix of that
+shuffle. So each corpus is a uniform random sample of the source, the
+smaller ones are nested in the larger ones, memory is bounded by the
+largest size, and the same seed always gives the same corpora.
+
+    python util/split_corpus.py \\
+        corpora/training.1600000.processed.noemoticon.csv
+
+writes lib/training.N/ (see sentiment/corpus.py) for each size, and with
+--csv-dir corpora also the corpora/training.N.csv files.
+"""
+
+import csv
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+from sentiment.corpus import Corpus, LABELS
+
+# The sizes create_smaller_corpora.sh produced
+SIZES = [100, 250, 500, 750, 1000, 2500, 5000, 7500, 10000, 15000, 20000,
+         25000, 250000]
+# Sentiment140 polarity column: 4 is positive, 2 is neutral, 0 is negative
+SENTIMENT140_LABELS = {'0': 'negative', '2': 'neutral', '4': 'positive'}
+
+
+def reservoir_sample(rows, k, rng):
+    """
+    Return a uniform random sample of k of rows (all of them if there are
+    fewer) in random order, reading rows once and holding at most k of them.
+    Also returns the number of rows read.
+    """
+    reservoir = []
+    n = 0
+    for n, row in enumerate(rows, 1):
+        if n <= k:
+            reservoir.append(row)
+        else:
+            j = rng.randint(0, n - 1)
+            if j < k:
+                reservoir[j] = row
+    rng.shuffle(reservoir)
+    return reservoir, n
+
+
+def label_of(row):
+    """The sentiment label of a Sentiment140 CSV row."""
+    try:
+        return SENTIMENT140_LABELS[row[0]]
+    except KeyError:
+        raise ValueError(
+            "Don't know how to handle sentiment {}".format(row[0])
+        )
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        'source',
+        help="Sentiment140-format CSV to sample from"
+    )
+    parser.add_argument(
+        'sizes', nargs='*', type=int, default=SIZES,
+        help="corpus sizes to write (default: {})".format(
+            ' '.join(map(str, SIZES))
+        )
+    )
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help="random seed; the same seed and source give the same corpora"
+    )
+    parser.add_argument(
+        '-o', '--output', default='lib',
+        help="directory to write the training.N corpora to"
+    )
+    parser.add_argument(
+        '--csv-dir', default=None,
+        help="also write training.N.csv files to this directory"
+    )
+    args = parser.parse_args()
+
+    sizes = sorted(set(args.sizes))
+    rng = random.Random(args.seed)
+    start = time.time()
+    with open(args.source, 'rb') as fin:
+        sample, n_rows = reservoir_sample(
+            csv.reader(fin, quotechar='"'), sizes[-1], rng
+        )
+    print "read {} rows from {} in {:.1f}s".format(
+        n_rows, args.source, time.time() - start
+    )
+    if sizes[-1] > len(sample):
+        sys.exit('split_corpus.py: error: {} has only {} rows'.format(
+            args.source, n_rows
+        ))
+    labels = [label_of(row) for row in sample]
+
+    print "size,{},positive_fraction".format(','.join(LABELS))
+    for size in sizes:
+        counts = Counter(labels[:size])
+        print "{},{},{:.4f}".format(
+            size, ','.join(str(counts[label]) for label in LABELS),
+            float(counts['positive']) / size
+        )
+        Corpus.from_pairs(
+            (row[-1], label) for row, label in zip(sample, labels[:size])
+        ).save(os.path.join(args.output, 'training.{}'.format(size)))
+        if args.csv_dir is not None:
+            filename = 'training.{}.csv'.format(size)
+            with open(os.path.join(args.csv_dir, filename), 'wb') as fout:
+                writer = csv.writer(fout, quoting=csv.QUOTE_ALL,
+                                    lineterminator='\n')
+                writer.writerows(sample[:size])
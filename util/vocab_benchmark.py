@@ -0,0 +1,133 @@
+"""
+Compare the dict and StringTable (sentiment/vocab.py) vocabulary backends
+of BagOfWords: memory, serialized size, build time, lookup throughput and
+transform throughput, e.g.
+
+    python util/vocab_benchmark.py lib/training.25000
+
+The vocabulary is fitted with PROD_PROCESSOR's analyzer on the first
+--train tweets of the corpus, and looked up with the n-grams of the next
+--test tweets, so the queries mix seen and unseen features as in production.
+"""
+
+import cPickle
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Run from the repository home directory, like the other util scripts
+sys.path.insert(0, os.getcwd())
+
+from sklearn.base import clone
+
+import sentiment.classifiers as sa
+from sentiment.corpus import load_corpus
+from sentiment.vocab import StringTable
+
+
+def dict_nbytes(vocabulary):
+    """
+    The memory held by a dict of unicode keys and int values: the table plus
+    every key and value object (small ints are shared, but these mostly
+    aren't).
+    """
+    return sys.getsizeof(vocabulary) + sum(
+        sys.getsizeof(key) + sys.getsizeof(value)
+        for key, value in vocabulary.iteritems()
+    )
+
+
+def dir_nbytes(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def best_time(function, repeat=3):
+    """The fastest of repeat calls to function, in seconds."""
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument(
+        'corpus', nargs='?', default=sa.PROD_TRAINING_FILE,
+        help="corpus to fit and query the vocabulary with "
+             "(default: {})".format(sa.PROD_TRAINING_FILE)
+    )
+    parser.add_argument(
+        '--train', type=int, default=None,
+        help="tweets to fit the vocabulary on (default: all but --test)"
+    )
+    parser.add_argument(
+        '--test', type=int, default=1000,
+        help="tweets to look up and transform"
+    )
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    n_train = args.train or len(corpus) - args.test
+    if n_train + args.test > len(corpus):
+        sys.exit('vocab_benchmark.py: error: {} has only {} tweets'.format(
+            args.corpus, len(corpus)
+        ))
+    train_texts = list(corpus[:n_train].texts())
+    test_texts = list(corpus[n_train:n_train + args.test].texts())
+
+    processor = clone(sa.PROD_PROCESSOR).set_params(
+        vocabulary_backend='dict'
+    )
+    start = time.time()
+    processor.fit(train_texts)
+    print "fit {} features on {} tweets in {:.1f}s".format(
+        len(processor.vocabulary_), n_train, time.time() - start
+    )
+    vocabulary = processor.vocabulary_
+    start = time.time()
+    table = StringTable.from_dict(vocabulary)
+    build_time = time.time() - start
+
+    analyze = processor.build_analyzer()
+    queries = [feature for text in test_texts for feature in analyze(text)]
+    hits = sum(1 for feature in queries if feature in vocabulary)
+    print "{} queries from {} tweets, {:.1%} in the vocabulary".format(
+        len(queries), len(test_texts), float(hits) / len(queries)
+    )
+    assert list(table.lookup_many(queries)) == [vocabulary.get(q, -1)
+                                                for q in queries]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        table.save(tmpdir)
+        table_disk = dir_nbytes(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    dict_disk = len(cPickle.dumps(vocabulary, cPickle.HIGHEST_PROTOCOL))
+
+    dict_lookup = best_time(lambda: [vocabulary.get(q, -1) for q in queries])
+    table_get = best_time(lambda: [table.get(q, -1) for q in queries])
+    table_lookup = best_time(lambda: table.lookup_many(queries))
+    dict_transform = best_time(lambda: processor.transform(test_texts))
+    processor.vocabulary_ = table
+    table_transform = best_time(lambda: processor.transform(test_texts))
+
+    print "backend,memory_mb,disk_mb,build_s,lookups_per_s,transform_s"
+    print "dict,{:.1f},{:.1f},0,{:.0f},{:.3f}".format(
+        dict_nbytes(vocabulary) / 1e6, dict_disk / 1e6,
+        len(queries) / dict_lookup, dict_transform
+    )
+    print "table (get),{:.1f},{:.1f},{:.2f},{:.0f},".format(
+        table.nbytes / 1e6, table_disk / 1e6, build_time,
+        len(queries) / table_get
+    )
+    print "table (lookup_many),{:.1f},{:.1f},{:.2f},{:.0f},{:.3f}".format(
+        table.nbytes / 1e6, table_disk / 1e6, build_time,
+        len(queries) / table_lookup, table_transform
+    )